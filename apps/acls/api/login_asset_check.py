@@ -26,7 +26,7 @@ class LoginAssetCheckAPI(CreateAPIView):
             'action': LoginAssetACL.ActionChoices.login_confirm
         }
         with tmp_to_org(self.serializer.org):
-            acl = LoginAssetACL.filter(**queries).valid().first()
+            acl = LoginAssetACL.get_matched_acl(**queries)
 
         if not acl:
             is_need_confirm = False
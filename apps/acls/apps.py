@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AclsConfig(AppConfig):
     name = 'acls'
+
+    def ready(self):
+        super().ready()
+        from . import signals_handler
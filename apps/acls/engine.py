@@ -0,0 +1,171 @@
+import uuid
+import threading
+
+from django.core.cache import cache
+
+from common.utils import get_logger
+from common.utils.ip import IPGroupMatcher
+from common.utils.time_period import TimePeriodMatcher
+from orgs.utils import tmp_to_org
+from .models import LoginACL, LoginAssetACL
+
+logger = get_logger(__file__)
+
+__all__ = ['LoginACLEngine', 'LoginAssetACLEngine']
+
+
+class WildcardSet:
+    """ 包含 `*` 时匹配所有，否则要完全相等 """
+
+    def __init__(self, values):
+        values = values or []
+        self.match_all = '*' in values
+        self.values = set(values)
+
+    def contains(self, value):
+        return self.match_all or value in self.values
+
+
+class BaseACLEngine:
+    """
+    把有效的 ACL 预先编译到内存中，匹配时不用查询数据库;
+    ACL 变化时更新缓存中的版本号，各进程发现版本号变化后重新编译
+    """
+    version_cache_key_template = 'ACLS_{}_VERSION_{}'
+    # { org_id: (version, engine) }, 每个子类单独一份
+    engines = None
+    lock = None
+
+    def __init__(self, org_id):
+        self.org_id = org_id
+
+    @classmethod
+    def get_version_cache_key(cls, org_id):
+        return cls.version_cache_key_template.format(cls.__name__.upper(), org_id)
+
+    @classmethod
+    def get_version(cls, org_id):
+        return cache.get_or_set(cls.get_version_cache_key(org_id), uuid.uuid4().hex, None)
+
+    @classmethod
+    def expire(cls, org_id=''):
+        cache.set(cls.get_version_cache_key(org_id), uuid.uuid4().hex, None)
+
+    @classmethod
+    def get_engine(cls, org_id=''):
+        org_id = str(org_id)
+        version = cls.get_version(org_id)
+        item = cls.engines.get(org_id)
+        if item and item[0] == version:
+            return item[1]
+
+        with cls.lock:
+            item = cls.engines.get(org_id)
+            if item and item[0] == version:
+                return item[1]
+            engine = cls(org_id)
+            engine.compile()
+            # 编译期间版本号变化的话，下次获取时会发现版本号不同，重新编译
+            cls.engines[org_id] = (version, engine)
+            logger.debug(f'Compile {cls.__name__}: org={org_id} version={version}')
+        return engine
+
+    def compile(self):
+        raise NotImplementedError
+
+
+class CompiledLoginACL:
+    def __init__(self, acl_id, action, rules, has_reviewers):
+        self.id = acl_id
+        self.action = action
+        self.ip_group = IPGroupMatcher(rules.get('ip_group'))
+        self.time_period = TimePeriodMatcher(rules.get('time_period'))
+        self.has_reviewers = has_reviewers
+
+    def contains_ip(self, ip):
+        return self.ip_group.contains(ip)
+
+    def contains_time_period(self):
+        return self.time_period.contains()
+
+
+class LoginACLEngine(BaseACLEngine):
+    """ 用户登录 ACL 不属于组织，只有一个 """
+    engines = {}
+    lock = threading.Lock()
+
+    def __init__(self, org_id=''):
+        super().__init__(org_id)
+        # { user_id: [CompiledLoginACL, ...] }，按匹配顺序排列
+        self.user_acls_mapper = {}
+
+    def compile(self):
+        acl_ids_with_reviewers = set(
+            LoginACL.reviewers.through.objects.values_list('loginacl_id', flat=True).distinct()
+        )
+        acls = LoginACL.objects.valid().values_list('id', 'user_id', 'action', 'rules')
+        for acl_id, user_id, action, rules in acls:
+            acl = CompiledLoginACL(acl_id, action, rules or {}, acl_id in acl_ids_with_reviewers)
+            self.user_acls_mapper.setdefault(user_id, []).append(acl)
+
+    def get_user_first_acl(self, user_id, confirm):
+        """
+        :param confirm: True 只找复核的，False 只找复核之外的
+        """
+        for acl in self.user_acls_mapper.get(user_id, []):
+            is_confirm = acl.action == LoginACL.ActionChoices.confirm
+            if is_confirm == confirm:
+                return acl
+        return None
+
+
+class CompiledLoginAssetACL:
+    def __init__(self, acl_id, action, users, assets, system_users):
+        self.id = acl_id
+        self.action = action
+        self.usernames = WildcardSet(users.get('username_group'))
+        self.hostnames = WildcardSet(assets.get('hostname_group'))
+        self.ip_group = IPGroupMatcher(assets.get('ip_group'))
+        self.system_user_names = WildcardSet(system_users.get('name_group'))
+        self.system_user_usernames = WildcardSet(system_users.get('username_group'))
+        self.system_user_protocols = WildcardSet(system_users.get('protocol_group'))
+
+    @classmethod
+    def from_acl(cls, acl):
+        return cls(acl.id, acl.action, acl.users or {}, acl.assets or {}, acl.system_users or {})
+
+    def match(self, user, asset, system_user):
+        return self.usernames.contains(user.username) \
+               and self.hostnames.contains(asset.hostname) \
+               and self.ip_group.contains(asset.ip) \
+               and self.system_user_names.contains(system_user.name) \
+               and self.system_user_usernames.contains(system_user.username) \
+               and self.system_user_protocols.contains(system_user.protocol)
+
+
+class LoginAssetACLEngine(BaseACLEngine):
+    engines = {}
+    lock = threading.Lock()
+
+    def __init__(self, org_id):
+        super().__init__(org_id)
+        # { action: [CompiledLoginAssetACL, ...] }，按匹配顺序排列
+        self.action_acls_mapper = {}
+
+    def compile(self):
+        with tmp_to_org(self.org_id):
+            acls = LoginAssetACL.objects.valid().values_list(
+                'id', 'action', 'users', 'assets', 'system_users'
+            )
+            for acl_id, action, users, assets, system_users in acls:
+                acl = CompiledLoginAssetACL(acl_id, action, users or {}, assets or {}, system_users or {})
+                self.action_acls_mapper.setdefault(action, []).append(acl)
+
+    def match(self, user, asset, system_user, action):
+        """
+        :return: 第一个匹配的 ACL 的 id
+        """
+        for acl in self.action_acls_mapper.get(action, []):
+            if acl.match(user, asset, system_user):
+                return acl.id
+        return None
@@ -2,8 +2,6 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from .base import BaseACL, BaseACLQuerySet
 from common.utils import get_request_ip, get_ip_city
-from common.utils.ip import contains_ip
-from common.utils.time_period import contains_time_period
 from common.utils.timezone import local_now_display
 
 
@@ -58,40 +56,41 @@ class LoginACL(BaseACL):
 
     @staticmethod
     def allow_user_confirm_if_need(user, ip):
-        acl = LoginACL.filter_acl(user).filter(
-            action=LoginACL.ActionChoices.confirm
-        ).first()
-        acl = acl if acl and acl.reviewers.exists() else None
-        if not acl:
-            return False, acl
-        ip_group = acl.rules.get('ip_group')
-        time_periods = acl.rules.get('time_period')
-        is_contain_ip = contains_ip(ip, ip_group)
-        is_contain_time_period = contains_time_period(time_periods)
-        return is_contain_ip and is_contain_time_period, acl
+        from ..engine import LoginACLEngine
+        # 编译后 ACL 可能已经被删除、修改，数据库中查不到或者不再需要复核时重新匹配一次
+        for i in range(2):
+            acl = LoginACLEngine.get_engine().get_user_first_acl(user.id, confirm=True)
+            acl = acl if acl and acl.has_reviewers else None
+            if not acl:
+                return False, acl
+            if not (acl.contains_ip(ip) and acl.contains_time_period()):
+                return False, None
+            acl = LoginACL.objects.filter(id=acl.id).valid().first()
+            if acl and acl.action == LoginACL.ActionChoices.confirm and acl.reviewers.exists():
+                return True, acl
+            LoginACLEngine.expire()
+        return False, None
 
     @staticmethod
     def allow_user_to_login(user, ip):
-        acl = LoginACL.filter_acl(user).exclude(
-            action=LoginACL.ActionChoices.confirm
-        ).first()
+        from ..engine import LoginACLEngine
+        acl = LoginACLEngine.get_engine().get_user_first_acl(user.id, confirm=False)
         if not acl:
             return True, ''
-        ip_group = acl.rules.get('ip_group')
-        time_periods = acl.rules.get('time_period')
-        is_contain_ip = contains_ip(ip, ip_group)
-        is_contain_time_period = contains_time_period(time_periods)
+        is_contain_ip = acl.contains_ip(ip)
+        is_contain_time_period = acl.contains_time_period()
+        action_allow = acl.action == LoginACL.ActionChoices.allow
 
         reject_type = ''
         if is_contain_ip and is_contain_time_period:
             # 满足条件
-            allow = acl.action_allow
+            allow = action_allow
             if not allow:
                 reject_type = 'ip' if is_contain_ip else 'time'
         else:
             # 不满足条件
             # 如果acl本身允许，那就拒绝；如果本身拒绝，那就允许
-            allow = not acl.action_allow
+            allow = not action_allow
             if not allow:
                 reject_type = 'ip' if not is_contain_ip else 'time'
 
@@ -42,6 +42,25 @@ class LoginAssetACL(BaseACL, OrgModelMixin):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def get_matched_acl(cls, user, asset, system_user, action):
+        """
+        与 `filter(...).valid().first()` 相同，在内存中编译好的 ACL 中匹配
+        """
+        from orgs.utils import current_org
+        from ..engine import LoginAssetACLEngine, CompiledLoginAssetACL
+        # 编译后 ACL 可能已经被删除、禁用或修改，数据库中查不到或者不再匹配时重新匹配一次
+        for i in range(2):
+            acl_id = LoginAssetACLEngine.get_engine(current_org.id).match(user, asset, system_user, action)
+            if not acl_id:
+                return None
+            acl = cls.objects.filter(id=acl_id).valid().first()
+            if acl and acl.action == action \
+                    and CompiledLoginAssetACL.from_acl(acl).match(user, asset, system_user):
+                return acl
+            LoginAssetACLEngine.expire(current_org.id)
+        return None
+
     @classmethod
     def filter(cls, user, asset, system_user, action):
         queryset = cls.objects.filter(action=action)
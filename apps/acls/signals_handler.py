@@ -0,0 +1,22 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from common.utils import get_logger
+from common.decorator import on_transaction_commit
+from .models import LoginACL, LoginAssetACL
+from .engine import LoginACLEngine, LoginAssetACLEngine
+
+logger = get_logger(__file__)
+
+
+@receiver([post_save, post_delete], sender=LoginACL)
+@receiver(m2m_changed, sender=LoginACL.reviewers.through)
+@on_transaction_commit
+def on_login_acl_change(sender, **kwargs):
+    LoginACLEngine.expire()
+
+
+@receiver([post_save, post_delete], sender=LoginAssetACL)
+@on_transaction_commit
+def on_login_asset_acl_change(sender, instance, **kwargs):
+    LoginAssetACLEngine.expire(instance.org_id)
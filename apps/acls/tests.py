@@ -1,3 +1,64 @@
-from django.test import TestCase
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.test import TransactionTestCase
+
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from .models import LoginAssetACL
+
+
+class LoginAssetACLMatchTestCase(TransactionTestCase):
+    """
+    ACL 变化后在事务提交时让编译的 ACL 失效，所以使用 TransactionTestCase;
+    `update` 不发送信号，用来模拟编译的 ACL 过期的情况
+    """
+    action = LoginAssetACL.ActionChoices.login_confirm
+
+    def setUp(self):
+        self.org = Organization.default()
+        with tmp_to_org(self.org):
+            self.acl1 = self.create_acl('acl1', 10, ['10.0.0.0/24'])
+            self.acl2 = self.create_acl('acl2', 20, ['*'])
+        self.user = SimpleNamespace(username='acl_test_user')
+        self.asset = SimpleNamespace(hostname='acl_test_host', ip='10.0.0.1')
+        self.system_user = SimpleNamespace(name='acl_test_system_user', username='root', protocol='ssh')
+
+    @staticmethod
+    def create_acl(name, priority, ip_group):
+        return LoginAssetACL.objects.create(
+            name=name, priority=priority,
+            users={'username_group': ['*']},
+            assets={'hostname_group': ['*'], 'ip_group': ip_group},
+            system_users={'name_group': ['*'], 'username_group': ['*'], 'protocol_group': ['ssh']},
+        )
+
+    def update_acls(self, acls, **kwargs):
+        with tmp_to_org(self.org):
+            LoginAssetACL.objects.filter(id__in=[acl.id for acl in acls]).update(**kwargs)
+
+    def get_matched_acl(self):
+        with tmp_to_org(self.org):
+            return LoginAssetACL.get_matched_acl(self.user, self.asset, self.system_user, self.action)
+
+    def test_match(self):
+        self.assertEqual(self.get_matched_acl(), self.acl1)
+        self.asset.ip = '10.0.1.1'
+        self.assertEqual(self.get_matched_acl(), self.acl2)
+        self.system_user.protocol = 'rdp'
+        self.assertIsNone(self.get_matched_acl())
+
+    def test_rematch_when_disabled(self):
+        self.assertEqual(self.get_matched_acl(), self.acl1)
+        self.update_acls([self.acl1], is_active=False)
+        self.assertEqual(self.get_matched_acl(), self.acl2)
+
+    def test_rematch_when_changed(self):
+        self.assertEqual(self.get_matched_acl(), self.acl1)
+        assets = dict(self.acl1.assets, ip_group=['10.0.1.0/24'])
+        self.update_acls([self.acl1], assets=assets)
+        self.assertEqual(self.get_matched_acl(), self.acl2)
+
+    def test_no_match_when_all_disabled(self):
+        self.assertEqual(self.get_matched_acl(), self.acl1)
+        self.update_acls([self.acl1, self.acl2], is_active=False)
+        self.assertIsNone(self.get_matched_acl())
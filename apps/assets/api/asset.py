@@ -3,7 +3,10 @@
 from assets.api import FilterAssetByNodeMixin
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.generics import RetrieveAPIView, ListAPIView
+from rest_framework.views import APIView
+from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.http import Http404
 from django.db.models import Q
 
 from common.utils import get_logger, get_object_or_none
@@ -21,7 +24,8 @@ from ..models import Asset, Node, Platform
 from .. import serializers
 from ..tasks import (
     update_assets_hardware_info_manual, test_assets_connectivity_manual,
-    test_system_users_connectivity_a_asset, push_system_users_a_asset
+    test_system_users_connectivity_a_asset, push_system_users_a_asset,
+    AssetsConnectivityProgress
 )
 from ..filters import FilterAssetByNodeFilterBackend, LabelFilterBackend, IpInFilterBackend
 
@@ -29,7 +33,7 @@ logger = get_logger(__file__)
 __all__ = [
     'AssetViewSet', 'AssetPlatformRetrieveApi',
     'AssetGatewayListApi', 'AssetPlatformViewSet',
-    'AssetTaskCreateApi', 'AssetsTaskCreateApi',
+    'AssetTaskCreateApi', 'AssetsTaskCreateApi', 'AssetsConnectivityProgressApi',
     'AssetPermUserListApi', 'AssetPermUserPermissionsListApi',
     'AssetPermUserGroupListApi', 'AssetPermUserGroupPermissionsListApi',
 ]
@@ -169,6 +173,19 @@ class AssetsTaskCreateApi(AssetsTaskMixin, generics.CreateAPIView):
     permission_classes = (IsOrgAdmin,)
 
 
+class AssetsConnectivityProgressApi(APIView):
+    """
+    可连接性测试的进度，pk 为创建测试任务时返回的任务 id
+    """
+    permission_classes = (IsOrgAdmin,)
+
+    def get(self, request, *args, **kwargs):
+        progress = AssetsConnectivityProgress(kwargs['pk']).get()
+        if progress is None:
+            raise Http404
+        return Response(progress)
+
+
 class AssetGatewayListApi(generics.ListAPIView):
     permission_classes = (IsOrgAdminOrAppUser,)
     serializer_class = serializers.GatewayWithAuthSerializer
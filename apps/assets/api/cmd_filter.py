@@ -1,21 +1,23 @@
 # -*- coding: utf-8 -*-
 #
 
+from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.generics import CreateAPIView
 from django.shortcuts import get_object_or_404
 
-from common.utils import reverse
+from common.utils import reverse, is_uuid
 from common.utils import lazyproperty
 from orgs.mixins.api import OrgBulkModelViewSet
 from tickets.api import GenericTicketStatusRetrieveCloseAPI
-from ..hands import IsOrgAdmin, IsAppUser
-from ..models import CommandFilter, CommandFilterRule
+from ..hands import IsOrgAdmin, IsAppUser, IsOrgAdminOrAppUser
+from ..models import CommandFilter, CommandFilterRule, CommandFilterRuleSet
 from .. import serializers
 
 __all__ = [
     'CommandFilterViewSet', 'CommandFilterRuleViewSet', 'CommandConfirmAPI',
-    'CommandConfirmStatusAPI'
+    'CommandConfirmStatusAPI', 'CommandFilterRuleSetApi',
 ]
 
 
@@ -42,6 +44,44 @@ class CommandFilterRuleViewSet(OrgBulkModelViewSet):
         return cmd_filter.rules.all()
 
 
+class CommandFilterRuleSetApi(APIView):
+    """
+    终端获取 (用户, 资产, 系统用户, 应用) 对应的规则，规则已经按匹配顺序排好;
+    带上 `If-None-Match: <version>`，规则没有变化时返回 304
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+    query_params_fields = ('user_id', 'user_group_id', 'system_user_id', 'asset_id', 'application_id')
+
+    def get(self, request, *args, **kwargs):
+        params = {}
+        for field in self.query_params_fields:
+            value = request.query_params.get(field)
+            if not value:
+                continue
+            if not is_uuid(value):
+                return Response({'error': f'{field} is not a valid uuid'}, status=status.HTTP_400_BAD_REQUEST)
+            params[field] = value
+
+        rule_set = CommandFilterRuleSet.get_rule_set(**params)
+        etag = '"{}"'.format(rule_set.version)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        rules = []
+        for rule in rule_set.rules:
+            rules.append({
+                'id': rule['id'],
+                'filter': rule['filter_id'],
+                'type': rule['type'],
+                'content': rule['content'],
+                'pattern': CommandFilterRule.get_pattern(rule['type'], rule['content']),
+                'priority': rule['priority'],
+                'action': rule['action'],
+            })
+        data = {'version': rule_set.version, 'rules': rules}
+        return Response(data, headers={'ETag': etag})
+
+
 class CommandConfirmAPI(CreateAPIView):
     permission_classes = (IsAppUser,)
     serializer_class = serializers.CommandConfirmSerializer
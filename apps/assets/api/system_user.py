@@ -1,18 +1,15 @@
 # ~*~ coding: utf-8 ~*~
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
-from django.db.models import Q
 
-from common.utils import get_logger, get_object_or_none
+from common.utils import get_logger, is_uuid
 from common.permissions import IsOrgAdmin, IsOrgAdminOrAppUser, IsValidUser
 from orgs.mixins.api import OrgBulkModelViewSet
 from orgs.mixins import generics
 from common.mixins.api import SuggestionMixin
 from orgs.utils import tmp_to_root_org
 from rest_framework.decorators import action
-from users.models import User, UserGroup
-from applications.models import Application
-from ..models import SystemUser, Asset, CommandFilter, CommandFilterRule
+from ..models import SystemUser, Asset, CommandFilterRule
 from .. import serializers
 from ..serializers import SystemUserWithAuthInfoSerializer, SystemUserTempAuthSerializer
 from ..tasks import (
@@ -196,42 +193,16 @@ class SystemUserCommandFilterRuleListApi(generics.ListAPIView):
         return CommandFilterRuleSerializer
 
     def get_queryset(self):
-        user_groups = []
-        user_id = self.request.query_params.get('user_id')
-        user = get_object_or_none(User, pk=user_id)
-        if user:
-            user_groups.extend(list(user.groups.all()))
-        user_group_id = self.request.query_params.get('user_group_id')
-        user_group = get_object_or_none(UserGroup, pk=user_group_id)
-        if user_group:
-            user_groups.append(user_group)
-        system_user_id = self.kwargs.get('pk', None)
-        system_user = get_object_or_none(SystemUser, pk=system_user_id)
-        if not system_user:
-            system_user_id = self.request.query_params.get('system_user_id')
-            system_user = get_object_or_none(SystemUser, pk=system_user_id)
-        asset_id = self.request.query_params.get('asset_id')
-        asset = get_object_or_none(Asset, pk=asset_id)
-        application_id = self.request.query_params.get('application_id')
-        application = get_object_or_none(Application, pk=application_id)
-        q = Q()
-        if user:
-            q |= Q(users=user)
-        if user_groups:
-            q |= Q(user_groups__in=set(user_groups))
-        if system_user:
-            q |= Q(system_users=system_user)
-        if asset:
-            q |= Q(assets=asset)
-        if application:
-            q |= Q(applications=application)
-        if q:
-            cmd_filters = CommandFilter.objects.filter(q).filter(is_active=True)
-            rule_ids = cmd_filters.values_list('rules', flat=True)
-            rules = CommandFilterRule.objects.filter(id__in=rule_ids)
-        else:
-            rules = CommandFilterRule.objects.none()
-        return rules
+        system_user_id = self.kwargs.get('pk', None) or self.request.query_params.get('system_user_id')
+        params = {
+            'user_id': self.request.query_params.get('user_id'),
+            'user_group_id': self.request.query_params.get('user_group_id'),
+            'system_user_id': system_user_id,
+            'asset_id': self.request.query_params.get('asset_id'),
+            'application_id': self.request.query_params.get('application_id'),
+        }
+        params = {k: v for k, v in params.items() if is_uuid(v)}
+        return CommandFilterRule.get_queryset(**params)
 
 
 class SystemUserAssetsListView(generics.ListAPIView):
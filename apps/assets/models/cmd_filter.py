@@ -2,8 +2,19 @@
 #
 import uuid
 import re
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 
 from django.db import models
+from django.db.models import Q
+from django.core.cache import cache
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils.translation import ugettext_lazy as _
 
@@ -14,7 +25,7 @@ logger = get_logger(__file__)
 
 
 __all__ = [
-    'CommandFilter', 'CommandFilterRule'
+    'CommandFilter', 'CommandFilterRule', 'CommandFilterRuleSet',
 ]
 
 
@@ -95,11 +106,19 @@ class CommandFilterRule(OrgModelMixin):
 
     @lazyproperty
     def pattern(self):
-        if self.type == 'command':
-            s = self.construct_command_regex(content=self.content)
-        else:
-            s = r'{0}'.format(self.content)
+        return self.get_pattern(self.type, self.content)
+
+    @lazyproperty
+    def compiled_pattern(self):
+        succeed, error, pattern = self.compile_regex(regex=self.pattern)
+        return pattern
 
+    @classmethod
+    def get_pattern(cls, tp, content):
+        if tp == cls.TYPE_COMMAND:
+            s = cls.construct_command_regex(content=content)
+        else:
+            s = r'{0}'.format(content)
         return s
 
     @classmethod
@@ -135,8 +154,8 @@ class CommandFilterRule(OrgModelMixin):
         return True, '', pattern
 
     def match(self, data):
-        succeed, error, pattern = self.compile_regex(regex=self.pattern)
-        if not succeed:
+        pattern = self.compiled_pattern
+        if pattern is None:
             return self.ACTION_UNKNOWN, ''
 
         found = pattern.search(data)
@@ -151,6 +170,39 @@ class CommandFilterRule(OrgModelMixin):
     def __str__(self):
         return '{} % {}'.format(self.type, self.content)
 
+    @classmethod
+    def get_queryset(cls, user_id=None, user_group_id=None, system_user_id=None,
+                     asset_id=None, application_id=None):
+        """
+        与 用户(及其用户组)、用户组、系统用户、资产、应用 任一关联的命令过滤器中的规则
+        """
+        from users.models import User
+
+        user_group_ids = set()
+        if user_id:
+            group_ids = User.groups.through.objects.filter(user_id=user_id) \
+                .values_list('usergroup_id', flat=True)
+            user_group_ids.update(group_ids)
+        if user_group_id:
+            user_group_ids.add(user_group_id)
+
+        q = Q()
+        if user_id:
+            q |= Q(users=user_id)
+        if user_group_ids:
+            q |= Q(user_groups__in=user_group_ids)
+        if system_user_id:
+            q |= Q(system_users=system_user_id)
+        if asset_id:
+            q |= Q(assets=asset_id)
+        if application_id:
+            q |= Q(applications=application_id)
+        if not q:
+            return cls.objects.none()
+        cmd_filters = CommandFilter.objects.filter(q).filter(is_active=True)
+        rule_ids = cmd_filters.values_list('rules', flat=True)
+        return cls.objects.filter(id__in=rule_ids)
+
     def create_command_confirm_ticket(self, run_command, session, cmd_filter_rule, org_id):
         from tickets.const import TicketType
         from tickets.models import Ticket
@@ -172,3 +224,223 @@ class CommandFilterRule(OrgModelMixin):
         ticket.create_process_map_and_node(self.reviewers.all())
         ticket.open(applicant=session.user_obj)
         return ticket
+
+
+class CommandFilterRuleSet:
+    """
+    编译好的一组命令过滤规则
+
+    规则按 优先级、动作 排序并预编译，同时从每个规则中提取出匹配时必须出现的字符串，
+    匹配时先一次性找出命令中出现了这些字符串的规则，只对它们(以及无法提取的规则)
+    按顺序执行正则，返回第一个匹配的规则
+    """
+    rule_fields = ('id', 'filter_id', 'type', 'content', 'priority', 'action')
+
+    version_cache_key = 'CMD_FILTER_RULES_VERSION'
+    rules_cache_key_template = 'CMD_FILTER_RULES_{version}_{org_id}_{user_id}_{user_group_id}_' \
+                               '{system_user_id}_{asset_id}_{application_id}'
+    rules_cache_timeout = 3600
+    # 进程中编译好的规则集 { version: CommandFilterRuleSet }
+    compiled_rule_sets = OrderedDict()
+    compiled_rule_sets_max_amount = 1000
+    compiled_rule_sets_lock = threading.Lock()
+
+    def __init__(self, rules):
+        """
+        :param rules: [{'id', 'filter_id', 'type', 'content', 'priority', 'action'}, ...]
+        """
+        self.rules = sorted(rules, key=lambda r: (r['priority'], r['action']))
+        self.version = self.get_rules_digest(self.rules)
+        # [(rule, compiled_pattern)]，正则有错误的规则不会匹配，直接跳过
+        self.compiled_rules = []
+        # 无法提取出必须出现的字符串的规则，每次都要匹配 [index, ...]
+        self.always_match_indexes = []
+        # 按字符串的前两个字符索引，匹配时只需检查命令中出现了前两个字符的字符串
+        # { (prefix, ignore_case): {literal: [index, ...]} }
+        self.literal_prefix_mapper = defaultdict(lambda: defaultdict(list))
+        # 只有一个字符的字符串 { (literal, ignore_case): [index, ...] }
+        self.short_literal_indexes_mapper = defaultdict(list)
+        self.compile()
+
+    @staticmethod
+    def get_rules_digest(rules):
+        md5 = hashlib.md5()
+        for rule in rules:
+            values = [str(rule[field]) for field in CommandFilterRuleSet.rule_fields]
+            md5.update('\0'.join(values).encode())
+            md5.update(b'\1')
+        return md5.hexdigest()
+
+    @classmethod
+    def get_required_literals(cls, pattern):
+        """
+        提取匹配时一定会出现的字符串
+        :return: {(literal, ignore_case)}，提取不到时返回 None
+        """
+        try:
+            parsed = sre_parse.parse(pattern)
+        except Exception:
+            return None
+        state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern', None)
+        flags = getattr(state, 'flags', 0)
+        if flags & re.LOCALE:
+            return None
+        ignore_case = bool(flags & re.IGNORECASE)
+        literals = cls._get_items_required_literals(parsed, ignore_case)
+        if not literals:
+            return None
+        return {(literal.lower() if ignore_case else literal, ignore_case) for literal in literals}
+
+    @classmethod
+    def _get_items_required_literals(cls, items, ignore_case):
+        """
+        优先取最长的连续字面量；没有时，如果有每个分支都能提取出字面量的分支结构，取所有分支的字面量
+        """
+        longest, current = '', ''
+        branches = []
+        for op, value in items:
+            if op is sre_constants.LITERAL:
+                current += chr(value)
+                continue
+            longest = max(longest, current, key=len)
+            current = ''
+            if op is sre_constants.BRANCH:
+                branches.append(value[1])
+        longest = max(longest, current, key=len)
+        # 忽略大小写时用 lower() 比较，只处理 ascii 字符
+        if longest and (not ignore_case or longest.isascii()):
+            return {longest}
+
+        for branch_items in branches:
+            literals = set()
+            for _items in branch_items:
+                _literals = cls._get_items_required_literals(_items, ignore_case)
+                if not _literals:
+                    break
+                literals.update(_literals)
+            else:
+                return literals
+        return None
+
+    def compile(self):
+        for rule in self.rules:
+            pattern = CommandFilterRule.get_pattern(rule['type'], rule['content'])
+            succeed, error, compiled = CommandFilterRule.compile_regex(pattern)
+            if not succeed:
+                continue
+            index = len(self.compiled_rules)
+            self.compiled_rules.append((rule, compiled))
+
+            literals = self.get_required_literals(pattern)
+            if not literals:
+                self.always_match_indexes.append(index)
+                continue
+            for literal, ignore_case in literals:
+                if len(literal) < 2:
+                    self.short_literal_indexes_mapper[(literal, ignore_case)].append(index)
+                else:
+                    self.literal_prefix_mapper[(literal[:2], ignore_case)][literal].append(index)
+
+    def get_candidate_indexes(self, command):
+        # 非 ascii 字符忽略大小写时的规则与 lower() 不完全相同，逐个规则匹配
+        if not command.isascii():
+            return range(len(self.compiled_rules))
+
+        indexes = set(self.always_match_indexes)
+        for ignore_case, text in ((True, command.lower()), (False, command)):
+            for i in range(len(text) - 1):
+                literal_indexes_mapper = self.literal_prefix_mapper.get((text[i:i + 2], ignore_case))
+                if not literal_indexes_mapper:
+                    continue
+                for literal, _indexes in literal_indexes_mapper.items():
+                    if text.startswith(literal, i):
+                        indexes.update(_indexes)
+            for char in set(text):
+                indexes.update(self.short_literal_indexes_mapper.get((char, ignore_case), ()))
+        return sorted(indexes)
+
+    def match(self, command):
+        """
+        :return: (rule, matched_command)，没有匹配的规则时返回 (None, '')
+        """
+        for index in self.get_candidate_indexes(command):
+            rule, compiled = self.compiled_rules[index]
+            found = compiled.search(command)
+            if found:
+                return rule, found.group()
+        return None, ''
+
+    def get_action(self, command):
+        """
+        与 `CommandFilterRule.match` 相同，除了允许都当作拒绝
+        """
+        rule, matched = self.match(command)
+        if rule is None:
+            return CommandFilterRule.ACTION_UNKNOWN, ''
+        if rule['action'] == CommandFilterRule.ActionChoices.allow:
+            return CommandFilterRule.ActionChoices.allow, matched
+        return CommandFilterRule.ActionChoices.deny, matched
+
+    @classmethod
+    def from_rules(cls, rules, version=None):
+        """
+        :param version: 规则的摘要，已知时传入，不用再计算
+        """
+        rules = list(rules)
+        if version is None:
+            version = cls.get_rules_digest(sorted(rules, key=lambda r: (r['priority'], r['action'])))
+        with cls.compiled_rule_sets_lock:
+            rule_set = cls.compiled_rule_sets.get(version)
+            if rule_set is not None:
+                cls.compiled_rule_sets.move_to_end(version)
+                return rule_set
+
+        rule_set = cls(rules)
+        with cls.compiled_rule_sets_lock:
+            cls.compiled_rule_sets[rule_set.version] = rule_set
+            while len(cls.compiled_rule_sets) > cls.compiled_rule_sets_max_amount:
+                cls.compiled_rule_sets.popitem(last=False)
+        return rule_set
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        rules = [
+            {field: str(value) if isinstance(value, uuid.UUID) else value
+             for field, value in zip(cls.rule_fields, row)}
+            for row in queryset.values_list(*cls.rule_fields)
+        ]
+        return cls.from_rules(rules)
+
+    @classmethod
+    def get_rules_version(cls):
+        return cache.get_or_set(cls.version_cache_key, uuid.uuid4().hex, None)
+
+    @classmethod
+    def expire_all(cls):
+        """ 命令过滤器、规则 或者 它们的关联关系变化时调用 """
+        cache.set(cls.version_cache_key, uuid.uuid4().hex, None)
+
+    @classmethod
+    def get_rule_set(cls, user_id=None, user_group_id=None, system_user_id=None,
+                     asset_id=None, application_id=None):
+        """
+        获取 (用户, 资产, 系统用户, 应用) 对应的规则集，规则会缓存到过滤器或规则变化为止
+        """
+        from orgs.utils import current_org
+
+        key = cls.rules_cache_key_template.format(
+            version=cls.get_rules_version(), org_id=current_org.id,
+            user_id=user_id, user_group_id=user_group_id, system_user_id=system_user_id,
+            asset_id=asset_id, application_id=application_id
+        )
+        data = cache.get(key)
+        if data is None:
+            queryset = CommandFilterRule.get_queryset(
+                user_id=user_id, user_group_id=user_group_id, system_user_id=system_user_id,
+                asset_id=asset_id, application_id=application_id
+            )
+            rule_set = cls.from_queryset(queryset)
+            data = {'version': rule_set.version, 'rules': rule_set.rules}
+            cache.set(key, data, cls.rules_cache_timeout)
+            return rule_set
+        return cls.from_rules(data['rules'], version=data['version'])
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 #
 import re
+import sys
 import time
 import uuid
+import array
+import struct
 import threading
 import os
 import time
 import uuid
 
-from collections import defaultdict
-from django.db import models, transaction
+from collections import defaultdict, Counter
+from django.db import models, transaction, connection
 from django.db.models import Q, Manager
 from django.db.utils import IntegrityError
 from django.utils.translation import ugettext_lazy as _
@@ -18,12 +21,17 @@ from django.db.transaction import atomic
 from django.core.cache import cache
 
 from common.utils.lock import DistributedLock
-from common.utils.common import timeit
-from common.db.models import output_as_string
+from common.utils.common import timeit, lazyproperty
+from common.db.models import output_as_string, replace_prefix
+from common.db.router import use_primary_db
 from common.utils import get_logger
+from common.utils.connection import get_redis_client
 from orgs.mixins.models import OrgModelMixin, OrgManager
 from orgs.utils import get_current_org, tmp_to_org, tmp_to_root_org
 from orgs.models import Organization
+from jumpserver.utils import get_current_request
+from jumpserver.const import CONFIG
+from ..signals import post_node_moved
 
 
 __all__ = ['Node', 'FamilyMixin', 'compute_parent_key', 'NodeQuerySet']
@@ -206,14 +214,12 @@ class FamilyMixin:
         if not self.is_node:
             self.key = parent.key + ':fake'
             return
-        children = self.get_all_children()
         old_key = self.key
         with transaction.atomic():
             self.key = parent.get_next_child_key()
+            # 后代节点的 key、parent_key、full_value 在 save 中一条 update 替换
             self.save()
-            for child in children:
-                child.key = child.key.replace(old_key, self.key, 1)
-                child.save()
+        post_node_moved.send(sender=self.__class__, instance=self, old_key=old_key)
 
     def get_siblings(self, with_self=False):
         key = ':'.join(self.key.split(':')[:-1])
@@ -255,12 +261,369 @@ class FamilyMixin:
         return [*tuple(ancestors), self, *tuple(children)]
 
 
+def node_key_sort_key(key):
+    return tuple(map(int, key.split(':')))
+
+
+class NodeAssetsMapping:
+    """
+    节点与其所有资产的紧凑映射
+
+    * 资产 id 被映射成整数，每个资产只存一份字符串
+    * 节点按 key 排序，这样一个节点及其后代节点是连续的一段 [index, end)
+    * 每个节点只记录直接资产，连续存放在一个整数数组里，节点的所有资产就是
+      数组中 [offsets[index], offsets[end]) 这一段，不再为每个祖先节点复制一份
+    * `version` 每次增量更新加一，用来判断各个进程内存中的映射是否落后
+    """
+    MAGIC = b'JNAM'
+    FORMAT_VERSION = 2
+    HEADER = struct.Struct('<4sBQIII')
+    ARRAY_TYPE = 'I'
+
+    ADD_ASSETS = 'add_assets'
+    REMOVE_ASSETS = 'remove_assets'
+    ADD_NODE = 'add_node'
+    REMOVE_NODE = 'remove_node'
+    MOVE_NODE = 'move_node'
+
+    def __init__(self, keys, ends, offsets, assets, asset_ids, version=0):
+        # 节点 key，已排序
+        self.keys = keys
+        # 节点 i 的后代节点范围是 (i, ends[i])
+        self.ends = ends
+        # 节点 i 的直接资产是 assets[offsets[i]:offsets[i+1]]
+        self.offsets = offsets
+        self.assets = assets
+        # 整数 -> 资产 id
+        self.asset_ids = asset_ids
+        self.version = version
+        self.key_index_mapper = {key: i for i, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_index_mapper
+
+    @lazyproperty
+    def asset_id_index_mapper(self):
+        return {asset_id: i for i, asset_id in enumerate(self.asset_ids)}
+
+    @classmethod
+    def build(cls, nodekey_assetsid_mapper, version=0):
+        """
+        :param nodekey_assetsid_mapper: 节点直接资产的映射 {"key1": set(), "key2": set()}
+        """
+        asset_id_index_mapper = {}
+        key_indexes_mapper = {}
+        for key, asset_ids in nodekey_assetsid_mapper.items():
+            key_indexes_mapper[key] = {
+                asset_id_index_mapper.setdefault(asset_id, len(asset_id_index_mapper))
+                for asset_id in asset_ids
+            }
+        asset_ids = list(asset_id_index_mapper.keys())
+        return cls._build(key_indexes_mapper, asset_ids, version)
+
+    @classmethod
+    def _build(cls, key_indexes_mapper, asset_ids, version):
+        keys = sorted(key_indexes_mapper.keys(), key=node_key_sort_key)
+        ends = array.array(cls.ARRAY_TYPE, [len(keys)]) * len(keys)
+        offsets = array.array(cls.ARRAY_TYPE, [0])
+        assets = array.array(cls.ARRAY_TYPE)
+
+        stack = []
+        for i, key in enumerate(keys):
+            while stack and not key.startswith(f'{keys[stack[-1]]}:'):
+                ends[stack.pop()] = i
+            stack.append(i)
+            assets.extend(sorted(key_indexes_mapper[key]))
+            offsets.append(len(assets))
+        return cls(keys, ends, offsets, assets, asset_ids, version)
+
+    def get_all_asset_indexes(self, key) -> set:
+        index = self.key_index_mapper.get(key)
+        if index is None:
+            return set()
+        start, end = self.offsets[index], self.offsets[self.ends[index]]
+        return set(self.assets[start:end])
+
+    def get_all_asset_ids(self, key) -> set:
+        asset_ids = self.asset_ids
+        return {asset_ids[i] for i in self.get_all_asset_indexes(key)}
+
+    def get_assets_amount(self, key) -> int:
+        return len(self.get_all_asset_indexes(key))
+
+    # 增量更新
+    # -------
+    def copy(self):
+        return self.__class__(
+            list(self.keys), array.array(self.ARRAY_TYPE, self.ends),
+            array.array(self.ARRAY_TYPE, self.offsets), array.array(self.ARRAY_TYPE, self.assets),
+            list(self.asset_ids), self.version
+        )
+
+    def patch(self, ops, version=None):
+        """
+        返回应用了 `ops` 后的新映射，原映射不变（其他线程可能正在读）
+
+        :param ops: [[action, *args], ...]
+            ['add_assets', node_key, [asset_id, ...]]
+            ['remove_assets', node_key, [asset_id, ...]]
+            ['add_node', node_key]
+            ['remove_node', node_key]
+            ['move_node', old_key, new_key]
+        """
+        structure_handlers = {
+            self.ADD_NODE: self._add_node,
+            self.REMOVE_NODE: self._remove_node,
+            self.MOVE_NODE: self._move_node,
+        }
+        mapping = self.copy()
+        for action, *args in ops:
+            if action == self.ADD_ASSETS:
+                if args[0] not in mapping:
+                    mapping = mapping._restructure(self._add_node, args[0])
+                mapping._add_assets(*args)
+            elif action == self.REMOVE_ASSETS:
+                mapping._remove_assets(*args)
+            elif action in structure_handlers:
+                mapping = mapping._restructure(structure_handlers[action], *args)
+            else:
+                raise ValueError(f'Invalid node assets mapping patch action: {action}')
+        mapping.version = self.version + 1 if version is None else version
+        return mapping
+
+    @classmethod
+    def merge_ops(cls, ops):
+        """
+        合并连续的资产增删，同一个节点的同一个资产以最后一次为准，
+        节点结构变化(增删、移动节点)保持原来的顺序
+        """
+        merged = []
+        # {node_key: {asset_id: action}}
+        asset_actions = {}
+
+        def _flush_asset_actions():
+            for key, actions in asset_actions.items():
+                for action in (cls.REMOVE_ASSETS, cls.ADD_ASSETS):
+                    asset_ids = [i for i, a in actions.items() if a == action]
+                    if asset_ids:
+                        merged.append([action, key, asset_ids])
+            asset_actions.clear()
+
+        for action, *args in ops:
+            if action in (cls.ADD_ASSETS, cls.REMOVE_ASSETS):
+                key, asset_ids = args
+                actions = asset_actions.setdefault(key, {})
+                for asset_id in asset_ids:
+                    actions[asset_id] = action
+            else:
+                _flush_asset_actions()
+                merged.append([action, *args])
+        _flush_asset_actions()
+        return merged
+
+    def _restructure(self, handler, *args):
+        # 节点结构变化，由直接资产重新组织，不需要查询数据库
+        key_indexes_mapper = self._get_key_indexes_mapper()
+        handler(key_indexes_mapper, *args)
+        return self._build(key_indexes_mapper, self.asset_ids, self.version)
+
+    def _get_key_indexes_mapper(self):
+        offsets = self.offsets
+        return {
+            key: set(self.assets[offsets[i]:offsets[i + 1]])
+            for i, key in enumerate(self.keys)
+        }
+
+    def _set_node_asset_indexes(self, index, indexes):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        self.assets[start:end] = array.array(self.ARRAY_TYPE, sorted(indexes))
+        diff = len(indexes) - (end - start)
+        if not diff:
+            return
+        offsets = self.offsets
+        for i in range(index + 1, len(offsets)):
+            offsets[i] += diff
+
+    def _add_assets(self, key, asset_ids):
+        index = self.key_index_mapper[key]
+        mapper = self.asset_id_index_mapper
+        indexes = set(self.assets[self.offsets[index]:self.offsets[index + 1]])
+        for asset_id in asset_ids:
+            if asset_id not in mapper:
+                mapper[asset_id] = len(self.asset_ids)
+                self.asset_ids.append(asset_id)
+            indexes.add(mapper[asset_id])
+        self._set_node_asset_indexes(index, indexes)
+
+    def _remove_assets(self, key, asset_ids):
+        index = self.key_index_mapper.get(key)
+        if index is None:
+            return
+        mapper = self.asset_id_index_mapper
+        indexes = set(self.assets[self.offsets[index]:self.offsets[index + 1]])
+        indexes -= {mapper[asset_id] for asset_id in asset_ids if asset_id in mapper}
+        self._set_node_asset_indexes(index, indexes)
+
+    @staticmethod
+    def _add_node(key_indexes_mapper, key):
+        key_indexes_mapper.setdefault(key, set())
+
+    @staticmethod
+    def _remove_node(key_indexes_mapper, key):
+        key_indexes_mapper.pop(key, None)
+
+    @staticmethod
+    def _move_node(key_indexes_mapper, old_key, new_key):
+        for key in list(key_indexes_mapper.keys()):
+            if key == old_key or key.startswith(f'{old_key}:'):
+                indexes = key_indexes_mapper.pop(key)
+                key_indexes_mapper[new_key + key[len(old_key):]] = indexes
+
+    # 序列化
+    # -----
+    @classmethod
+    def _array_to_bytes(cls, arr):
+        if sys.byteorder != 'little':
+            arr = array.array(cls.ARRAY_TYPE, arr)
+            arr.byteswap()
+        return arr.tobytes()
+
+    @classmethod
+    def _array_from_bytes(cls, data):
+        arr = array.array(cls.ARRAY_TYPE)
+        arr.frombytes(data)
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        return arr
+
+    def to_bytes(self) -> bytes:
+        keys = '\n'.join(self.keys).encode()
+        asset_ids = '\n'.join(self.asset_ids).encode()
+        header = self.HEADER.pack(
+            self.MAGIC, self.FORMAT_VERSION, self.version,
+            len(self.keys), len(self.assets), len(keys)
+        )
+        return b''.join([
+            header, keys,
+            self._array_to_bytes(self.ends),
+            self._array_to_bytes(self.offsets),
+            self._array_to_bytes(self.assets),
+            asset_ids,
+        ])
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        magic, format_version, version, keys_amount, assets_amount, keys_length = \
+            cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or format_version != cls.FORMAT_VERSION:
+            raise ValueError(f'Invalid node assets mapping data: magic={magic} format={format_version}')
+
+        item_size = array.array(cls.ARRAY_TYPE).itemsize
+        sizes = [
+            keys_length,
+            keys_amount * item_size,
+            (keys_amount + 1) * item_size,
+            assets_amount * item_size,
+        ]
+        sections = []
+        pos = cls.HEADER.size
+        for size in sizes:
+            sections.append(data[pos:pos + size])
+            pos += size
+        keys_data, ends_data, offsets_data, assets_data = sections
+        asset_ids_data = data[pos:]
+
+        keys = keys_data.decode().split('\n') if keys_data else []
+        asset_ids = asset_ids_data.decode().split('\n') if asset_ids_data else []
+        return cls(
+            keys,
+            cls._array_from_bytes(ends_data),
+            cls._array_from_bytes(offsets_data),
+            cls._array_from_bytes(assets_data),
+            asset_ids, version
+        )
+
+
+class NodeAssetsMappingMetrics:
+    """
+    节点资产映射的命中统计，各进程先在内存中计数，定期累加到 redis 中，
+    Prometheus 接口读取的是所有进程的汇总
+    """
+    cache_key = 'assets.node_all_asset_ids_mapping.metrics'
+    events = ('hit', 'miss', 'stale', 'regenerate')
+    flush_interval = 10
+
+    def __init__(self):
+        self._counter = Counter()
+        self._lock = threading.Lock()
+        self._last_flush_time = time.time()
+
+    @property
+    def client(self):
+        return get_redis_client(CONFIG.REDIS_DB_CACHE)
+
+    def incr(self, org_id, event):
+        with self._lock:
+            self._counter[(str(org_id), event)] += 1
+            need_flush = time.time() - self._last_flush_time > self.flush_interval
+        if need_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counter, self._counter = self._counter, Counter()
+            self._last_flush_time = time.time()
+        if not counter:
+            return
+        try:
+            with self.client.pipeline(transaction=False) as p:
+                for (org_id, event), amount in counter.items():
+                    p.hincrby(self.cache_key, f'{org_id}:{event}', amount)
+                p.execute()
+        except Exception as e:
+            logger.error(f'Flush node asset mapping metrics error: {e}')
+
+    def get_metrics(self):
+        """
+        :return: {(org_id, event): amount}
+        """
+        metrics = {}
+        for field, amount in self.client.hgetall(self.cache_key).items():
+            field = field.decode() if isinstance(field, bytes) else field
+            org_id, event = field.rsplit(':', 1)
+            metrics[(org_id, event)] = int(amount)
+        return metrics
+
+    def get_prometheus_metrics_text(self):
+        self.flush()
+        prometheus_metrics = [
+            '## 节点资产映射',
+            '# HELP jumpserver_node_assets_mapping_total Node assets mapping load events',
+            '# TYPE jumpserver_node_assets_mapping_total counter',
+        ]
+        for (org_id, event), amount in sorted(self.get_metrics().items()):
+            prometheus_metrics.append(
+                f'jumpserver_node_assets_mapping_total{{org_id="{org_id}", event="{event}"}} {amount}'
+            )
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+node_assets_mapping_metrics = NodeAssetsMappingMetrics()
+
+
 class NodeAllAssetsMappingMixin:
     # Use a new plan
 
-    # { org_id: { node_key: [ asset1_id, asset2_id ] } }
+    # { org_id: NodeAssetsMapping }
     orgid_nodekey_assetsid_mapping = defaultdict(dict)
     locks_for_get_mapping_from_cache = defaultdict(threading.Lock)
+    # 请求之外检查版本号的时间 { org_id: timestamp }
+    orgid_version_checked_time = {}
+    version_check_interval = 1
 
     @classmethod
     def get_lock(cls, org_id):
@@ -270,8 +633,10 @@ class NodeAllAssetsMappingMixin:
     @classmethod
     def get_node_all_asset_ids_mapping(cls, org_id):
         _mapping = cls.get_node_all_asset_ids_mapping_from_memory(org_id)
-        if _mapping:
+        if _mapping and not cls.is_node_all_asset_ids_mapping_in_memory_stale(org_id, _mapping):
+            node_assets_mapping_metrics.incr(org_id, 'hit')
             return _mapping
+        node_assets_mapping_metrics.incr(org_id, 'miss')
 
         logger.debug(f'Get node asset mapping from memory failed, acquire thread lock: '
                      f'thread={threading.get_ident()} '
@@ -291,6 +656,43 @@ class NodeAllAssetsMappingMixin:
             cls.set_node_all_asset_ids_mapping_to_memory(org_id, mapping=_mapping)
         return _mapping
 
+    @classmethod
+    def is_node_all_asset_ids_mapping_in_memory_stale(cls, org_id, mapping):
+        """
+        订阅的消息可能会丢失，这里对比 redis 中的版本号兜底，
+        同一个请求中每个组织只检查一次，请求之外(celery 等)每个组织每秒最多检查一次
+        """
+        org_id = str(org_id)
+        request = get_current_request()
+        if request is not None:
+            checked_org_ids = getattr(request, '_node_assets_mapping_checked_org_ids', None)
+            if checked_org_ids is None:
+                checked_org_ids = set()
+                setattr(request, '_node_assets_mapping_checked_org_ids', checked_org_ids)
+            if org_id in checked_org_ids:
+                return False
+            checked_org_ids.add(org_id)
+        else:
+            now = time.time()
+            if now - cls.orgid_version_checked_time.get(org_id, 0) < cls.version_check_interval:
+                return False
+            cls.orgid_version_checked_time[org_id] = now
+
+        version = cls.get_node_all_asset_ids_mapping_version(org_id)
+        # 内存中的版本比 redis 中的还大，说明 redis 数据被清空过，同样视为过期
+        if mapping.version == version:
+            return False
+
+        logger.info(f'Node asset mapping in memory is stale, expire it: org_id={org_id} '
+                    f'memory_version={mapping.version} version={version}')
+        node_assets_mapping_metrics.incr(org_id, 'stale')
+        with cls.get_lock(org_id):
+            _mapping = cls.get_node_all_asset_ids_mapping_from_memory(org_id)
+            # 可能已经被其他线程更新过了
+            if _mapping is mapping:
+                cls.expire_node_all_asset_ids_mapping_from_memory(org_id)
+        return True
+
     # from memory
     @classmethod
     def get_node_all_asset_ids_mapping_from_memory(cls, org_id):
@@ -306,6 +708,28 @@ class NodeAllAssetsMappingMixin:
         org_id = str(org_id)
         cls.orgid_nodekey_assetsid_mapping.pop(org_id, None)
 
+    @classmethod
+    def patch_node_all_asset_ids_mapping_in_memory(cls, org_id, version, ops):
+        """
+        版本连续的才增量更新，否则说明错过了更新，清除掉，下次使用时重新获取
+        """
+        org_id = str(org_id)
+        # 与加载映射使用同一把锁，避免加载到旧版本覆盖掉更新
+        with cls.get_lock(org_id):
+            mapping = cls.get_node_all_asset_ids_mapping_from_memory(org_id)
+            if not mapping:
+                return
+            if ops is not None and version is not None:
+                if mapping.version >= version:
+                    return
+                if mapping.version == version - 1:
+                    mapping = mapping.patch(ops, version)
+                    cls.set_node_all_asset_ids_mapping_to_memory(org_id, mapping)
+                    return
+            logger.info(f'Node asset mapping in memory is behind, expire it: org_id={org_id} '
+                        f'memory_version={mapping.version} version={version}')
+            cls.expire_node_all_asset_ids_mapping_from_memory(org_id)
+
     @classmethod
     def expire_all_orgs_node_all_asset_ids_mapping_from_memory(cls):
         orgs = Organization.objects.all()
@@ -322,7 +746,7 @@ class NodeAllAssetsMappingMixin:
         if mapping:
             return mapping
 
-        lock_key = f'KEY_LOCK_GENERATE_ORG_{org_id}_NODE_ALL_ASSET_ids_MAPPING'
+        lock_key = cls._get_lock_key_for_node_all_asset_ids_mapping(org_id)
         with DistributedLock(lock_key):
             # 这里使用无限期锁，原因是如果这里卡住了，就卡在数据库了，说明
             # 数据库繁忙，所以不应该再有线程执行这个操作，使数据库忙上加忙
@@ -331,14 +755,57 @@ class NodeAllAssetsMappingMixin:
             if _mapping:
                 return _mapping
 
-            _mapping = cls.generate_node_all_asset_ids_mapping(org_id)
-            cls.set_node_all_asset_ids_mapping_to_cache(org_id=org_id, mapping=_mapping)
+            version = cls.get_node_all_asset_ids_mapping_version(org_id)
+            with use_primary_db():
+                _mapping = cls.generate_node_all_asset_ids_mapping(org_id)
+            node_assets_mapping_metrics.incr(org_id, 'regenerate')
+            _mapping.version = version
+            # 生成期间又有变化，生成的可能已经是旧的了，不放到缓存
+            if version == cls.get_node_all_asset_ids_mapping_version(org_id):
+                cls.set_node_all_asset_ids_mapping_to_cache(org_id=org_id, mapping=_mapping)
             return _mapping
 
+    @classmethod
+    def patch_node_all_asset_ids_mapping_in_cache(cls, org_id, ops):
+        """
+        增量更新缓存中的映射，返回新的版本号
+        """
+        lock_key = cls._get_lock_key_for_node_all_asset_ids_mapping(org_id)
+        with DistributedLock(lock_key):
+            version = cls.incr_node_all_asset_ids_mapping_version(org_id)
+            mapping = cls.get_node_all_asset_ids_mapping_from_cache(org_id)
+            if mapping is None:
+                return version
+            if mapping.version != version - 1:
+                logger.info(f'Node asset mapping in cache is behind, expire it: org_id={org_id} '
+                            f'cache_version={mapping.version} version={version}')
+                cls.delete_node_all_asset_ids_mapping_from_cache(org_id)
+                return version
+            mapping = mapping.patch(ops, version)
+            cls.set_node_all_asset_ids_mapping_to_cache(org_id, mapping)
+            return version
+
+    @classmethod
+    def get_node_all_asset_ids_mapping_version(cls, org_id):
+        cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping_version(org_id)
+        return cache.get(cache_key) or 0
+
+    @classmethod
+    def incr_node_all_asset_ids_mapping_version(cls, org_id):
+        cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping_version(org_id)
+        cache.add(cache_key, 0, timeout=None)
+        return cache.incr(cache_key)
+
     @classmethod
     def get_node_all_asset_ids_mapping_from_cache(cls, org_id):
         cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping(org_id)
-        mapping = cache.get(cache_key)
+        data = cache.get(cache_key)
+        mapping = None
+        if data:
+            try:
+                mapping = NodeAssetsMapping.from_bytes(data)
+            except (ValueError, struct.error) as e:
+                logger.error(f'Load node asset mapping from cache error: org_id={org_id} {e}')
         logger.info(f'Get node asset mapping from cache {bool(mapping)}: '
                     f'thread={threading.get_ident()} '
                     f'org_id={org_id}')
@@ -347,16 +814,43 @@ class NodeAllAssetsMappingMixin:
     @classmethod
     def set_node_all_asset_ids_mapping_to_cache(cls, org_id, mapping):
         cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping(org_id)
-        cache.set(cache_key, mapping, timeout=None)
+        cache.set(cache_key, mapping.to_bytes(), timeout=None)
 
     @classmethod
-    def expire_node_all_asset_ids_mapping_from_cache(cls, org_id):
+    def delete_node_all_asset_ids_mapping_from_cache(cls, org_id):
         cache_key = cls._get_cache_key_for_node_all_asset_ids_mapping(org_id)
         cache.delete(cache_key)
 
+    @classmethod
+    def expire_node_all_asset_ids_mapping_from_cache(cls, org_id):
+        """
+        版本号加一，各进程内存中的映射收到新版本号后发现不连续，也会清除，返回新的版本号
+        """
+        version = cls.incr_node_all_asset_ids_mapping_version(org_id)
+        cls.delete_node_all_asset_ids_mapping_from_cache(org_id)
+        return version
+
     @staticmethod
     def _get_cache_key_for_node_all_asset_ids_mapping(org_id):
-        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_MAPPING_{}'.format(org_id)
+        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_MAPPING_V2_{}'.format(org_id)
+
+    @staticmethod
+    def _get_cache_key_for_node_all_asset_ids_mapping_version(org_id):
+        return 'ASSETS_ORG_NODE_ALL_ASSET_ids_MAPPING_VERSION_{}'.format(org_id)
+
+    @staticmethod
+    def _get_lock_key_for_node_all_asset_ids_mapping(org_id):
+        return f'KEY_LOCK_GENERATE_ORG_{org_id}_NODE_ALL_ASSET_ids_MAPPING'
+
+    @staticmethod
+    def convert_id_to_mapping_str(pk):
+        """
+        映射中的 id 是数据库转换的字符串(`output_as_string`)，这里保持一致
+        """
+        pk = pk if isinstance(pk, uuid.UUID) else uuid.UUID(str(pk))
+        if connection.features.has_native_uuid_field:
+            return str(pk)
+        return pk.hex
 
     @classmethod
     def generate_node_all_asset_ids_mapping(cls, org_id):
@@ -377,23 +871,17 @@ class NodeAllAssetsMappingMixin:
                 .annotate(char_asset_id=output_as_string('asset_id')) \
                 .values_list('char_node_id', 'char_asset_id')
 
-            node_id_ancestor_keys_mapping = {
-                node_id: cls.get_node_ancestor_keys(node_key, with_self=True)
-                for node_id, node_key in node_ids_key
-            }
-
             nodeid_assetsid_mapping = defaultdict(set)
             for node_id, asset_id in nodes_asset_ids:
                 nodeid_assetsid_mapping[node_id].add(asset_id)
 
         t2 = time.time()
 
-        mapping = defaultdict(set)
-        for node_id, node_key in node_ids_key:
-            asset_ids = nodeid_assetsid_mapping[node_id]
-            node_ancestor_keys = node_id_ancestor_keys_mapping[node_id]
-            for ancestor_key in node_ancestor_keys:
-                mapping[ancestor_key].update(asset_ids)
+        nodekey_assetsid_mapping = {
+            node_key: nodeid_assetsid_mapping[node_id]
+            for node_id, node_key in node_ids_key
+        }
+        mapping = NodeAssetsMapping.build(nodekey_assetsid_mapping)
 
         t3 = time.time()
         logger.info('t1-t2(DB Query): {} s, t3-t2(Generate mapping): {} s'.format(t2-t1, t3-t2))
@@ -462,9 +950,8 @@ class NodeAssetsMixin(NodeAllAssetsMappingMixin):
     @classmethod
     def get_all_asset_ids_by_node_key(cls, org_id, node_key):
         org_id = str(org_id)
-        nodekey_assetsid_mapping = cls.get_node_all_asset_ids_mapping(org_id)
-        asset_ids = nodekey_assetsid_mapping.get(node_key, [])
-        return set(asset_ids)
+        mapping = cls.get_node_all_asset_ids_mapping(org_id)
+        return mapping.get_all_asset_ids(node_key)
 
 
 class SomeNodesMixin:
@@ -554,6 +1041,8 @@ class Node(OrgModelMixin, SomeNodesMixin, FamilyMixin, NodeAssetsMixin):
     objects = OrgManager.from_queryset(NodeQuerySet)()
     is_node = True
     _parents = None
+    # 这些字段变化时，自己和后代节点的 full_value 都要更新
+    family_fields = ('key', 'value')
 
     class Meta:
         verbose_name = _("Node")
@@ -649,8 +1138,67 @@ class Node(OrgModelMixin, SomeNodesMixin, FamilyMixin, NodeAssetsMixin):
             node.full_value = parent.full_value + '/' + node.value
         self.__class__.objects.bulk_update(nodes, ['full_value'])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.mark_family_values_saved()
+        return instance
+
+    def mark_family_values_saved(self, update_fields=None):
+        # 记录数据库中的值，save 时判断 key、value 是否变化
+        saved = getattr(self, '_saved_family_values', None) or {}
+        for field in self.family_fields + ('full_value',):
+            if update_fields is not None and field not in update_fields:
+                continue
+            if field in self.__dict__:
+                saved[field] = self.__dict__[field]
+        self._saved_family_values = saved
+
+    def get_changed_family_fields(self, update_fields=None):
+        saved = getattr(self, '_saved_family_values', None) or {}
+        changed = set()
+        for field in self.family_fields:
+            if update_fields is not None and field not in update_fields:
+                continue
+            # 延迟加载并且没有赋值的字段不会被保存
+            if field not in self.__dict__:
+                continue
+            if field not in saved or saved[field] != self.__dict__[field]:
+                changed.add(field)
+        return changed
+
+    def update_descendants_family_values(self, old_key, old_full_value):
+        """ 一条 update 替换后代节点 key、parent_key、full_value 的前缀 """
+        if old_key is None or old_full_value is None:
+            self.update_child_full_value()
+            return
+        values = {}
+        if old_full_value != self.full_value:
+            values['full_value'] = replace_prefix('full_value', old_full_value, self.full_value)
+        if old_key != self.key:
+            values['key'] = replace_prefix('key', old_key, self.key)
+            values['parent_key'] = replace_prefix('parent_key', old_key, self.key)
+        if not values:
+            return
+        Node.objects.filter(key__startswith=f'{old_key}:').update(**values)
+
     def save(self, *args, **kwargs):
-        self.full_value = self.computed_full_value()
+        """
+        只有 key、value 变化时才重新计算 full_value 并更新后代节点，
+        get_next_child_key、资产数量等其它字段的保存不再扫描整棵子树
+        """
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        changed = self.get_changed_family_fields(update_fields)
+        saved = getattr(self, '_saved_family_values', None) or {}
+
+        if adding or changed:
+            self.full_value = self.computed_full_value()
+            if update_fields is not None:
+                # parent_key 在 pre_save 中根据 key 计算
+                kwargs['update_fields'] = {*update_fields, 'full_value', 'parent_key'}
         instance = super().save(*args, **kwargs)
-        self.update_child_full_value()
+        if changed and not adding:
+            self.update_descendants_family_values(saved.get('key'), saved.get('full_value'))
+        self.mark_family_values_saved(kwargs.get('update_fields'))
         return instance
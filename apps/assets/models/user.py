@@ -264,12 +264,13 @@ class SystemUser(ProtocolMixin, AuthMixin, BaseUser):
         return rules
 
     def is_command_can_run(self, command):
-        for rule in self.cmd_filter_rules:
-            action, matched_cmd = rule.match(command)
-            if action == rule.ActionChoices.allow:
-                return True, None
-            elif action == rule.ActionChoices.deny:
-                return False, matched_cmd
+        from .cmd_filter import CommandFilterRule, CommandFilterRuleSet
+        rule_set = CommandFilterRuleSet.from_queryset(self.cmd_filter_rules)
+        action, matched_cmd = rule_set.get_action(command)
+        if action == CommandFilterRule.ActionChoices.allow:
+            return True, None
+        elif action == CommandFilterRule.ActionChoices.deny:
+            return False, matched_cmd
         return True, None
 
     def get_all_assets(self):
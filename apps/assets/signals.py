@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+#
+from django.dispatch import Signal
+
+post_node_moved = Signal(providing_args=('instance', 'old_key'))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
+from common.utils import get_logger
+from common.decorator import on_transaction_commit
+from assets.models import CommandFilter, CommandFilterRule, CommandFilterRuleSet
+from users.models import User, UserGroup
+
+logger = get_logger(__file__)
+
+
+@on_transaction_commit
+def expire_cmd_filter_rule_sets():
+    logger.debug('Command filter rules changed, expire rule sets')
+    CommandFilterRuleSet.expire_all()
+
+
+@receiver([post_save, post_delete], sender=CommandFilter)
+@receiver([post_save, post_delete], sender=CommandFilterRule)
+def on_cmd_filter_change(sender, **kwargs):
+    expire_cmd_filter_rule_sets()
+
+
+@receiver(m2m_changed, sender=CommandFilter.users.through)
+@receiver(m2m_changed, sender=CommandFilter.user_groups.through)
+@receiver(m2m_changed, sender=CommandFilter.assets.through)
+@receiver(m2m_changed, sender=CommandFilter.system_users.through)
+@receiver(m2m_changed, sender=CommandFilter.applications.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def on_cmd_filter_relations_change(sender, action, **kwargs):
+    # 用户的用户组变化，用户关联的命令过滤器也会变化
+    if action not in (POST_ADD, POST_REMOVE, POST_CLEAR):
+        return
+    expire_cmd_filter_rule_sets()
+
+
+@receiver(pre_delete, sender=UserGroup)
+def on_user_group_delete(sender, instance, **kwargs):
+    # 删除用户组时级联删除的关联关系不会发送 m2m_changed，组内用户的规则集也会变化
+    through = CommandFilter.user_groups.through
+    if not through.objects.filter(usergroup_id=instance.id).exists():
+        return
+    expire_cmd_filter_rule_sets()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 from operator import add, sub
+from django.conf import settings
 from django.db.models import Q, F
 from django.dispatch import receiver
 from django.db.models.signals import (
@@ -8,10 +9,11 @@ from django.db.models.signals import (
 )
 
 from orgs.utils import ensure_in_real_or_default_org, tmp_to_org
-from common.const.signals import PRE_ADD, POST_REMOVE, PRE_CLEAR
+from common.const.signals import PRE_ADD, POST_ADD, POST_REMOVE, PRE_CLEAR
 from common.utils import get_logger
 from assets.models import Asset, Node, compute_parent_key
 from assets.locks import NodeTreeUpdateLock
+from assets.utils import NodeAssetsAmountDeferredUpdater
 
 
 logger = get_logger(__file__)
@@ -25,6 +27,10 @@ def on_node_asset_change(sender, action, instance, reverse, pk_set, **kwargs):
     if action in refused:
         raise ValueError
 
+    if settings.NODE_ASSETS_AMOUNT_DEFERRED_UPDATE:
+        on_node_asset_change_deferred(action, instance, reverse, pk_set)
+        return
+
     mapper = {
         PRE_ADD: add,
         POST_REMOVE: sub
@@ -46,6 +52,18 @@ def on_node_asset_change(sender, action, instance, reverse, pk_set, **kwargs):
             NodeAssetsAmountUtils.update_nodes_asset_amount(node_keys, asset_pk, operator)
 
 
+def on_node_asset_change_deferred(action, instance, reverse, pk_set):
+    # 关系已经变化，提交后根据映射重新计算，只需要记录哪些节点变化了
+    if action not in (POST_ADD, POST_REMOVE) or not pk_set:
+        return
+    if reverse:
+        node_keys = [instance.key]
+    else:
+        with tmp_to_org(instance.org):
+            node_keys = list(Node.objects.filter(id__in=pk_set).values_list('key', flat=True))
+    NodeAssetsAmountDeferredUpdater.add_changed_node_keys(instance.org_id, node_keys)
+
+
 class NodeAssetsAmountUtils:
 
     @classmethod
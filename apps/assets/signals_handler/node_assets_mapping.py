@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import time
 import threading
 
 from django.db.models.signals import (
     m2m_changed, post_save, post_delete
 )
+from django.db import transaction
 from django.dispatch import receiver
 from django.utils.functional import LazyObject
 
 from common.signals import django_ready
 from common.utils.connection import RedisPubSub
 from common.utils import get_logger
+from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
 from assets.models import Asset, Node
+from assets.models.node import NodeAssetsMapping
+from assets.signals import post_node_moved
 from orgs.models import Organization
+from orgs.utils import tmp_to_org
 
 
 logger = get_logger(__file__)
@@ -40,46 +46,182 @@ def expire_node_assets_mapping_for_memory(org_id):
     root_org_id = Organization.ROOT_ID
 
     # 当前进程清除(cache 数据)
-    Node.expire_node_all_asset_ids_mapping_from_cache(org_id)
+    version = Node.expire_node_all_asset_ids_mapping_from_cache(org_id)
     Node.expire_node_all_asset_ids_mapping_from_cache(root_org_id)
 
-    node_assets_mapping_for_memory_pub_sub.publish(org_id)
+    node_assets_mapping_for_memory_pub_sub.publish({
+        'org_id': org_id, 'version': version, 'ops': None
+    })
+
+
+def patch_node_assets_mapping_now(org_id, ops):
+    """
+    增量更新缓存和所有进程内存中的映射，各进程根据版本号判断能否增量更新
+    """
+    org_id = str(org_id)
+    root_org_id = Organization.ROOT_ID
+
+    version = Node.patch_node_all_asset_ids_mapping_in_cache(org_id, ops)
+    # root 组织包含所有组织的节点，还是直接清除
+    Node.expire_node_all_asset_ids_mapping_from_cache(root_org_id)
+
+    node_assets_mapping_for_memory_pub_sub.publish({
+        'org_id': org_id, 'version': version, 'ops': ops
+    })
+
+
+class _FlushCallback:
+    def __init__(self, func):
+        self.func = func
+        self.cancelled = False
+
+    def __call__(self):
+        if not self.cancelled:
+            self.func()
+
+
+class NodeAssetsMappingPatcher:
+    """
+    一个事务中节点资产的变化合并成一次更新，批量导入时不用每个变化都加锁读取、更新、序列化整个映射:
+
+    * 每个变化用 `on_commit` 记录，savepoint 回滚时随之丢弃
+    * 所有变化记录之后再更新一次缓存、通知其他进程；更新的回调每次都移到最后，
+      不属于任何 savepoint，只有整个事务回滚时才丢弃
+    * 变化的资产太多时增量更新不划算，直接清除
+    """
+    max_patch_amount = 5000
+
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def pending(self):
+        # { org_id: ops }, ops 为 None 表示要清除
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = {}
+        return self.local.pending
+
+    def patch(self, org_id, ops):
+        self.add(org_id, ops)
+
+    def expire(self, org_id):
+        self.add(org_id, None)
+
+    def add(self, org_id, ops):
+        org_id = str(org_id)
+        conn = transaction.get_connection()
+        if not conn.in_atomic_block:
+            self.record(org_id, ops)
+            self.flush()
+            return
+        transaction.on_commit(lambda: self.record(org_id, ops))
+        self.schedule_flush(conn)
+
+    def schedule_flush(self, conn):
+        last_callback = getattr(self.local, 'flush_callback', None)
+        if last_callback is not None:
+            last_callback.cancelled = True
+        callback = _FlushCallback(self.flush)
+        self.local.flush_callback = callback
+        conn.run_on_commit.append((set(), callback))
+
+    def record(self, org_id, ops):
+        pending = self.pending
+        if org_id in pending and pending[org_id] is None:
+            return
+        if ops is None:
+            pending[org_id] = None
+            return
+        pending.setdefault(org_id, []).extend(ops)
+
+    def get_ops_amount(self, ops):
+        amount = 0
+        for action, *args in ops:
+            if action in (NodeAssetsMapping.ADD_ASSETS, NodeAssetsMapping.REMOVE_ASSETS):
+                amount += len(args[1])
+            else:
+                amount += 1
+        return amount
+
+    def flush(self):
+        pending, self.local.pending = self.pending, {}
+        self.local.flush_callback = None
+        for org_id, ops in pending.items():
+            if ops is not None:
+                ops = NodeAssetsMapping.merge_ops(ops)
+            if ops is None or self.get_ops_amount(ops) > self.max_patch_amount:
+                expire_node_assets_mapping_for_memory(org_id)
+            elif ops:
+                patch_node_assets_mapping_now(org_id, ops)
+
+
+node_assets_mapping_patcher = NodeAssetsMappingPatcher()
 
 
 @receiver(post_save, sender=Node)
 def on_node_post_create(sender, instance, created, update_fields, **kwargs):
     if created:
-        need_expire = True
+        node_assets_mapping_patcher.patch(instance.org_id, [[NodeAssetsMapping.ADD_NODE, instance.key]])
     elif update_fields and 'key' in update_fields:
-        need_expire = True
-    else:
-        need_expire = False
-
-    if need_expire:
-        expire_node_assets_mapping_for_memory(instance.org_id)
+        # 不知道原来的 key，只能全部清除
+        node_assets_mapping_patcher.expire(instance.org_id)
 
 
 @receiver(post_delete, sender=Node)
 def on_node_post_delete(sender, instance, **kwargs):
-    expire_node_assets_mapping_for_memory(instance.org_id)
+    node_assets_mapping_patcher.patch(instance.org_id, [[NodeAssetsMapping.REMOVE_NODE, instance.key]])
+
+
+@receiver(post_node_moved, sender=Node)
+def on_node_moved(sender, instance, old_key, **kwargs):
+    node_assets_mapping_patcher.patch(instance.org_id, [[NodeAssetsMapping.MOVE_NODE, old_key, instance.key]])
 
 
 @receiver(m2m_changed, sender=Asset.nodes.through)
-def on_node_asset_change(sender, instance, **kwargs):
-    expire_node_assets_mapping_for_memory(instance.org_id)
+def on_node_asset_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == POST_CLEAR:
+        # `post_clear` 没有 `pk_set`
+        node_assets_mapping_patcher.expire(instance.org_id)
+        return
+
+    mapper = {
+        POST_ADD: NodeAssetsMapping.ADD_ASSETS,
+        POST_REMOVE: NodeAssetsMapping.REMOVE_ASSETS,
+    }
+    if action not in mapper or not pk_set:
+        return
+    patch_action = mapper[action]
+
+    if reverse:
+        asset_ids = [Node.convert_id_to_mapping_str(pk) for pk in pk_set]
+        ops = [[patch_action, instance.key, asset_ids]]
+    else:
+        asset_id = Node.convert_id_to_mapping_str(instance.id)
+        with tmp_to_org(instance.org):
+            node_keys = Node.objects.filter(id__in=pk_set).values_list('key', flat=True)
+            ops = [[patch_action, key, [asset_id]] for key in node_keys]
+    node_assets_mapping_patcher.patch(instance.org_id, ops)
 
 
 @receiver(django_ready)
 def subscribe_node_assets_mapping_expire(sender, **kwargs):
     logger.debug("Start subscribe for expire node assets id mapping from memory")
 
-    def handle_node_relation_change(org_id):
+    def handle_node_relation_change(data):
         root_org_id = Organization.ROOT_ID
-        Node.expire_node_all_asset_ids_mapping_from_memory(org_id)
+        if isinstance(data, dict):
+            org_id, version, ops = data['org_id'], data.get('version'), data.get('ops')
+        else:
+            org_id, version, ops = data, None, None
+        Node.patch_node_all_asset_ids_mapping_in_memory(org_id, version, ops)
         Node.expire_node_all_asset_ids_mapping_from_memory(root_org_id)
 
     def keep_subscribe_node_assets_relation():
-        node_assets_mapping_for_memory_pub_sub.keep_handle_msg(handle_node_relation_change)
+        # 连接断开后重新订阅，断开期间错过的消息靠版本号检查兜底
+        while True:
+            node_assets_mapping_for_memory_pub_sub.keep_handle_msg(handle_node_relation_change)
+            logger.warning('Subscribe node assets mapping expire exited, resubscribe later')
+            time.sleep(3)
 
     t = threading.Thread(target=keep_subscribe_node_assets_relation)
     t.daemon = True
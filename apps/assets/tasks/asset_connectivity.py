@@ -1,11 +1,15 @@
 # ~*~ coding: utf-8 ~*~
+import time
+import uuid
 from itertools import groupby
 from collections import defaultdict
-from celery import shared_task
+from celery import shared_task, chord, current_task
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from common.utils import get_logger
-from orgs.utils import org_aware_func
+from common.utils.connection import get_redis_client
+from orgs.utils import org_aware_func, tmp_to_org
 from ..models import Asset, Connectivity, AuthBook
 from . import const
 from .utils import clean_ansible_task_hosts, group_asset_by_platform
@@ -15,21 +19,17 @@ logger = get_logger(__file__)
 __all__ = [
     'test_asset_connectivity_util', 'test_asset_connectivity_manual',
     'test_node_assets_connectivity_manual', 'test_assets_connectivity_manual',
+    'test_assets_connectivity_shard', 'collect_assets_connectivity_shards_result',
+    'AssetsConnectivityProgress',
 ]
 
+PLATFORM_TASKS_MAP = {
+    "unixlike": const.PING_UNIXLIKE_TASKS,
+    "windows": const.PING_WINDOWS_TASKS
+}
 
-def set_assets_accounts_connectivity(assets, results_summary):
-    asset_ids_ok = set()
-    asset_ids_failed = set()
-
-    asset_hostnames_ok = results_summary.get('contacted', {}).keys()
-
-    for asset in assets:
-        if asset.hostname in asset_hostnames_ok:
-            asset_ids_ok.add(asset.id)
-        else:
-            asset_ids_failed.add(asset.id)
 
+def bulk_set_assets_accounts_connectivity(asset_ids_ok, asset_ids_failed):
     Asset.bulk_set_connectivity(asset_ids_ok, Connectivity.ok)
     Asset.bulk_set_connectivity(asset_ids_failed, Connectivity.failed)
 
@@ -40,15 +40,173 @@ def set_assets_accounts_connectivity(assets, results_summary):
     AuthBook.bulk_set_connectivity(accounts_failed, Connectivity.failed)
 
 
+class AssetsConnectivityProgress:
+    """
+    一次可连接性测试的进度，保存在 redis 中，拆分出的多个任务一起更新
+    """
+    key_template = 'assets.connectivity.progress.{}'
+    expire = 3600 * 24
+
+    def __init__(self, progress_id):
+        self.progress_id = str(progress_id)
+        self.key = self.key_template.format(self.progress_id)
+
+    @property
+    def client(self):
+        return get_redis_client(settings.REDIS_DB_CACHE)
+
+    def start(self, total):
+        with self.client.pipeline() as p:
+            p.delete(self.key)
+            p.hset(self.key, mapping={
+                'total': total, 'ok': 0, 'failed': 0, 'finished': 0, 'success': 0
+            })
+            p.expire(self.key, self.expire)
+            p.execute()
+
+    def finish(self, success):
+        # 所有任务(包括拆分出的任务)都结束后才算完成，不能只看写入的数量
+        self.client.hset(self.key, mapping={'finished': 1, 'success': int(bool(success))})
+
+    def incr(self, ok=0, failed=0):
+        with self.client.pipeline() as p:
+            p.hincrby(self.key, 'ok', ok)
+            p.hincrby(self.key, 'failed', failed)
+            p.execute()
+
+    def get(self):
+        data = self.client.hgetall(self.key)
+        if not data:
+            return None
+        data = {k.decode(): int(v) for k, v in data.items()}
+        data['done'] = data['ok'] + data['failed']
+        data['is_finished'] = bool(data.pop('finished', 0))
+        data['success'] = bool(data['success']) if data['is_finished'] else None
+        return data
+
+
+class AssetsConnectivityResultWriter:
+    """
+    每台主机的结果返回时先暂存，攒够一批或者过了一段时间就写到数据库中，
+    不用等所有主机(特别是超时的)执行完
+    """
+    batch_size = 50
+    flush_interval = 3
+
+    def __init__(self, assets, progress=None):
+        self.hostname_asset_id_mapper = {asset.hostname: asset.id for asset in assets}
+        self.pending_asset_ids = set(self.hostname_asset_id_mapper.values())
+        self.progress = progress
+        self.asset_ids_ok = set()
+        self.asset_ids_failed = set()
+        self.last_flush_time = time.time()
+
+    def on_host_result(self, t, host, task_name, task_result):
+        asset_id = self.hostname_asset_id_mapper.get(host)
+        if asset_id not in self.pending_asset_ids:
+            return
+        self.pending_asset_ids.remove(asset_id)
+        if t in ('ok', 'skipped'):
+            self.asset_ids_ok.add(asset_id)
+        else:
+            self.asset_ids_failed.add(asset_id)
+
+        amount = len(self.asset_ids_ok) + len(self.asset_ids_failed)
+        if amount >= self.batch_size or time.time() - self.last_flush_time > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.time()
+        if not self.asset_ids_ok and not self.asset_ids_failed:
+            return
+        bulk_set_assets_accounts_connectivity(self.asset_ids_ok, self.asset_ids_failed)
+        if self.progress:
+            self.progress.incr(ok=len(self.asset_ids_ok), failed=len(self.asset_ids_failed))
+        self.asset_ids_ok = set()
+        self.asset_ids_failed = set()
+
+    def finish(self):
+        # 没有返回结果的主机都当作失败
+        self.asset_ids_failed.update(self.pending_asset_ids)
+        self.pending_asset_ids = set()
+        self.flush()
+
+
+def run_platform_assets_connectivity_test(platform, assets, task_name, progress=None):
+    from ops.utils import update_or_create_ansible_task
+
+    writer = AssetsConnectivityResultWriter(assets, progress=progress)
+    tasks = PLATFORM_TASKS_MAP.get(platform)
+    task, created = update_or_create_ansible_task(
+        task_name=task_name, hosts=assets, tasks=tasks,
+        pattern='all', options=const.TASK_OPTIONS, run_as_admin=True,
+    )
+    summary = {}
+    try:
+        if task:
+            raw, summary = task.run(host_result_handler=writer.on_host_result)
+    finally:
+        writer.finish()
+    return summary
+
+
+@shared_task(queue="ansible")
+def test_assets_connectivity_shard(org_id, platform, asset_ids, task_name, progress_id):
+    with tmp_to_org(org_id):
+        assets = list(Asset.objects.filter(id__in=asset_ids))
+        progress = AssetsConnectivityProgress(progress_id)
+        try:
+            return run_platform_assets_connectivity_test(platform, assets, task_name, progress=progress)
+        except Exception as e:
+            # 不抛出异常，否则其它分片的结果不会汇总，整个测试也就一直不会结束
+            logger.error('Test assets connectivity shard error: {}'.format(e), exc_info=True)
+            return {'success': False, 'error': str(e), 'asset_ids': asset_ids}
+
+
+def merge_assets_connectivity_summaries(summaries):
+    results_summary = dict(
+        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
+    )
+    for summary in summaries:
+        summary = summary or {}
+        results_summary['success'] &= summary.get('success', False)
+        results_summary['contacted'].update(summary.get('contacted', {}))
+        results_summary['dark'].update(summary.get('dark', {}))
+        if summary.get('error'):
+            for asset_id in summary.get('asset_ids', []):
+                results_summary['dark'][asset_id] = {'error': summary['error']}
+    return results_summary
+
+
+@shared_task(queue="ansible")
+def collect_assets_connectivity_shards_result(summaries, progress_id):
+    results_summary = merge_assets_connectivity_summaries(summaries)
+    AssetsConnectivityProgress(progress_id).finish(
+        results_summary['success'] and not results_summary['dark']
+    )
+    return results_summary
+
+
+def get_current_progress_id():
+    # 与 api 返回的任务 id 一致，可以用它查询进度
+    try:
+        return current_task.request.id or str(uuid.uuid4())
+    except AttributeError:
+        return str(uuid.uuid4())
+
+
 @shared_task(queue="ansible")
 @org_aware_func("assets")
 def test_asset_connectivity_util(assets, task_name=None):
-    from ops.utils import update_or_create_ansible_task
-
     if task_name is None:
         task_name = _("Test assets connectivity")
 
     hosts = clean_ansible_task_hosts(assets)
+    # 不能执行 ansible 的资产直接设置为不可连接
+    host_ids = {host.id for host in hosts}
+    skipped_asset_ids = {asset.id for asset in assets if asset.id not in host_ids}
+    if skipped_asset_ids:
+        bulk_set_assets_accounts_connectivity(set(), skipped_asset_ids)
     if not hosts:
         return {}
     platform_hosts_map = {}
@@ -57,55 +215,68 @@ def test_asset_connectivity_util(assets, task_name=None):
     for i in platform_hosts:
         platform_hosts_map[i[0]] = list(i[1])
 
-    platform_tasks_map = {
-        "unixlike": const.PING_UNIXLIKE_TASKS,
-        "windows": const.PING_WINDOWS_TASKS
-    }
-    results_summary = dict(
-        contacted=defaultdict(dict), dark=defaultdict(dict), success=True
-    )
-    for platform, _hosts in platform_hosts_map.items():
-        if not _hosts:
-            continue
-        logger.debug("System user not has special auth")
-        tasks = platform_tasks_map.get(platform)
-        task, created = update_or_create_ansible_task(
-            task_name=task_name, hosts=_hosts, tasks=tasks,
-            pattern='all', options=const.TASK_OPTIONS, run_as_admin=True,
-        )
-        raw, summary = task.run()
-        success = summary.get('success', False)
-        contacted = summary.get('contacted', {})
-        dark = summary.get('dark', {})
-
-        results_summary['success'] &= success
-        results_summary['contacted'].update(contacted)
-        results_summary['dark'].update(dark)
-        continue
-    set_assets_accounts_connectivity(assets, results_summary)
-    return results_summary
+    progress_id = get_current_progress_id()
+    progress = AssetsConnectivityProgress(progress_id)
+    progress.start(len(hosts))
 
+    shard_size = settings.CONNECTIVITY_TEST_SHARD_SIZE
+    if len(hosts) > shard_size:
+        # 主机太多，拆分成多个任务让多个 worker 并行执行，结果边执行边写入，进度通过 api 查看
+        org_id = hosts[0].org_id
+        shards = []
+        for platform, _hosts in platform_hosts_map.items():
+            for i in range(0, len(_hosts), shard_size):
+                asset_ids = [str(asset.id) for asset in _hosts[i:i + shard_size]]
+                shards.append((platform, asset_ids))
+        signatures = [
+            test_assets_connectivity_shard.s(
+                org_id, platform, asset_ids,
+                '{} ({}/{})'.format(task_name, i, len(shards)), progress_id
+            )
+            for i, (platform, asset_ids) in enumerate(shards, start=1)
+        ]
+        print(_("Hosts count: {}").format(len(hosts)))
+        # 所有分片结束后汇总结果，进度中的 is_finished/success 以汇总为准
+        chord(signatures)(collect_assets_connectivity_shards_result.s(progress_id))
+        return {'progress_id': progress_id, 'shards': len(shards), 'pending': True}
+
+    summaries = []
+    try:
+        for platform, _hosts in platform_hosts_map.items():
+            if not _hosts:
+                continue
+            summary = run_platform_assets_connectivity_test(platform, _hosts, task_name, progress=progress)
+            summaries.append(summary)
+    except Exception:
+        progress.finish(False)
+        raise
+    results_summary = merge_assets_connectivity_summaries(summaries)
+    progress.finish(results_summary['success'] and not results_summary['dark'])
+    return results_summary
 
-@shared_task(queue="ansible")
-def test_asset_connectivity_manual(asset):
-    task_name = _("Test assets connectivity: {}").format(asset)
-    summary = test_asset_connectivity_util([asset], task_name=task_name)
 
+def get_connectivity_manual_result(summary):
+    if summary.get('pending'):
+        # 拆分执行的测试还没有结果，通过进度 api 查看最终结果
+        return None, summary
     if summary.get('dark'):
         return False, summary['dark']
     else:
         return True, ""
 
 
+@shared_task(queue="ansible")
+def test_asset_connectivity_manual(asset):
+    task_name = _("Test assets connectivity: {}").format(asset)
+    summary = test_asset_connectivity_util([asset], task_name=task_name)
+    return get_connectivity_manual_result(summary)
+
+
 @shared_task(queue="ansible")
 def test_assets_connectivity_manual(assets):
     task_name = _("Test assets connectivity: {}").format([asset.hostname for asset in assets])
     summary = test_asset_connectivity_util(assets, task_name=task_name)
-
-    if summary.get('dark'):
-        return False, summary['dark']
-    else:
-        return True, ""
+    return get_connectivity_manual_result(summary)
 
 
 @shared_task(queue="ansible")
@@ -114,4 +285,3 @@ def test_node_assets_connectivity_manual(node):
     assets = node.get_all_assets()
     result = test_asset_connectivity_util(assets, task_name=task_name)
     return result
-
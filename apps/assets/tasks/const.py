@@ -43,6 +43,11 @@ TASK_OPTIONS = {
     'forks': 10,
 }
 
+PUSH_SYSTEM_USER_TASK_OPTIONS = {
+    'timeout': 10,
+    'forks': settings.PUSH_SYSTEM_USER_FORKS,
+}
+
 CACHE_KEY_ASSET_BULK_UPDATE_ID_PREFIX = '_KEY_ASSET_BULK_UPDATE_ID_{}'
 CONN_UNREACHABLE, CONN_REACHABLE, CONN_UNKNOWN = range(0, 3)
 CONNECTIVITY_CHOICES = (
@@ -4,7 +4,7 @@ from django.utils.translation import gettext_lazy as _
 from orgs.models import Organization
 from orgs.utils import tmp_to_org
 from ops.celery.decorator import register_as_period_task
-from assets.utils import check_node_assets_amount
+from assets.utils import check_node_assets_amount, NodeAssetsAmountDeferredUpdater
 
 from common.utils.lock import AcquireFailed
 from common.utils import get_logger
@@ -29,6 +29,13 @@ def check_node_assets_amount_task(org_id=None):
             logger.error(error)
 
 
+@shared_task
+def update_nodes_assets_amount_task(org_id):
+    org = Organization.get_instance(org_id)
+    with tmp_to_org(org):
+        NodeAssetsAmountDeferredUpdater.update_dirty_nodes()
+
+
 @register_as_period_task(crontab='0 2 * * *')
 @shared_task
 def check_node_assets_amount_period_task():
@@ -14,6 +14,7 @@ from .utils import clean_ansible_task_hosts, group_asset_by_platform
 
 
 logger = get_logger(__file__)
+PUSH_AUTH_VAR_TEMPLATE = 'jms_push_auth_{}'
 __all__ = [
     'push_system_user_util', 'push_system_user_to_assets',
     'push_system_user_to_assets_manual', 'push_system_user_a_asset_manual',
@@ -32,7 +33,15 @@ def _dump_args(args: dict):
     return ' '.join([f'{k}={v}' for k, v in args.items() if v is not Empty])
 
 
-def get_push_unixlike_system_user_tasks(system_user, username=None):
+def _get_auth_var_expr(auth_var, attr):
+    return '{{ %s.%s }}' % (auth_var, attr)
+
+
+def get_push_unixlike_system_user_tasks(system_user, username=None, auth_var=None):
+    """
+    :param auth_var: 认证信息所在的主机变量名，设置后密码和公钥从主机变量中取，
+        这样每台主机的认证信息不同也可以在一次执行中推送
+    """
     comment = system_user.name
 
     if username is None:
@@ -97,7 +106,31 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
                 'when': 'home_existed.stat.exists == true'
             }
         ])
-    if password:
+    if auth_var:
+        tasks.extend([
+            {
+                'name': 'Set {} password'.format(username),
+                'action': {
+                    'module': 'user',
+                    'args': 'name={} shell={} state=present password={}'.format(
+                        username, system_user.shell,
+                        _get_auth_var_expr(auth_var, 'password_hash'),
+                    ),
+                },
+                'when': '{}.password_hash'.format(auth_var)
+            },
+            {
+                'name': 'Set {} authorized key'.format(username),
+                'action': {
+                    'module': 'authorized_key',
+                    'args': "user={} state=present key='{}'".format(
+                        username, _get_auth_var_expr(auth_var, 'public_key')
+                    )
+                },
+                'when': '{}.public_key'.format(auth_var)
+            }
+        ])
+    if password and not auth_var:
         tasks.append({
             'name': 'Set {} password'.format(username),
             'action': {
@@ -108,7 +141,7 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
                 ),
             }
         })
-    if public_key:
+    if public_key and not auth_var:
         tasks.append({
             'name': 'Set {} authorized key'.format(username),
             'action': {
@@ -138,10 +171,12 @@ def get_push_unixlike_system_user_tasks(system_user, username=None):
     return tasks
 
 
-def get_push_windows_system_user_tasks(system_user: SystemUser, username=None):
+def get_push_windows_system_user_tasks(system_user: SystemUser, username=None, auth_var=None):
     if username is None:
         username = system_user.username
     password = system_user.password
+    if auth_var:
+        password = _get_auth_var_expr(auth_var, 'password')
     groups = {'Users', 'Remote Desktop Users'}
     if system_user.system_groups:
         groups.update(_split_by_comma(system_user.system_groups))
@@ -172,15 +207,18 @@ def get_push_windows_system_user_tasks(system_user: SystemUser, username=None):
                     ''.format(username, username, password, groups),
         }
     }
+    if auth_var:
+        task['when'] = '{}.password'.format(auth_var)
     tasks.append(task)
     return tasks
 
 
-def get_push_system_user_tasks(system_user, platform="unixlike", username=None):
+def get_push_system_user_tasks(system_user, platform="unixlike", username=None, auth_var=None):
     """
     :param system_user:
     :param platform:
     :param username: 当动态时，近推送某个
+    :param auth_var: 认证信息所在的主机变量名
     :return:
     """
     get_task_map = {
@@ -189,19 +227,64 @@ def get_push_system_user_tasks(system_user, platform="unixlike", username=None):
     }
     get_tasks = get_task_map.get(platform, get_push_unixlike_system_user_tasks)
     if not system_user.username_same_with_user:
-        return get_tasks(system_user)
+        return get_tasks(system_user, auth_var=auth_var)
     tasks = []
     # 仅推送这个username
     if username is not None:
-        tasks.extend(get_tasks(system_user, username))
+        tasks.extend(get_tasks(system_user, username, auth_var=auth_var))
         return tasks
     users = system_user.users.all().values_list('username', flat=True)
     print(_("System user is dynamic: {}").format(list(users)))
     for _username in users:
-        tasks.extend(get_tasks(system_user, _username))
+        tasks.extend(get_tasks(system_user, _username, auth_var=auth_var))
     return tasks
 
 
+def get_push_system_user_auth(system_user, auth_book=None):
+    password = system_user.password
+    public_key = system_user.public_key
+    if auth_book:
+        if auth_book.password:
+            password = auth_book.password
+        if auth_book.public_key or auth_book.private_key:
+            public_key = auth_book.public_key
+    return {
+        'password': password or '',
+        'password_hash': encrypt_password(password, salt="K3mIlKK") if password else '',
+        'public_key': public_key or '',
+    }
+
+
+def get_push_system_user_host_vars(system_user, assets, usernames):
+    """
+    每台主机上要推送的每个用户的认证信息 {asset_id: {'jms_push_auth_0': {...}}}，
+    有特殊认证(AuthBook)的使用特殊认证，否则使用系统用户的
+    """
+    asset_ids = [asset.id for asset in assets]
+    auth_books = AuthBook.objects.filter(asset_id__in=asset_ids).filter(
+        Q(username__in=usernames) | Q(systemuser__username__in=usernames)
+    ).prefetch_related('systemuser')
+
+    special_auth_mapper = {}
+    for auth_book in auth_books:
+        auth_book.load_auth()
+        special_auth_mapper[(auth_book.username, auth_book.asset_id)] = auth_book
+
+    default_auth = get_push_system_user_auth(system_user)
+    host_vars = {}
+    for asset_id in asset_ids:
+        _vars = {}
+        for i, _username in enumerate(usernames):
+            auth_book = special_auth_mapper.get((_username, asset_id))
+            if auth_book:
+                auth = get_push_system_user_auth(system_user, auth_book)
+            else:
+                auth = default_auth
+            _vars[PUSH_AUTH_VAR_TEMPLATE.format(i)] = auth
+        host_vars[str(asset_id)] = _vars
+    return host_vars
+
+
 @org_aware_func("system_user")
 def push_system_user_util(system_user, assets, task_name, username=None):
     from ops.utils import update_or_create_ansible_task
@@ -212,14 +295,14 @@ def push_system_user_util(system_user, assets, task_name, username=None):
     assets_sorted = sorted(assets, key=group_asset_by_platform)
     platform_hosts = groupby(assets_sorted, key=group_asset_by_platform)
 
-    def run_task(_tasks, _hosts):
+    def run_task(_tasks, _hosts, _host_vars):
         if not _tasks:
             return
         task, created = update_or_create_ansible_task(
             task_name=task_name, hosts=_hosts, tasks=_tasks, pattern='all',
-            options=const.TASK_OPTIONS, run_as_admin=True,
+            options=const.PUSH_SYSTEM_USER_TASK_OPTIONS, run_as_admin=True,
         )
-        task.run()
+        task.run(host_vars=_host_vars)
 
     if system_user.username_same_with_user:
         if username is None:
@@ -239,36 +322,15 @@ def push_system_user_util(system_user, assets, task_name, username=None):
         print(_("Start push system user for platform: [{}]").format(platform))
         print(_("Hosts count: {}").format(len(_assets)))
 
-        id_asset_map = {_asset.id: _asset for _asset in _assets}
-        asset_ids = id_asset_map.keys()
-        no_special_auth = []
-        special_auth_set = set()
-
-        auth_books = AuthBook.objects.filter(asset_id__in=asset_ids).filter(
-            Q(username__in=usernames) | Q(systemuser__username__in=usernames)
-        ).prefetch_related('systemuser')
-
-        for auth_book in auth_books:
-            auth_book.load_auth()
-            special_auth_set.add((auth_book.username, auth_book.asset_id))
-
-        for _username in usernames:
-            no_special_assets = []
-            for asset_id in asset_ids:
-                if (_username, asset_id) not in special_auth_set:
-                    no_special_assets.append(id_asset_map[asset_id])
-            if no_special_assets:
-                no_special_auth.append((_username, no_special_assets))
-
-        for _username, no_special_assets in no_special_auth:
-            tasks = get_push_system_user_tasks(system_user, platform, username=_username)
-            run_task(tasks, no_special_assets)
-
-        for auth_book in auth_books:
-            system_user._merge_auth(auth_book)
-            tasks = get_push_system_user_tasks(system_user, platform, username=auth_book.username)
-            asset = id_asset_map[auth_book.asset_id]
-            run_task(tasks, [asset])
+        # 每台主机的认证信息放到主机变量中，一个平台只执行一次
+        host_vars = get_push_system_user_host_vars(system_user, _assets, usernames)
+        tasks = []
+        for i, _username in enumerate(usernames):
+            auth_var = PUSH_AUTH_VAR_TEMPLATE.format(i)
+            tasks.extend(get_push_system_user_tasks(
+                system_user, platform, username=_username, auth_var=auth_var
+            ))
+        run_task(tasks, _assets, host_vars)
 
 
 @shared_task(queue="ansible")
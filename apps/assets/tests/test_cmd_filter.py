@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+import random
+import uuid
+
+from django.test import TransactionTestCase
+
+from assets.models import CommandFilter, CommandFilterRule, CommandFilterRuleSet
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from users.models import User, UserGroup
+
+TYPE_REGEX = CommandFilterRule.TYPE_REGEX
+TYPE_COMMAND = CommandFilterRule.TYPE_COMMAND
+DENY = CommandFilterRule.ActionChoices.deny
+ALLOW = CommandFilterRule.ActionChoices.allow
+CONFIRM = CommandFilterRule.ActionChoices.confirm
+UNKNOWN = CommandFilterRule.ACTION_UNKNOWN
+
+
+def make_rule(tp, content, action=DENY, priority=50):
+    return {
+        'id': str(uuid.uuid4()), 'filter_id': str(uuid.uuid4()),
+        'type': tp, 'content': content, 'priority': priority, 'action': action,
+    }
+
+
+def get_action_one_by_one(rules, command):
+    """ 之前的实现: 按顺序逐个规则匹配 """
+    rules = sorted(rules, key=lambda r: (r['priority'], r['action']))
+    for rule in rules:
+        action, matched = CommandFilterRule(**rule).match(command)
+        if action != UNKNOWN:
+            return action, matched
+    return UNKNOWN, ''
+
+
+def assert_same_as_one_by_one(rules, commands):
+    rule_set = CommandFilterRuleSet(rules)
+    for command in commands:
+        assert rule_set.get_action(command) == get_action_one_by_one(rules, command), command
+
+
+REGEX_RULES = [
+    make_rule(TYPE_REGEX, r'rm\s+-rf\s+/'),
+    make_rule(TYPE_REGEX, r'^reboot$'),
+    make_rule(TYPE_REGEX, r'(shutdown|halt|poweroff)'),
+    make_rule(TYPE_REGEX, r'(?i)mkfs\.\w+'),
+    make_rule(TYPE_REGEX, r'\d{3,}'),
+    make_rule(TYPE_REGEX, r'['),
+    make_rule(TYPE_REGEX, r'dd\s+if=.*of=/dev/sd[a-z]'),
+]
+
+COMMAND_RULES = [
+    make_rule(TYPE_COMMAND, 'rm'),
+    make_rule(TYPE_COMMAND, 'ls -l'),
+    make_rule(TYPE_COMMAND, 'reboot\nshutdown\r\ninit 0'),
+    make_rule(TYPE_COMMAND, 'w'),
+    make_rule(TYPE_COMMAND, 'chmod 777'),
+    make_rule(TYPE_COMMAND, '.sh'),
+]
+
+COMMANDS = [
+    '', 'ls', 'ls -l /tmp', 'ls  -l', 'LS -L', 'rm -rf /', 'RM -RF /', 'rm -rf /tmp', 'echo rm',
+    'firmware', 'reboot', 'sudo reboot', 'REBOOT', 'shutdown -h now', 'halting', 'mkfs.ext4 /dev/sdb',
+    'MKFS.EXT4 /dev/sdb', 'echo 12', 'echo 123', 'dd if=/dev/zero of=/dev/sda', 'w', 'who', 'ww',
+    'chmod 777 a', 'chmod  777 a', 'chmod 755 a', 'init 0', 'init 1', 'bash a.sh', 'bash ash',
+    'rm 文件', 'ｒｍ -rf /', 'Reboot\n', 'ſhutdown',
+]
+
+
+def test_regex_rules():
+    assert_same_as_one_by_one(REGEX_RULES, COMMANDS)
+
+
+def test_command_rules():
+    assert_same_as_one_by_one(COMMAND_RULES, COMMANDS)
+
+
+def test_invalid_regex_rule_skipped():
+    rule_set = CommandFilterRuleSet([make_rule(TYPE_REGEX, r'[')])
+    assert rule_set.get_action('[') == (UNKNOWN, '')
+
+
+def test_priority_order():
+    rules = [
+        make_rule(TYPE_COMMAND, 'rm', action=ALLOW, priority=10),
+        make_rule(TYPE_REGEX, r'rm\s+-rf', action=DENY, priority=20),
+        make_rule(TYPE_COMMAND, 'ls', action=ALLOW, priority=30),
+        make_rule(TYPE_COMMAND, 'ls', action=DENY, priority=30),
+        make_rule(TYPE_COMMAND, 'cat', action=ALLOW, priority=40),
+        make_rule(TYPE_COMMAND, 'cat', action=CONFIRM, priority=40),
+    ]
+    rule_set = CommandFilterRuleSet(rules)
+    assert rule_set.get_action('rm -rf /') == (ALLOW, 'rm')
+    # 优先级相同时按动作排序，拒绝在前
+    assert rule_set.get_action('ls') == (DENY, 'ls')
+    # 复核与之前的实现相同，当作拒绝
+    assert rule_set.get_action('cat a') == (DENY, 'cat')
+    assert_same_as_one_by_one(rules, ['rm -rf /', 'ls', 'cat a', 'echo'])
+
+
+def test_case_handling():
+    rules = [
+        make_rule(TYPE_REGEX, r'Reboot'),
+        make_rule(TYPE_REGEX, r'(?i)Shutdown'),
+        make_rule(TYPE_COMMAND, 'Halt'),
+    ]
+    rule_set = CommandFilterRuleSet(rules)
+    assert rule_set.get_action('reboot') == (UNKNOWN, '')
+    assert rule_set.get_action('Reboot') == (DENY, 'Reboot')
+    assert rule_set.get_action('SHUTDOWN') == (DENY, 'SHUTDOWN')
+    # 命令类型的规则忽略大小写
+    assert rule_set.get_action('HALT') == (DENY, 'HALT')
+    assert_same_as_one_by_one(rules, ['reboot', 'REBOOT', 'shutdown', 'ſhutdown', 'halt', 'HaLt', 'ｈalt'])
+
+
+def test_random_commands():
+    rand = random.Random(0)
+    rules = REGEX_RULES + COMMAND_RULES
+    rand.shuffle(rules)
+    for rule in rules:
+        rule['priority'] = rand.randint(1, 100)
+        rule['action'] = rand.choice([DENY, ALLOW, CONFIRM])
+    words = ['rm', '-rf', '/', 'ls', '-l', 'reboot', 'Reboot', 'shutdown', 'mkfs.xfs', '1234',
+             'w', 'who', 'chmod', '777', 'init', '0', 'a.sh', 'dd', 'if=/dev/zero', 'of=/dev/sdc', '文件']
+    commands = [
+        rand.choice(['', ' ', '  ', ';']).join(rand.choices(words, k=rand.randint(1, 5)))
+        for _ in range(500)
+    ]
+    assert_same_as_one_by_one(rules, commands)
+
+
+def test_from_rules_cached_by_version():
+    rules = [make_rule(TYPE_COMMAND, 'rm'), make_rule(TYPE_COMMAND, 'ls', priority=10)]
+    rule_set = CommandFilterRuleSet.from_rules(rules)
+    assert CommandFilterRuleSet.from_rules(list(reversed(rules))) is rule_set
+    assert CommandFilterRuleSet.from_rules(rules[:1]) is not rule_set
+
+
+class CommandFilterRuleSetExpireTestCase(TransactionTestCase):
+    """
+    缓存的规则集在事务提交后失效，所以使用 TransactionTestCase
+    """
+
+    def setUp(self):
+        self.org = Organization.default()
+        with tmp_to_org(self.org):
+            self.user = User.objects.create(
+                username='cmd_filter_test_user', name='cmd_filter_test_user',
+                email='cmd_filter_test_user@example.com'
+            )
+            self.group = UserGroup.objects.create(name='cmd_filter_test_group')
+            self.user.groups.add(self.group)
+            self.cmd_filter = CommandFilter.objects.create(name='cmd_filter_test')
+            CommandFilterRule.objects.create(filter=self.cmd_filter, type=TYPE_COMMAND, content='rm')
+            self.cmd_filter.user_groups.add(self.group)
+
+    def get_user_rule_set(self):
+        with tmp_to_org(self.org):
+            return CommandFilterRuleSet.get_rule_set(user_id=self.user.id)
+
+    def test_expire_on_user_group_delete(self):
+        self.assertEqual(self.get_user_rule_set().get_action('rm')[0], DENY)
+        with tmp_to_org(self.org):
+            self.group.delete()
+        self.assertEqual(self.get_user_rule_set().get_action('rm')[0], UNKNOWN)
+
+    def test_expire_on_user_group_remove(self):
+        self.assertEqual(self.get_user_rule_set().get_action('rm')[0], DENY)
+        self.user.groups.remove(self.group)
+        self.assertEqual(self.get_user_rule_set().get_action('rm')[0], UNKNOWN)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+import random
+import threading
+
+from assets.models import Node
+from assets.models.node import NodeAssetsMapping
+from assets.signals_handler import node_assets_mapping as handler
+
+ADD_ASSETS = NodeAssetsMapping.ADD_ASSETS
+REMOVE_ASSETS = NodeAssetsMapping.REMOVE_ASSETS
+ADD_NODE = NodeAssetsMapping.ADD_NODE
+REMOVE_NODE = NodeAssetsMapping.REMOVE_NODE
+MOVE_NODE = NodeAssetsMapping.MOVE_NODE
+
+ALL_KEYS = ['1', '1:1', '1:1:1', '1:1:2', '1:2', '1:2:1', '1:3']
+
+
+def get_direct_assets():
+    return {
+        '1': {'a0'},
+        '1:1': {'a1'},
+        '1:1:1': {'a2', 'a3'},
+        '1:1:2': set(),
+        '1:2': {'a3', 'a4'},
+        '1:2:1': {'a5'},
+    }
+
+
+def apply_ops_to_direct_assets(direct_assets, ops):
+    """ 逐个应用变化，与数据库中节点、资产关系的变化相同 """
+    for action, *args in ops:
+        if action == ADD_ASSETS:
+            direct_assets.setdefault(args[0], set()).update(args[1])
+        elif action == REMOVE_ASSETS:
+            direct_assets.get(args[0], set()).difference_update(args[1])
+        elif action == ADD_NODE:
+            direct_assets.setdefault(args[0], set())
+        elif action == REMOVE_NODE:
+            direct_assets.pop(args[0], None)
+        elif action == MOVE_NODE:
+            old_key, new_key = args
+            for key in list(direct_assets):
+                if key == old_key or key.startswith(f'{old_key}:'):
+                    direct_assets[new_key + key[len(old_key):]] = direct_assets.pop(key)
+    return direct_assets
+
+
+def assert_mapping_equal(mapping, expected, keys=None):
+    keys = keys or set(mapping.keys) | set(expected.keys) | set(ALL_KEYS)
+    for key in keys:
+        assert mapping.get_all_asset_ids(key) == expected.get_all_asset_ids(key), key
+        assert mapping.get_assets_amount(key) == expected.get_assets_amount(key), key
+
+
+def assert_patch_same_as_build(ops):
+    mapping = NodeAssetsMapping.build(get_direct_assets(), version=1)
+    patched = mapping.patch(ops)
+    direct_assets = apply_ops_to_direct_assets(get_direct_assets(), ops)
+    expected = NodeAssetsMapping.build(direct_assets)
+    assert_mapping_equal(patched, expected)
+    assert patched.version == 2
+    # 原映射不变
+    assert_mapping_equal(mapping, NodeAssetsMapping.build(get_direct_assets()))
+    # 序列化后相同
+    assert_mapping_equal(NodeAssetsMapping.from_bytes(patched.to_bytes()), expected)
+    return patched
+
+
+def test_patch_add_assets():
+    assert_patch_same_as_build([
+        [ADD_ASSETS, '1:1:2', ['a6', 'a0']],
+        [ADD_ASSETS, '1:3', ['a1']],
+    ])
+
+
+def test_patch_add_assets_to_new_node():
+    assert_patch_same_as_build([[ADD_ASSETS, '1:4', ['a7']]])
+
+
+def test_patch_remove_assets():
+    assert_patch_same_as_build([
+        [REMOVE_ASSETS, '1:1:1', ['a3']],
+        [REMOVE_ASSETS, '1:2', ['a3', 'not-exist']],
+        [REMOVE_ASSETS, '1:9', ['a1']],
+    ])
+
+
+def test_patch_clear_node_assets():
+    # `post_clear` 在信号中直接清除映射，这里是移除节点的全部资产
+    assert_patch_same_as_build([[REMOVE_ASSETS, '1:2', ['a3', 'a4']]])
+
+
+def test_patch_nodes():
+    assert_patch_same_as_build([
+        [ADD_NODE, '1:5'],
+        [MOVE_NODE, '1:1', '1:5:1'],
+        [REMOVE_NODE, '1:2:1'],
+        [ADD_ASSETS, '1:5:1:2', ['a8']],
+    ])
+
+
+def test_merge_ops_same_as_sequential():
+    ops = [
+        [ADD_ASSETS, '1:1:2', ['a6']],
+        [REMOVE_ASSETS, '1:1:2', ['a6']],
+        [ADD_ASSETS, '1:2', ['a1', 'a6']],
+        [REMOVE_ASSETS, '1:1:1', ['a2']],
+        [ADD_ASSETS, '1:1:1', ['a2']],
+        [MOVE_NODE, '1:2', '1:3:1'],
+        [REMOVE_ASSETS, '1:3:1', ['a4']],
+        [ADD_ASSETS, '1:3:1', ['a4', 'a9']],
+        [REMOVE_ASSETS, '1:3:1', ['a9']],
+    ]
+    mapping = NodeAssetsMapping.build(get_direct_assets())
+    merged = NodeAssetsMapping.merge_ops(ops)
+    assert len(merged) < len(ops)
+    assert [op[0] for op in merged].count(MOVE_NODE) == 1
+    assert_mapping_equal(mapping.patch(merged), mapping.patch(ops), keys=ALL_KEYS + ['1:3:1'])
+
+
+def test_merge_ops_random():
+    rand = random.Random(0)
+    keys = ALL_KEYS[1:]
+    asset_ids = [f'a{i}' for i in range(10)]
+    for _ in range(200):
+        ops = [
+            [rand.choice([ADD_ASSETS, REMOVE_ASSETS]), rand.choice(keys), rand.sample(asset_ids, 2)]
+            for _ in range(20)
+        ]
+        mapping = NodeAssetsMapping.build(get_direct_assets())
+        assert_mapping_equal(mapping.patch(NodeAssetsMapping.merge_ops(ops)), mapping.patch(ops))
+
+
+def test_patch_in_memory_versions():
+    org_id = 'test-patch-in-memory-versions'
+    ops = [[ADD_ASSETS, '1:3', ['a6']]]
+    Node.set_node_all_asset_ids_mapping_to_memory(org_id, NodeAssetsMapping.build(get_direct_assets(), 1))
+
+    # 旧版本的消息忽略
+    Node.patch_node_all_asset_ids_mapping_in_memory(org_id, 1, ops)
+    assert Node.get_node_all_asset_ids_mapping_from_memory(org_id).version == 1
+
+    Node.patch_node_all_asset_ids_mapping_in_memory(org_id, 2, ops)
+    mapping = Node.get_node_all_asset_ids_mapping_from_memory(org_id)
+    assert mapping.version == 2
+    assert mapping.get_all_asset_ids('1:3') == {'a6'}
+
+    # 版本不连续，说明错过了更新，清除
+    Node.patch_node_all_asset_ids_mapping_in_memory(org_id, 4, ops)
+    assert not Node.get_node_all_asset_ids_mapping_from_memory(org_id)
+
+
+def test_concurrent_patch_in_memory():
+    """
+    各进程收到的消息可能乱序、并发处理，结果要么与按顺序更新的相同，要么被清除，不能是错的
+    """
+    org_id = 'test-concurrent-patch-in-memory'
+    all_ops = [[[ADD_ASSETS, '1:3', [f'b{i}']]] for i in range(2, 30)]
+    expected = NodeAssetsMapping.build(get_direct_assets(), 1)
+    for ops in all_ops:
+        expected = expected.patch(ops)
+
+    for _ in range(20):
+        Node.set_node_all_asset_ids_mapping_to_memory(org_id, NodeAssetsMapping.build(get_direct_assets(), 1))
+        messages = list(enumerate(all_ops, start=2))
+        random.shuffle(messages)
+        threads = [
+            threading.Thread(target=Node.patch_node_all_asset_ids_mapping_in_memory, args=(org_id, v, ops))
+            for v, ops in messages
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        mapping = Node.get_node_all_asset_ids_mapping_from_memory(org_id)
+        if mapping:
+            assert_mapping_equal(mapping, expected)
+    Node.expire_node_all_asset_ids_mapping_from_memory(org_id)
+
+
+class FakeConnection:
+    def __init__(self, in_atomic_block):
+        self.in_atomic_block = in_atomic_block
+        self.run_on_commit = []
+
+
+def test_patcher_merges_ops_in_transaction(monkeypatch):
+    calls = []
+    monkeypatch.setattr(handler, 'patch_node_assets_mapping_now', lambda org_id, ops: calls.append((org_id, ops)))
+    monkeypatch.setattr(handler, 'expire_node_assets_mapping_for_memory', lambda org_id: calls.append((org_id, None)))
+    conn = FakeConnection(in_atomic_block=True)
+    monkeypatch.setattr(handler.transaction, 'get_connection', lambda: conn)
+    monkeypatch.setattr(handler.transaction, 'on_commit', lambda func: conn.run_on_commit.append(({'s1'}, func)))
+
+    patcher = handler.NodeAssetsMappingPatcher()
+    patcher.patch('org', [[ADD_ASSETS, '1:1', ['a1']]])
+    patcher.patch('org', [[ADD_ASSETS, '1:1', ['a2']]])
+    # savepoint 回滚，其中的变化丢弃，更新回调保留
+    conn.run_on_commit = [item for item in conn.run_on_commit if 's1' not in item[0]]
+    patcher.patch('org', [[ADD_ASSETS, '1:2', ['a3']]])
+    assert not calls
+
+    for sids, func in conn.run_on_commit:
+        func()
+    assert calls == [('org', [[ADD_ASSETS, '1:2', ['a3']]])]
+
+
+def test_patcher_expire_when_too_many(monkeypatch):
+    calls = []
+    monkeypatch.setattr(handler, 'patch_node_assets_mapping_now', lambda org_id, ops: calls.append((org_id, ops)))
+    monkeypatch.setattr(handler, 'expire_node_assets_mapping_for_memory', lambda org_id: calls.append((org_id, None)))
+    conn = FakeConnection(in_atomic_block=True)
+    monkeypatch.setattr(handler.transaction, 'get_connection', lambda: conn)
+    monkeypatch.setattr(handler.transaction, 'on_commit', lambda func: conn.run_on_commit.append((set(), func)))
+
+    patcher = handler.NodeAssetsMappingPatcher()
+    patcher.max_patch_amount = 3
+    for i in range(4):
+        patcher.patch('org1', [[ADD_ASSETS, '1:1', [f'a{i}']]])
+    patcher.patch('org2', [[ADD_ASSETS, '1:1', ['a1']]])
+    patcher.expire('org2')
+    patcher.patch('org2', [[ADD_ASSETS, '1:1', ['a2']]])
+    for sids, func in conn.run_on_commit:
+        func()
+    assert calls == [('org1', None), ('org2', None)]
@@ -1,14 +1,21 @@
 # ~*~ coding: utf-8 ~*~
 #
 from collections import defaultdict
+
+from django.db import transaction
+
 from common.utils import get_logger, dict_get_any, is_uuid, get_object_or_none, timeit
 from common.http import is_true
 from common.struct import Stack
+from common.local import thread_local
 from common.db.models import output_as_string
+from common.utils.connection import get_redis_client
 from orgs.utils import ensure_in_real_or_default_org, current_org
+from jumpserver.const import CONFIG
 
 from .locks import NodeTreeUpdateLock
 from .models import Node, Asset
+from .models.node import node_key_sort_key
 
 logger = get_logger(__file__)
 
@@ -44,6 +51,103 @@ def check_node_assets_amount():
     Node.objects.bulk_update(to_updates, fields=('assets_amount',))
 
 
+class NodeAssetsAmountDeferredUpdater:
+    """
+    资产和节点关系变化时，合并、延迟更新节点的资产数量:
+
+    - 事务中只记录关系变化的节点，提交后放入组织待更新的集合，只调度一个任务
+    - 任务根据节点资产映射，重新计算这些节点及其祖先节点的资产数量
+    - 待更新的节点太多或者计算出错时，使用 check_node_assets_amount 全量检查
+    """
+    dirty_keys_key_template = 'assets.node.assets_amount.dirty.<org_id:{org_id}>'
+    scheduled_key_template = 'assets.node.assets_amount.scheduled.<org_id:{org_id}>'
+    countdown = 2
+    # 任务丢失时，过期后可以重新调度
+    scheduled_ttl = 60
+    max_nodes_amount = 5000
+
+    @classmethod
+    def get_redis_client(cls):
+        return get_redis_client(CONFIG.REDIS_DB_CACHE)
+
+    @classmethod
+    def add_changed_node_keys(cls, org_id, node_keys):
+        node_keys = set(node_keys)
+        if not node_keys:
+            return
+        buffer = getattr(thread_local, 'node_assets_amount_changed_keys', None)
+        if buffer is None:
+            buffer = defaultdict(set)
+            thread_local.node_assets_amount_changed_keys = buffer
+        buffer[str(org_id)].update(node_keys)
+        # 第一个执行的回调处理全部，之后的直接返回；
+        # 回滚的事务记录的节点会在下次提交时一起计算，重新计算不会出错
+        transaction.on_commit(cls.flush)
+
+    @classmethod
+    def flush(cls):
+        from .tasks import update_nodes_assets_amount_task
+
+        buffer = getattr(thread_local, 'node_assets_amount_changed_keys', None)
+        if not buffer:
+            return
+        thread_local.node_assets_amount_changed_keys = None
+
+        client = cls.get_redis_client()
+        for org_id, node_keys in buffer.items():
+            client.sadd(cls.dirty_keys_key_template.format(org_id=org_id), *node_keys)
+            scheduled_key = cls.scheduled_key_template.format(org_id=org_id)
+            if client.set(scheduled_key, 1, nx=True, ex=cls.scheduled_ttl):
+                update_nodes_assets_amount_task.apply_async((org_id,), countdown=cls.countdown)
+
+    @classmethod
+    def pop_dirty_node_keys(cls, org_id):
+        client = cls.get_redis_client()
+        # 先删除调度标记，之后加入的节点会调度新的任务
+        client.delete(cls.scheduled_key_template.format(org_id=org_id))
+        dirty_keys_key = cls.dirty_keys_key_template.format(org_id=org_id)
+        with client.pipeline() as p:
+            p.smembers(dirty_keys_key)
+            p.delete(dirty_keys_key)
+            node_keys, __ = p.execute()
+        return {key.decode() for key in node_keys}
+
+    @classmethod
+    @NodeTreeUpdateLock()
+    @ensure_in_real_or_default_org
+    def update_dirty_nodes(cls):
+        org_id = str(current_org.id)
+        node_keys = cls.pop_dirty_node_keys(org_id)
+        if not node_keys:
+            return
+
+        keys = set()
+        for key in node_keys:
+            keys.update(Node.get_node_ancestor_keys(key, with_self=True))
+        if len(keys) > cls.max_nodes_amount:
+            check_node_assets_amount()
+            return
+
+        try:
+            # 缓存中的映射在关系变化的事务提交时已经更新，进程内存中的可能还没有收到
+            mapping = Node.get_node_all_asset_ids_mapping_from_cache_or_generate_to_cache(org_id)
+        except Exception as e:
+            logger.error(f'Get node assets mapping error, check all nodes: org_id={org_id} {e}')
+            check_node_assets_amount()
+            return
+
+        nodes = Node.objects.filter(key__in=keys).only('id', 'key', 'assets_amount')
+        to_updates = []
+        for node in nodes:
+            assets_amount = mapping.get_assets_amount(node.key)
+            if node.assets_amount != assets_amount:
+                node.assets_amount = assets_amount
+                to_updates.append(node)
+        Node.objects.bulk_update(to_updates, fields=('assets_amount',))
+        logger.debug(f'Update nodes assets amount: org_id={org_id} '
+                     f'changed={len(node_keys)} updated={len(to_updates)}')
+
+
 def is_query_node_all_assets(request):
     request = request
     query_all_arg = request.query_params.get('all', 'true')
@@ -65,18 +169,6 @@ def get_node(request):
     return node
 
 
-class NodeAssetsInfo:
-    __slots__ = ('key', 'assets_amount', 'assets')
-
-    def __init__(self, key, assets_amount, assets):
-        self.key = key
-        self.assets_amount = assets_amount
-        self.assets = assets
-
-    def __str__(self):
-        return self.key
-
-
 class NodeAssetsUtil:
     def __init__(self, nodes, nodekey_assetsid_mapper):
         """
@@ -86,40 +178,73 @@ class NodeAssetsUtil:
         self.nodes = nodes
         # node_id --> set(asset_id1, asset_id2)
         self.nodekey_assetsid_mapper = nodekey_assetsid_mapper
-        self.nodekey_assetsinfo_mapper = {}
+        self.nodekey_assets_amount_mapper = {}
 
     @timeit
     def generate(self):
-        # 准备排序好的资产信息数据
-        infos = []
-        for node in self.nodes:
-            assets = self.nodekey_assetsid_mapper.get(node.key, set())
-            info = NodeAssetsInfo(key=node.key, assets_amount=0, assets=assets)
-            infos.append(info)
-        infos = sorted(infos, key=lambda i: [int(i) for i in i.key.split(':')])
-        # 这个守卫需要添加一下，避免最后一个无法出栈
-        guarder = NodeAssetsInfo(key='', assets_amount=0, assets=set())
-        infos.append(guarder)
+        """
+        计算每个节点子树中不重复的资产数量，不再逐层合并资产集合:
+
+        * 节点按 key 先序排好，一个节点的子树就是连续的一段 [index, ends[index])
+        * 每个资产在它所在的节点上 +1，再在它相邻(先序)两个节点的最近公共祖先上 -1，
+          这样一个资产对它所有节点的祖先并集中的每个节点恰好贡献 1
+        * 最后自底向上把子节点的计数累加到父节点上，就是子树的资产数量
+
+        节点的父节点取的是 nodes 中最近的祖先节点，与之前的算法一致
+        """
+        keys = sorted({node.key for node in self.nodes}, key=node_key_sort_key)
+        amount = len(keys)
+        parents = [-1] * amount
+        ends = [amount] * amount
 
+        # 先序遍历，计算每个节点的父节点和子树的结束位置
         stack = Stack()
-        for info in infos:
-            # 如果栈顶的不是这个节点的父祖节点，那么可以出栈了，可以计算资产数量了
-            while stack.top and not info.key.startswith(f'{stack.top.key}:'):
-                pop_info = stack.pop()
-                pop_info.assets_amount = len(pop_info.assets)
-                self.nodekey_assetsinfo_mapper[pop_info.key] = pop_info
-                if not stack.top:
+        for index, key in enumerate(keys):
+            while stack.top is not None and not key.startswith(f'{keys[stack.top]}:'):
+                ends[stack.pop()] = index
+            if stack.top is not None:
+                parents[index] = stack.top
+            stack.push(index)
+
+        counts = [0] * amount
+        assets_list = [self.nodekey_assetsid_mapper.get(key) or set() for key in keys]
+
+        # 大部分资产只在一个节点下，先用集合运算找出在多个节点下的资产，只有它们需要找公共祖先
+        seen_asset_ids, multi_node_asset_ids = set(), set()
+        for asset_ids in assets_list:
+            multi_node_asset_ids |= seen_asset_ids & asset_ids
+            seen_asset_ids |= asset_ids
+
+        # 资产 --> 上一次出现的节点位置
+        asset_last_index_mapper = {}
+        for index, asset_ids in enumerate(assets_list):
+            if not asset_ids:
+                continue
+            counts[index] += len(asset_ids)
+            if not multi_node_asset_ids:
+                continue
+            for asset_id in asset_ids & multi_node_asset_ids:
+                last_index = asset_last_index_mapper.get(asset_id)
+                asset_last_index_mapper[asset_id] = index
+                if last_index is None:
                     continue
-                stack.top.assets.update(pop_info.assets)
-            stack.push(info)
+                # 从上一个位置向上找，第一个子树包含当前位置的就是公共祖先
+                ancestor = last_index
+                while ancestor != -1 and ends[ancestor] <= index:
+                    ancestor = parents[ancestor]
+                if ancestor != -1:
+                    counts[ancestor] -= 1
+
+        # 逆先序保证子节点在父节点之前累加完
+        for index in range(amount - 1, -1, -1):
+            parent = parents[index]
+            if parent != -1:
+                counts[parent] += counts[index]
 
-    def get_assets_by_key(self, key):
-        info = self.nodekey_assetsinfo_mapper[key]
-        return info['assets']
+        self.nodekey_assets_amount_mapper = dict(zip(keys, counts))
 
     def get_assets_amount(self, key):
-        info = self.nodekey_assetsinfo_mapper[key]
-        return info.assets_amount
+        return self.nodekey_assets_amount_mapper[key]
 
     @classmethod
     def test_it(cls):
@@ -3,10 +3,14 @@
 from rest_framework.mixins import ListModelMixin, CreateModelMixin
 from django.db.models import F, Value
 from django.db.models.functions import Concat
+from django.utils.decorators import method_decorator
 
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor, IsOrgAdmin
 from common.drf.filters import DatetimeRangeFilter
+from common.drf.pagination import KeysetLimitOffsetPagination
 from common.api import CommonGenericViewSet
+from common.mixins.api import NonAtomicRequestsMixin
+from common.db.router import use_read_replica
 from orgs.mixins.api import OrgGenericViewSet, OrgBulkModelViewSet, OrgRelationMixin
 from orgs.utils import current_org
 from ops.models import CommandExecution
@@ -15,6 +19,7 @@ from .serializers import FTPLogSerializer, UserLoginLogSerializer, CommandExecut
 from .serializers import OperateLogSerializer, PasswordChangeLogSerializer, CommandExecutionHostsRelationSerializer
 
 
+@method_decorator(use_read_replica(), name='list')
 class FTPLogViewSet(CreateModelMixin,
                     ListModelMixin,
                     OrgGenericViewSet):
@@ -28,9 +33,12 @@ class FTPLogViewSet(CreateModelMixin,
     filterset_fields = ['user', 'asset', 'system_user', 'filename']
     search_fields = filterset_fields
     ordering = ['-date_start']
+    pagination_class = KeysetLimitOffsetPagination
+    keyset_pagination_field = 'date_start'
 
 
-class UserLoginLogViewSet(ListModelMixin, CommonGenericViewSet):
+@method_decorator(use_read_replica(), name='list')
+class UserLoginLogViewSet(NonAtomicRequestsMixin, ListModelMixin, CommonGenericViewSet):
     queryset = UserLoginLog.objects.all()
     permission_classes = [IsOrgAdmin | IsOrgAuditor]
     serializer_class = UserLoginLogSerializer
@@ -40,6 +48,8 @@ class UserLoginLogViewSet(ListModelMixin, CommonGenericViewSet):
     ]
     filterset_fields = ['username', 'ip', 'city', 'type', 'status', 'mfa']
     search_fields = ['username', 'ip', 'city']
+    pagination_class = KeysetLimitOffsetPagination
+    keyset_pagination_field = 'datetime'
 
     @staticmethod
     def get_org_members():
@@ -55,7 +65,8 @@ class UserLoginLogViewSet(ListModelMixin, CommonGenericViewSet):
         return queryset
 
 
-class OperateLogViewSet(ListModelMixin, OrgGenericViewSet):
+@method_decorator(use_read_replica(), name='list')
+class OperateLogViewSet(NonAtomicRequestsMixin, ListModelMixin, OrgGenericViewSet):
     model = OperateLog
     serializer_class = OperateLogSerializer
     permission_classes = [IsOrgAdmin | IsOrgAuditor]
@@ -66,9 +77,12 @@ class OperateLogViewSet(ListModelMixin, OrgGenericViewSet):
     filterset_fields = ['user', 'action', 'resource_type', 'resource', 'remote_addr']
     search_fields = ['resource']
     ordering = ['-datetime']
+    pagination_class = KeysetLimitOffsetPagination
+    keyset_pagination_field = 'datetime'
 
 
-class PasswordChangeLogViewSet(ListModelMixin, CommonGenericViewSet):
+@method_decorator(use_read_replica(), name='list')
+class PasswordChangeLogViewSet(NonAtomicRequestsMixin, ListModelMixin, CommonGenericViewSet):
     queryset = PasswordChangeLog.objects.all()
     permission_classes = [IsOrgAdmin | IsOrgAuditor]
     serializer_class = PasswordChangeLogSerializer
@@ -88,7 +102,8 @@ class PasswordChangeLogViewSet(ListModelMixin, CommonGenericViewSet):
         return queryset
 
 
-class CommandExecutionViewSet(ListModelMixin, OrgGenericViewSet):
+@method_decorator(use_read_replica(), name='list')
+class CommandExecutionViewSet(NonAtomicRequestsMixin, ListModelMixin, OrgGenericViewSet):
     model = CommandExecution
     serializer_class = CommandExecutionSerializer
     permission_classes = [IsOrgAdmin | IsOrgAuditor]
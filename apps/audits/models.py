@@ -40,7 +40,7 @@ class FTPLog(OrgModelMixin):
     operate = models.CharField(max_length=16, verbose_name=_("Operate"), choices=OPERATE_CHOICES)
     filename = models.CharField(max_length=1024, verbose_name=_("Filename"))
     is_success = models.BooleanField(default=True, verbose_name=_("Success"))
-    date_start = models.DateTimeField(auto_now_add=True, verbose_name=_('Date start'))
+    date_start = models.DateTimeField(auto_now_add=True, verbose_name=_('Date start'), db_index=True)
 
 
 class OperateLog(OrgModelMixin):
@@ -110,7 +110,7 @@ class UserLoginLog(models.Model):
     mfa = models.SmallIntegerField(default=MFA_UNKNOWN, choices=MFA_CHOICE, verbose_name=_('MFA'))
     reason = models.CharField(default='', max_length=128, blank=True, verbose_name=_('Reason'))
     status = models.BooleanField(max_length=2, default=True, choices=STATUS_CHOICE, verbose_name=_('Status'))
-    datetime = models.DateTimeField(default=timezone.now, verbose_name=_('Date login'))
+    datetime = models.DateTimeField(default=timezone.now, verbose_name=_('Date login'), db_index=True)
     backend = models.CharField(max_length=32, default='', verbose_name=_('Authentication backend'))
 
     @classmethod
@@ -4,6 +4,7 @@ from django.db.models.signals import (
     post_save, m2m_changed, pre_delete
 )
 from django.dispatch import receiver
+from celery.signals import worker_process_shutdown
 from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
@@ -21,6 +22,7 @@ from users.models import User
 from users.signals import post_user_change_password
 from terminal.models import Session, Command
 from .utils import write_login_log
+from .writer import audit_log_writer
 from . import models
 from .models import OperateLog
 from orgs.utils import current_org
@@ -86,15 +88,17 @@ def create_operate_log(action, sender, resource):
     resource_type = sender._meta.verbose_name
     remote_addr = get_request_ip(current_request)
 
+    # 后台线程中没有当前组织，这里先设置好
     data = {
         "user": str(user), 'action': action, 'resource_type': resource_type,
-        'resource': str(resource), 'remote_addr': remote_addr,
+        'resource': str(resource), 'remote_addr': remote_addr, 'org_id': current_org.id,
     }
-    with transaction.atomic():
-        try:
-            models.OperateLog.objects.create(**data)
-        except Exception as e:
-            logger.error("Create operate log error: {}".format(e))
+    write_audit_log(models.OperateLog, data)
+
+
+def write_audit_log(model, data, prepare=None):
+    """ 事务提交后放入队列批量写入，事务回滚的操作不记录日志 """
+    transaction.on_commit(lambda: audit_log_writer.write(model, data, prepare=prepare))
 
 
 M2M_NEED_RECORD = {
@@ -193,7 +197,6 @@ def on_m2m_changed(sender, action, instance, reverse, model, pk_set, **kwargs):
         elif action == 'remove':
             resource_tmpl = resource_tmpl_remove
 
-        to_create = []
         objs = model.objects.filter(pk__in=pk_set)
 
         instance_name = instance._meta.object_name
@@ -207,11 +210,10 @@ def on_m2m_changed(sender, action, instance, reverse, model, pk_set, **kwargs):
                 model_name: str(obj)
             })[:128]  # `resource` 字段只有 128 个字符长 😔
 
-            to_create.append(OperateLog(
+            write_audit_log(OperateLog, dict(
                 user=user, action=action, resource_type=resource_type,
                 resource=resource, remote_addr=remote_addr, org_id=org_id
             ))
-        OperateLog.objects.bulk_create(to_create)
 
 
 @receiver(post_save)
@@ -243,11 +245,16 @@ def on_user_change_password(sender, user=None, **kwargs):
             change_by = str(user)
         else:
             change_by = str(current_request.user)
-    with transaction.atomic():
-        models.PasswordChangeLog.objects.create(
-            user=str(user), change_by=change_by,
-            remote_addr=remote_addr,
-        )
+    write_audit_log(models.PasswordChangeLog, dict(
+        user=str(user), change_by=change_by,
+        remote_addr=remote_addr,
+    ))
+
+
+@worker_process_shutdown.connect
+def on_celery_worker_process_shutdown(sender=None, **kwargs):
+    # celery 子进程退出时不执行 atexit，这里写完队列中的日志
+    audit_log_writer.stop()
 
 
 def on_audits_log_create(sender, instance=None, **kwargs):
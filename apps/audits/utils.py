@@ -25,14 +25,19 @@ def write_content_to_excel(response, header=None, login_logs=None, fields=None):
     return response
 
 
-def write_login_log(*args, **kwargs):
-    from audits.models import UserLoginLog
-
-    ip = kwargs.get('ip') or ''
+def fill_login_log_city(data):
+    ip = data.get('ip') or ''
     if not (ip and validate_ip(ip)):
         ip = ip[:15]
         city = DEFAULT_CITY
     else:
         city = get_ip_city(ip) or DEFAULT_CITY
-    kwargs.update({'ip': ip, 'city': city})
-    UserLoginLog.objects.create(**kwargs)
+    data.update({'ip': ip, 'city': city})
+
+
+def write_login_log(*args, **kwargs):
+    from audits.models import UserLoginLog
+    from audits.signals_handler import write_audit_log
+
+    # 查询 ip 所在城市比较慢，放到后台写入时处理
+    write_audit_log(UserLoginLog, kwargs, prepare=fill_login_log_city)
@@ -0,0 +1,148 @@
+import time
+import queue
+import atexit
+import threading
+from collections import Counter, defaultdict
+
+from django.db.models.signals import post_save
+
+from common.utils import get_logger
+from common.db.utils import safe_db_connection
+
+logger = get_logger(__name__)
+
+__all__ = ['AuditLogWriter', 'audit_log_writer']
+
+
+class AuditLogWriter:
+    """
+    审计日志先放入进程内的队列，后台线程攒够 batch_size 条或者等待 flush_interval 秒后 bulk_create
+
+    - 队列满时(数据库写入跟不上)，在调用的线程中直接写入，不丢日志
+    - 进程退出时等待后台线程写完队列中的日志
+    - bulk_create 不会发送 post_save，写入后补发，syslog 等依赖它
+    """
+
+    def __init__(self, batch_size=200, flush_interval=1, max_queue_size=10000, put_timeout=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.metrics = Counter()
+
+    def start_if_need(self):
+        if self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def write(self, model, data, prepare=None):
+        """
+        :param model: 日志的 model
+        :param data: 创建日志的字段
+        :param prepare: prepare(data) 在后台线程中执行，比较慢的处理(如 ip 查询城市)放到这里
+        """
+        entry = (model, data, prepare)
+        if self.stop_event.is_set():
+            self.write_entries([entry])
+            return
+        self.start_if_need()
+        try:
+            self.queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            self.metrics['sync'] += 1
+            logger.debug('Audit log queue is full, write in current thread')
+            self.write_entries([entry])
+
+    def get_batch(self):
+        entries = []
+        deadline = time.time() + self.flush_interval
+        while len(entries) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                entries.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return entries
+
+    def run(self):
+        while not self.stop_event.is_set() or not self.queue.empty():
+            entries = self.get_batch()
+            if not entries:
+                continue
+            with safe_db_connection():
+                self.write_entries(entries)
+
+    def write_entries(self, entries):
+        model_objs_mapper = defaultdict(list)
+        for model, data, prepare in entries:
+            try:
+                if prepare:
+                    prepare(data)
+                model_objs_mapper[model].append(model(**data))
+            except Exception as e:
+                self.metrics['error'] += 1
+                logger.error(f'Prepare audit log error: {model.__name__} {e}')
+
+        for model, objs in model_objs_mapper.items():
+            try:
+                model.objects.bulk_create(objs, batch_size=self.batch_size)
+            except Exception as e:
+                self.metrics['error'] += len(objs)
+                logger.error(f'Write audit logs error: {model.__name__} count={len(objs)} {e}')
+                continue
+            self.metrics['written'] += len(objs)
+            for obj in objs:
+                post_save.send(model, instance=obj, created=True)
+
+    def flush(self):
+        """ 在当前线程写入队列中的日志 """
+        entries = []
+        while True:
+            try:
+                entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(entries) >= self.batch_size:
+                self.write_entries(entries)
+                entries = []
+        if entries:
+            self.write_entries(entries)
+
+    def stop(self, timeout=10):
+        """ 之后的日志直接写入，等待后台线程写完，还没写完的在当前线程写入 """
+        self.stop_event.set()
+        thread = self.thread
+        if thread and thread.is_alive():
+            thread.join(timeout)
+        self.flush()
+
+    def get_prometheus_metrics_text(self):
+        metrics = {'written': 0, 'sync': 0, 'error': 0}
+        metrics.update(self.metrics)
+        prometheus_metrics = [
+            '## 审计日志写入',
+            '# HELP jumpserver_audit_log_writer_total Audit log writer events of this process',
+            '# TYPE jumpserver_audit_log_writer_total counter',
+        ]
+        for event, amount in sorted(metrics.items()):
+            prometheus_metrics.append(f'jumpserver_audit_log_writer_total{{event="{event}"}} {amount}')
+        prometheus_metrics.extend([
+            '# HELP jumpserver_audit_log_writer_queue_size Audit logs waiting to be written',
+            '# TYPE jumpserver_audit_log_writer_queue_size gauge',
+            f'jumpserver_audit_log_writer_queue_size {self.queue.qsize()}',
+        ])
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+audit_log_writer = AuditLogWriter()
@@ -10,10 +10,40 @@ from django_auth_ldap.config import _LDAPConfig, LDAPSearch, LDAPSearchUnion
 
 from users.utils import construct_user_email
 from common.const import LDAP_AD_ACCOUNT_DISABLE
+from common.utils.connection_pool import connection_pool_registry
 
 logger = _LDAPConfig.get_logger()
 
 
+def get_ldap_auth_connection_pool(backend):
+    """
+    认证使用的连接池，连接创建后以 BIND_DN 绑定;
+    认证时会以用户身份绑定，所以归还的连接都标记为 dirty，下次取出时重新以 BIND_DN 绑定(同时检查连接是否可用)
+    """
+    ldap_settings = backend.settings
+    uri = ldap_settings.SERVER_URI
+    options = tuple(sorted(ldap_settings.CONNECTION_OPTIONS.items()))
+    key = (uri, ldap_settings.BIND_DN, ldap_settings.BIND_PASSWORD, ldap_settings.START_TLS, options)
+
+    def bind(conn):
+        conn.simple_bind_s(ldap_settings.BIND_DN, ldap_settings.BIND_PASSWORD)
+
+    def create():
+        conn = backend.ldap.initialize(uri, bytes_mode=False)
+        for opt, value in ldap_settings.CONNECTION_OPTIONS.items():
+            conn.set_option(opt, value)
+        if ldap_settings.START_TLS:
+            conn.start_tls_s()
+        bind(conn)
+        return conn
+
+    return connection_pool_registry.get_pool(
+        'ldap_auth', key, create=create, reset=bind, close=lambda conn: conn.unbind_s(),
+        max_size=settings.AUTH_LDAP_POOL_SIZE, max_age=settings.AUTH_LDAP_POOL_MAX_AGE,
+        timeout=settings.AUTH_LDAP_CONNECT_TIMEOUT,
+    )
+
+
 class LDAPAuthorizationBackend(LDAPBackend):
     """
     Override this class to override _LDAPUser to LDAPUser
@@ -85,7 +115,10 @@ class LDAPAuthorizationBackend(LDAPBackend):
             logger.info('Authenticate failed: {}'.format(msg))
             return None
         ldap_user = LDAPUser(self, username=username.strip(), request=request)
-        user = self.authenticate_ldap_user(ldap_user, password)
+        try:
+            user = self.authenticate_ldap_user(ldap_user, password)
+        finally:
+            ldap_user.release_connection()
         logger.info('Authenticate user: {}'.format(user))
         return user if self.user_can_authenticate(user) else None
 
@@ -102,18 +135,43 @@ class LDAPAuthorizationBackend(LDAPBackend):
         if not hasattr(user, 'ldap_user') and self.settings.AUTHORIZE_ALL_USERS:
             LDAPUser(self, user=user)  # This sets user.ldap_user
         if hasattr(user, 'ldap_user'):
-            permissions = user.ldap_user.get_group_permissions()
+            try:
+                permissions = user.ldap_user.get_group_permissions()
+            finally:
+                user.ldap_user.release_connection()
         else:
             permissions = set()
         return permissions
 
     def populate_user(self, username):
         ldap_user = LDAPUser(self, username=username)
-        user = ldap_user.populate_user()
+        try:
+            user = ldap_user.populate_user()
+        finally:
+            ldap_user.release_connection()
         return user
 
 
 class LDAPUser(_LDAPUser):
+    _connection_pool = None
+
+    def _get_connection(self):
+        """
+        从连接池中取连接，用完后需要调用 release_connection 归还
+        """
+        if self._connection is None:
+            self._connection_pool = get_ldap_auth_connection_pool(self.backend)
+            self._connection = self._connection_pool.acquire()
+            # 连接池中取出的连接已经以 BIND_DN 绑定
+            self._connection_bound = True
+        return self._connection
+
+    def release_connection(self):
+        if self._connection is None or self._connection_pool is None:
+            return
+        self._connection_pool.release(self._connection, dirty=True)
+        self._connection = None
+        self._connection_bound = False
 
     def _search_for_user_dn_from_ldap_util(self):
         from settings.utils import LDAPServerUtil
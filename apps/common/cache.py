@@ -1,11 +1,10 @@
 import time
 
-from redis import Redis
-
 from common.utils.lock import DistributedLock
 from common.utils import lazyproperty
 from common.utils import get_logger
-from jumpserver.const import CONFIG
+from common.utils.connection import get_redis_client
+from common.db.router import use_primary_db
 
 logger = get_logger(__file__)
 
@@ -58,7 +57,7 @@ class Cache(metaclass=CacheType):
 
     def __init__(self):
         self._data = None
-        self.redis = Redis(host=CONFIG.REDIS_HOST, port=CONFIG.REDIS_PORT, password=CONFIG.REDIS_PASSWORD)
+        self.redis = get_redis_client()
 
     def __getitem__(self, item):
         return self.field_desc_mapper[item]
@@ -130,6 +129,7 @@ class Cache(metaclass=CacheType):
         self.redis.hset(self.key, mapping=data)
         self.load_data_from_db()
 
+    @use_primary_db()
     def compute_values(self, *fields):
         field_objs = []
         for field in fields:
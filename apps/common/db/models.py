@@ -15,7 +15,7 @@ import inspect
 
 from django.db.models import *
 from django.db.models import QuerySet
-from django.db.models.functions import Concat
+from django.db.models.functions import Concat, Substr
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -87,6 +87,14 @@ def concated_display(name1, name2):
     return Concat(F(name1), Value('('), F(name2), Value(')'))
 
 
+def replace_prefix(field_name, old_prefix, new_prefix):
+    """ 用于 update，把字段值开头的 old_prefix 替换成 new_prefix，调用方要保证字段值以 old_prefix 开头 """
+    return Concat(
+        Value(new_prefix), Substr(field_name, len(old_prefix) + 1),
+        output_field=CharField()
+    )
+
+
 def output_as_string(field_name):
     return ExpressionWrapper(F(field_name), output_field=CharField())
 
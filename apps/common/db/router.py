@@ -0,0 +1,130 @@
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from common.local import thread_local
+
+__all__ = [
+    'ReadReplicaRouter', 'db_read_state', 'use_read_replica', 'use_primary_db', 'reset_db_read_state',
+    'is_atomic_request_view', 'set_db_in_atomic_request',
+]
+
+
+def reset_db_read_state():
+    thread_local.db_read_replica = False
+    thread_local.db_read_primary = False
+    thread_local.db_written = False
+    thread_local.db_in_atomic_request = False
+
+
+@contextmanager
+def db_read_state(replica=False, primary=False):
+    """ 中间件、celery 任务开始时设置当前线程的读库状态，结束后清理 """
+    reset_db_read_state()
+    thread_local.db_read_replica = replica
+    thread_local.db_read_primary = primary
+    try:
+        yield
+    finally:
+        reset_db_read_state()
+
+
+def is_atomic_request_view(view_func, using=DEFAULT_DB_ALIAS):
+    """ 视图是否在 ATOMIC_REQUESTS 的事务中执行，与 django 的 `BaseHandler.make_view_atomic` 判断相同 """
+    if not connections[using].settings_dict.get('ATOMIC_REQUESTS'):
+        return False
+    return using not in getattr(view_func, '_non_atomic_requests', set())
+
+
+def set_db_in_atomic_request(in_atomic_request):
+    """ 中间件在视图执行前设置，请求级别的事务由 django 在这之后开启 """
+    thread_local.db_in_atomic_request = in_atomic_request
+
+
+def is_db_written():
+    return bool(getattr(thread_local, 'db_written', False))
+
+
+@contextmanager
+def use_read_replica():
+    """
+    只读的工具方法、接口使用，读从库；
+    当前线程已经写过数据、请求要求读主库(read-your-writes)时，仍然读主库
+    """
+    ori = getattr(thread_local, 'db_read_replica', False)
+    thread_local.db_read_replica = True
+    try:
+        yield
+    finally:
+        thread_local.db_read_replica = ori
+
+
+@contextmanager
+def use_primary_db():
+    """
+    结果会被缓存或者写回数据库的计算(如授权树、权限判定缓存)要读主库，
+    从库的延迟会让旧数据被缓存下来
+    """
+    ori = getattr(thread_local, 'db_read_primary', False)
+    thread_local.db_read_primary = True
+    try:
+        yield
+    finally:
+        thread_local.db_read_primary = ori
+
+
+class ReadReplicaRouter:
+    """
+    settings.DB_READ_REPLICA_ALIASES 中配置了从库时:
+    - 写都在主库，写过之后本线程(本次请求)的读也都在主库
+    - 安全方法的请求、use_read_replica 标记的代码读从库
+    - 显式开启的事务中读主库，读、写在同一个事务里
+    """
+
+    @property
+    def replicas(self):
+        return settings.DB_READ_REPLICA_ALIASES
+
+    @staticmethod
+    def in_explicit_atomic():
+        conn = connections[DEFAULT_DB_ALIAS]
+        if not conn.in_atomic_block:
+            return False
+        if conn.savepoint_ids:
+            return True
+        # ATOMIC_REQUESTS 开启的请求级别的事务不算，NonAtomicRequestsMixin 的视图没有这个事务，
+        # 最外层的事务就是显式开启的
+        return not getattr(thread_local, 'db_in_atomic_request', False)
+
+    def should_read_replica(self):
+        if not self.replicas:
+            return False
+        if not getattr(thread_local, 'db_read_replica', False):
+            return False
+        if getattr(thread_local, 'db_read_primary', False) or is_db_written():
+            return False
+        return not self.in_explicit_atomic()
+
+    def db_for_read(self, model, **hints):
+        # 明确返回主库，否则 django 会使用 instance 所在的库(可能是从库)
+        if self.should_read_replica():
+            return random.choice(self.replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        thread_local.db_written = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 从库是主库的复制，数据相同
+        dbs = {DEFAULT_DB_ALIAS, *self.replicas}
+        if obj1._state.db in dbs and obj2._state.db in dbs:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return None
@@ -1,8 +1,17 @@
+import hashlib
+import threading
+import weakref
+from collections import Counter
 from contextlib import contextmanager
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
 from django.db import connections
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
 
-from common.utils import get_logger
+from common.utils import get_logger, iter_chunks
 
 logger = get_logger(__file__)
 
@@ -44,13 +53,213 @@ def get_objects(model, pks):
     return objs
 
 
-def close_old_connections():
+class DBConnectionMetrics:
+    """
+    本进程的数据库连接统计，连接是线程私有的，创建时记录下来，统计时查看各线程连接的状态
+    """
+
+    def __init__(self):
+        self.wrappers = weakref.WeakSet()
+        self.lock = threading.Lock()
+        # { (alias, event): count }
+        self.metrics = Counter()
+
+    def incr(self, alias, event):
+        with self.lock:
+            self.metrics[(alias, event)] += 1
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        with self.lock:
+            self.wrappers.add(connection)
+        self.incr(connection.alias, 'created')
+
+    def get_metrics(self):
+        with self.lock:
+            wrappers = list(self.wrappers)
+            metrics = Counter(self.metrics)
+        for wrapper in wrappers:
+            if wrapper.connection is None:
+                continue
+            metrics[(wrapper.alias, 'open')] += 1
+            if wrapper.in_atomic_block:
+                metrics[(wrapper.alias, 'in_transaction')] += 1
+        return metrics
+
+    def get_prometheus_metrics_text(self):
+        prometheus_metrics = [
+            '## 数据库连接',
+            '# HELP jumpserver_db_connections Database connections of this process',
+            '# TYPE jumpserver_db_connections gauge',
+        ]
+        for (alias, metric), value in sorted(self.get_metrics().items()):
+            prometheus_metrics.append(f'jumpserver_db_connections{{db="{alias}",metric="{metric}"}} {value}')
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+db_connection_metrics = DBConnectionMetrics()
+
+
+def check_connection_health(conn):
+    """
+    持久连接(CONN_MAX_AGE)复用前检查，数据库重启、超时断开的连接关闭，下次使用时重新连接
+    """
+    if conn.connection is None or conn.in_atomic_block:
+        return
+    db_connection_metrics.incr(conn.alias, 'reused')
+    if not settings.DB_CONN_HEALTH_CHECKS:
+        return
+    if conn.is_usable():
+        return
+    logger.warning(f'Database connection unusable, close it: {conn.alias}')
+    db_connection_metrics.incr(conn.alias, 'unhealthy')
+    conn.close()
+
+
+def close_old_connections(health_check=True):
     for conn in connections.all():
         conn.close_if_unusable_or_obsolete()
+        if health_check:
+            check_connection_health(conn)
 
 
 @contextmanager
 def safe_db_connection():
     close_old_connections()
     yield
-    close_old_connections()
+    close_old_connections(health_check=False)
+
+
+def get_queryset_ordering(queryset):
+    query = queryset.query
+    if query.extra_order_by:
+        return list(query.extra_order_by)
+    if query.order_by:
+        return list(query.order_by)
+    if query.default_ordering:
+        return list(queryset.model._meta.ordering)
+    return []
+
+
+def get_keyset_ordering_field(queryset):
+    """
+    可以按 (字段, pk) 分批的排序字段，返回 (字段名, 是否倒序)；
+    不是简单的单个非空字段(关联字段、表达式、多个字段等)返回 None
+    """
+    model = queryset.model
+    ordering = [o for o in get_queryset_ordering(queryset) if o not in ('pk', '-pk')]
+    if not ordering:
+        return 'pk', False
+    if len(ordering) > 1 or not isinstance(ordering[0], str):
+        return None
+    name = ordering[0]
+    desc = name.startswith('-')
+    name = name.lstrip('-')
+    if name == '?' or LOOKUP_SEP in name:
+        return None
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if not field.concrete or field.null or field.is_relation:
+        return None
+    return field.attname, desc
+
+
+def iter_queryset_chunks(queryset, chunk_size=1000):
+    """
+    保持 queryset 原有的排序分批读取，不会把整个结果集读到内存:
+    - 排序是单个非空字段时按 (字段, pk) 做 keyset 分页:
+      `WHERE (f > 上一批最后的值) OR (f = 值 AND pk > 上一批最后的 pk)`，不像 offset 那样越往后越慢
+    - 其它排序使用 iterator() 分批；iterator() 会忽略 prefetch_related，
+      有 prefetch 时按顺序读出主键，每批再按主键查询(会执行 prefetch)
+    """
+    keyset = get_keyset_ordering_field(queryset)
+    if keyset is None and queryset._prefetch_related_lookups:
+        pks = queryset.values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        for chunk_pks in iter_chunks(pks, chunk_size):
+            objs = {obj.pk: obj for obj in queryset.order_by().filter(pk__in=chunk_pks)}
+            yield [objs[pk] for pk in chunk_pks if pk in objs]
+        return
+    if keyset is None:
+        chunk = []
+        for obj in queryset.iterator(chunk_size=chunk_size):
+            chunk.append(obj)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    name, desc = keyset
+    lookup = 'lt' if desc else 'gt'
+    prefix = '-' if desc else ''
+    if name == 'pk':
+        queryset = queryset.order_by(prefix + 'pk')
+    else:
+        queryset = queryset.order_by(prefix + name, prefix + 'pk')
+
+    last = None
+    while True:
+        chunk_queryset = queryset
+        if last is not None:
+            last_value, last_pk = last
+            pk_q = Q(**{f'pk__{lookup}': last_pk})
+            if name == 'pk':
+                chunk_queryset = queryset.filter(pk_q)
+            else:
+                chunk_queryset = queryset.filter(
+                    Q(**{f'{name}__{lookup}': last_value}) | (Q(**{name: last_value}) & pk_q)
+                )
+        chunk = list(chunk_queryset[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        obj = chunk[-1]
+        last = (getattr(obj, name) if name != 'pk' else obj.pk, obj.pk)
+
+
+def get_table_estimated_rows(model, using):
+    """ 数据库统计信息中的表行数，只是估算值；不支持的数据库返回 None """
+    conn = connections[using]
+    table = model._meta.db_table
+    if conn.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES ' \
+              'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    elif conn.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+    else:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def get_queryset_approximate_count(queryset, ttl=60, exact_threshold=100000):
+    """
+    大表 COUNT(*) 很慢，返回估算值:
+    - 没有过滤条件时使用数据库统计信息，估算值小于 exact_threshold 时精确计数
+    - 有过滤条件时精确计数后缓存 ttl 秒
+    """
+    if not queryset.query.where:
+        estimated = get_table_estimated_rows(queryset.model, queryset.db)
+        if estimated is not None and estimated >= exact_threshold:
+            return estimated
+        return queryset.count()
+
+    try:
+        sql = str(queryset.order_by().query)
+    except EmptyResultSet:
+        return 0
+    digest = hashlib.md5(f'{queryset.db}:{sql}'.encode()).hexdigest()
+    key = f'QUERYSET_APPROXIMATE_COUNT_{digest}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, ttl)
+    return count
@@ -2,7 +2,7 @@ from rest_framework.viewsets import GenericViewSet, ModelViewSet, ReadOnlyModelV
 from rest_framework_bulk import BulkModelViewSet
 
 from ..mixins.api import (
-    RelationMixin, AllowBulkDestroyMixin, CommonMixin
+    RelationMixin, AllowBulkDestroyMixin, CommonMixin, StreamExportMixin
 )
 
 
@@ -14,20 +14,21 @@ class JMSViewSet(CommonMixin, ViewSet):
     pass
 
 
-class JMSModelViewSet(CommonMixin, ModelViewSet):
+class JMSModelViewSet(CommonMixin, StreamExportMixin, ModelViewSet):
     pass
 
 
-class JMSReadOnlyModelViewSet(CommonMixin, ReadOnlyModelViewSet):
+class JMSReadOnlyModelViewSet(CommonMixin, StreamExportMixin, ReadOnlyModelViewSet):
     pass
 
 
-class JMSBulkModelViewSet(CommonMixin, AllowBulkDestroyMixin, BulkModelViewSet):
+class JMSBulkModelViewSet(CommonMixin, AllowBulkDestroyMixin, StreamExportMixin, BulkModelViewSet):
     pass
 
 
 class JMSBulkRelationModelViewSet(CommonMixin,
                                   RelationMixin,
                                   AllowBulkDestroyMixin,
+                                  StreamExportMixin,
                                   BulkModelViewSet):
     pass
@@ -0,0 +1,168 @@
+import json
+import base64
+import hashlib
+import datetime
+
+from django.core.cache import cache
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+from common.utils import get_logger
+from common.db.utils import get_queryset_approximate_count
+from orgs.utils import get_current_org_id
+
+logger = get_logger(__name__)
+
+__all__ = ['KeysetLimitOffsetPagination']
+
+
+class KeysetLimitOffsetPagination(LimitOffsetPagination):
+    """
+    参数和返回与 LimitOffsetPagination 相同(limit、offset; count、next、previous、results)，
+    用于数据量很大，按时间倒序查看的日志、会话等:
+
+    - 视图设置 `keyset_pagination_field`(如 date_start)，按它倒序排序时，next 链接带上 cursor，
+      下一页使用 `WHERE (date_start, id) < (上一页最后一条)`，不再 OFFSET 越往后越慢；
+      页面只传 offset 时，记住每一页最后一条，连续翻到下一页(offset 正好接上)也使用 cursor，
+      直接跳到其它页时仍然使用 OFFSET
+    - count 是估算值，没有过滤条件时使用数据库的统计信息，否则缓存一段时间；
+      `?exact_count=1` 时精确计数
+    """
+    cursor_query_param = 'cursor'
+    exact_count_query_param = 'exact_count'
+    count_cache_ttl = 60
+    seek_cache_ttl = 300
+
+    keyset_field = None
+    has_next = False
+    last_obj = None
+    request = None
+
+    def get_keyset_field(self, queryset, view):
+        field = getattr(view, 'keyset_pagination_field', None)
+        if not field or not isinstance(queryset, QuerySet):
+            return None
+        if queryset._fields or not queryset.query.can_filter():
+            return None
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        # 用户选择了其它排序，只能使用 OFFSET
+        if ordering and ordering[0] != f'-{field}':
+            return None
+        return field
+
+    def get_count(self, queryset):
+        exact = self.request.query_params.get(self.exact_count_query_param) in ('1', 'true')
+        if exact or not isinstance(queryset, QuerySet):
+            return super().get_count(queryset)
+        return get_queryset_approximate_count(queryset, ttl=self.count_cache_ttl)
+
+    @staticmethod
+    def encode_cursor(value, pk):
+        if isinstance(value, datetime.datetime):
+            data = {'dt': value.isoformat(), 'pk': str(pk)}
+        else:
+            data = {'v': value, 'pk': str(pk)}
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            if 'dt' in data:
+                value = parse_datetime(data['dt'])
+            else:
+                value = data['v']
+            pk = data['pk']
+        except (ValueError, TypeError, KeyError) as e:
+            logger.debug(f'Invalid pagination cursor: {cursor} {e}')
+            return None
+        if value is None:
+            return None
+        return value, pk
+
+    def get_seek_cache_key(self, offset):
+        # 同一用户、同一组织、同样的过滤条件，上一页结束的位置
+        request = self.request
+        params = sorted(
+            (k, v) for k, v in request.query_params.lists()
+            if k not in (self.offset_query_param, self.cursor_query_param)
+        )
+        data = json.dumps([request.path, str(request.user.id), str(get_current_org_id()), params])
+        digest = hashlib.md5(data.encode()).hexdigest()
+        return f'pagination.keyset.seek.{digest}.{offset}'
+
+    def get_cached_cursor(self, offset):
+        if not offset:
+            return None
+        cursor = cache.get(self.get_seek_cache_key(offset))
+        return self.decode_cursor(cursor) if cursor else None
+
+    def cache_next_cursor(self, cursor):
+        key = self.get_seek_cache_key(self.offset + self.limit)
+        cache.set(key, cursor, self.seek_cache_ttl)
+
+    def get_next_cursor(self):
+        value = getattr(self.last_obj, self.keyset_field)
+        return self.encode_cursor(value, self.last_obj.pk)
+
+    def filter_after_cursor(self, queryset, cursor):
+        value, pk = cursor
+        field = self.keyset_field
+        q = Q(**{f'{field}__lt': value}) | Q(**{field: value, 'pk__lt': pk})
+        return queryset.filter(q)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        if not isinstance(queryset, QuerySet):
+            # 列表、ES 等，与 LimitOffsetPagination 相同
+            self.has_next = None
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.count = self.get_count(queryset)
+        self.keyset_field = self.get_keyset_field(queryset, view)
+
+        cursor = None
+        if self.keyset_field:
+            queryset = queryset.order_by(f'-{self.keyset_field}', '-pk')
+            cursor = request.query_params.get(self.cursor_query_param)
+            cursor = self.decode_cursor(cursor) if cursor else self.get_cached_cursor(self.offset)
+        if cursor:
+            queryset = self.filter_after_cursor(queryset, cursor)
+            start = 0
+        else:
+            start = self.offset
+        # 多取一条判断是否有下一页，count 是估算值不能用来判断
+        page = list(queryset[start:start + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        self.last_obj = page[-1] if page else None
+        if self.keyset_field and self.has_next:
+            self.cache_next_cursor(self.get_next_cursor())
+        # 估算值比实际少时，至少包含已经看到的数据
+        self.count = max(self.count, self.offset + len(page) + int(self.has_next))
+        return page
+
+    def get_next_link(self):
+        if self.has_next is None:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        url = replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+        if not self.keyset_field:
+            return remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.get_next_cursor())
+
+    def get_previous_link(self):
+        link = super().get_previous_link()
+        if link:
+            # 上一页使用 OFFSET
+            link = remove_query_param(link, self.cursor_query_param)
+        return link
@@ -1,9 +1,11 @@
 import abc
 from datetime import datetime
+from django.http import StreamingHttpResponse
 from rest_framework.renderers import BaseRenderer
 from rest_framework.utils import encoders, json
 
 from common.utils import get_logger
+from common.db.utils import iter_queryset_chunks
 
 logger = get_logger(__file__)
 
@@ -12,6 +14,9 @@ class BaseFileRenderer(BaseRenderer):
     # 渲染模版标识, 导入、导出、更新模版: ['import', 'update', 'export']
     template = 'export'
     serializer = None
+    # 流式导出时每批读取、序列化的数量
+    stream_chunk_size = 1000
+    stream_error_message = 'Export error, the file is incomplete!'
 
     @staticmethod
     def _check_validation_data(data):
@@ -63,9 +68,12 @@ class BaseFileRenderer(BaseRenderer):
         else:
             # 限制数据数量
             results = results[:10000]
+        return self.to_json_data(results)
+
+    @staticmethod
+    def to_json_data(data):
         # 会将一些 UUID 字段转化为 string
-        results = json.loads(json.dumps(results, cls=encoders.JSONEncoder))
-        return results
+        return json.loads(json.dumps(data, cls=encoders.JSONEncoder))
 
     @staticmethod
     def generate_rows(data, render_fields):
@@ -96,6 +104,50 @@ class BaseFileRenderer(BaseRenderer):
     def get_rendered_value(self):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def iter_stream_content(self, column_titles, rows):
+        """ 边生成行边输出文件内容 """
+        raise NotImplementedError
+
+    def iter_queryset_rows(self, view, queryset, rendered_fields):
+        for objs in iter_queryset_chunks(queryset, self.stream_chunk_size):
+            data = view.get_serializer(objs, many=True).data
+            data = self.to_json_data(data)
+            yield from self.generate_rows(data, rendered_fields)
+
+    def render_stream(self, view, queryset):
+        """
+        导出 queryset 的全部数据，保持原有排序分批序列化，写入 StreamingHttpResponse，
+        内存占用与数据量无关
+        """
+        self.template = 'export'
+        self.serializer = view.get_serializer()
+        rendered_fields = self.get_rendered_fields()
+        column_titles = self.get_column_titles(rendered_fields)
+        rows = self.iter_queryset_rows(view, queryset, rendered_fields)
+        content = self.iter_stream_content_safe(column_titles, rows)
+        response = StreamingHttpResponse(content, content_type=self.media_type)
+        self.set_response_disposition(response)
+        return response
+
+    def get_stream_error_marker(self):
+        """ 导出出错时追加到已输出内容后面的错误标记，格式不支持时返回空 """
+        return b''
+
+    def iter_stream_content_safe(self, column_titles, rows):
+        """
+        已经开始输出，不能再修改状态码: 写入错误标记后重新抛出异常，
+        服务器中断响应，客户端不会把不完整的文件当作下载成功
+        """
+        try:
+            yield from self.iter_stream_content(column_titles, rows)
+        except Exception as e:
+            logger.error(f'Stream render error: {self.format} {e}', exc_info=True)
+            marker = self.get_stream_error_marker()
+            if marker:
+                yield marker
+            raise
+
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if data is None:
             return bytes()
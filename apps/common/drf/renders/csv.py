@@ -28,3 +28,25 @@ class CSVFileRenderer(BaseFileRenderer):
     def get_rendered_value(self):
         value = self.buffer.getvalue()
         return value
+
+    def iter_stream_content(self, column_titles, rows):
+        self.initial_writer()
+        self.write_column_titles(column_titles)
+        for i, row in enumerate(rows, 1):
+            self.write_row(row)
+            if i % self.stream_chunk_size == 0:
+                yield self.pop_buffer_value()
+        yield self.pop_buffer_value()
+
+    def get_stream_error_marker(self):
+        # 最后一行是错误信息，之前还没输出的行一起输出
+        if self.writer is None:
+            return b''
+        self.write_row([self.stream_error_message])
+        return self.pop_buffer_value()
+
+    def pop_buffer_value(self):
+        value = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return value
@@ -1,3 +1,6 @@
+import tempfile
+import itertools
+
 from openpyxl import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
@@ -12,6 +15,7 @@ class ExcelFileRenderer(BaseFileRenderer):
     wb = None
     ws = None
     row_count = 0
+    stream_read_size = 64 * 1024
 
     def initial_writer(self):
         self.wb = Workbook()
@@ -26,6 +30,24 @@ class ExcelFileRenderer(BaseFileRenderer):
             cell_value = ILLEGAL_CHARACTERS_RE.sub(r'', cell_value)
             self.ws.cell(row=self.row_count, column=column_count, value=cell_value)
 
+    def iter_stream_content(self, column_titles, rows):
+        """
+        xlsx 是 zip 格式，需要写完才能输出；write_only 模式下行直接写到临时文件，
+        不在内存中保留所有单元格，写完后分块输出临时文件
+        """
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row in itertools.chain([column_titles], rows):
+            ws.append([ILLEGAL_CHARACTERS_RE.sub(r'', value) for value in row])
+        with tempfile.TemporaryFile() as f:
+            wb.save(f)
+            f.seek(0)
+            while True:
+                data = f.read(self.stream_read_size)
+                if not data:
+                    break
+                yield data
+
     def get_rendered_value(self):
         value = save_virtual_workbook(self.wb)
         return value
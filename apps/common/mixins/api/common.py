@@ -4,6 +4,7 @@ from typing import Callable
 from rest_framework.response import Response
 from collections import defaultdict
 
+from django.db import transaction
 from django.db.models.signals import m2m_changed
 
 from .serializer import SerializerMixin
@@ -13,7 +14,8 @@ from .queryset import QuerySetMixin
 
 
 __all__ = [
-    'CommonApiMixin', 'PaginatedResponseMixin', 'RelationMixin', 'CommonMixin'
+    'CommonApiMixin', 'PaginatedResponseMixin', 'RelationMixin', 'CommonMixin',
+    'NonAtomicRequestsMixin',
 ]
 
 
@@ -82,6 +84,17 @@ class RelationMixin:
         self.send_m2m_changed_signal(instance, 'post_remove')
 
 
+class NonAtomicRequestsMixin:
+    """
+    只读的视图不在请求级别的事务(ATOMIC_REQUESTS)中执行，不用每次请求都开启、提交事务;
+    需要放在 APIView、ViewSet 前面
+    """
+    @classmethod
+    def as_view(cls, *args, **kwargs):
+        view = super().as_view(*args, **kwargs)
+        return transaction.non_atomic_requests(view)
+
+
 class CommonApiMixin(SerializerMixin, ExtraFilterFieldsMixin, RenderToJsonMixin):
     pass
 
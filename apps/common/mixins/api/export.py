@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+from django.db.models import QuerySet
+
+from common.drf.renders.base import BaseFileRenderer
+
+__all__ = ['StreamExportMixin']
+
+
+class StreamExportMixin:
+    """
+    list 导出 csv、xlsx 时，不分页、不限数量，由 renderer 分批读取 queryset 流式输出
+    路由根据是否有 list 方法生成路由，所以只能用在有 list 的 ViewSet 上
+    """
+    def is_stream_export(self):
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        if not isinstance(renderer, BaseFileRenderer):
+            return False
+        return self.request.query_params.get('template', 'export') == 'export'
+
+    @staticmethod
+    def can_stream_queryset(queryset):
+        # 按主键分批需要可以过滤、排序的 model queryset
+        if not isinstance(queryset, QuerySet) or queryset._fields:
+            return False
+        return queryset.query.can_filter()
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_stream_export():
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        if not self.can_stream_queryset(queryset):
+            return super().list(request, *args, **kwargs)
+        return request.accepted_renderer.render_stream(self, queryset)
@@ -5,12 +5,16 @@ import os
 import logging
 from collections import defaultdict
 from django.conf import settings
-from django.core.signals import request_finished
-from django.db import connection
+from django.core.signals import request_finished, request_started
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from celery.signals import task_prerun
 
 from jumpserver.utils import get_current_request
 
 from .local import thread_local
+from .db.router import reset_db_read_state
+from .db.utils import db_connection_metrics, check_connection_health, close_old_connections
 
 pattern = re.compile(r'FROM `(\w+)`')
 logger = logging.getLogger("jumpserver.common")
@@ -70,3 +74,26 @@ if settings.DEBUG and DEBUG_DB:
     request_finished.connect(on_request_finished_logging_db_query)
 else:
     request_finished.connect(on_request_finished_release_local)
+
+
+def on_celery_task_prerun_reset_db_read_state(sender=None, **kwargs):
+    # worker 线程复用，上一个任务写过数据的状态不影响这个任务读从库
+    reset_db_read_state()
+
+
+task_prerun.connect(on_celery_task_prerun_reset_db_read_state)
+
+
+def on_request_started_check_db_connections(sender, **kwargs):
+    # django 已经关闭了过期的连接，这里检查复用的持久连接是否可用
+    for conn in connections.all():
+        check_connection_health(conn)
+
+
+def on_celery_task_prerun_check_db_connections(sender=None, **kwargs):
+    close_old_connections()
+
+
+connection_created.connect(db_connection_metrics.on_connection_created)
+request_started.connect(on_request_started_check_db_connections)
+task_prerun.connect(on_celery_task_prerun_check_db_connections)
@@ -0,0 +1,153 @@
+import threading
+import time
+
+from common.utils.connection_pool import ConnectionPool, ConnectionPoolTimeout
+
+
+class FakeLDAPConnection:
+    """
+    代替 LDAP 连接的测试替身，记录绑定次数，可以模拟连接断开
+    """
+    created = 0
+
+    def __init__(self):
+        FakeLDAPConnection.created += 1
+        self.bind_count = 0
+        self.closed = False
+        self.broken = False
+
+    def simple_bind_s(self, who='', cred=''):
+        if self.broken or self.closed:
+            raise ConnectionError('Server down')
+        self.bind_count += 1
+
+    def unbind_s(self):
+        self.closed = True
+
+
+def create_fake_connection():
+    conn = FakeLDAPConnection()
+    conn.simple_bind_s()
+    return conn
+
+
+def get_pool(**kwargs):
+    kwargs.setdefault('max_size', 2)
+    kwargs.setdefault('timeout', 0.2)
+    return ConnectionPool(
+        'test', create=create_fake_connection,
+        reset=lambda conn: conn.simple_bind_s(),
+        check=lambda conn: not conn.broken,
+        close=lambda conn: conn.unbind_s(), **kwargs
+    )
+
+
+def test_reuse_connection():
+    pool = get_pool()
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        pass
+    assert conn1 is conn2
+    assert pool.size == 1
+    assert pool.get_metrics()['reused'] == 1
+
+
+def test_reset_dirty_connection():
+    pool = get_pool()
+    with pool.connection(dirty=True) as conn:
+        assert conn.bind_count == 1
+    with pool.connection() as conn:
+        assert conn.bind_count == 2
+
+
+def test_discard_broken_connection_on_reset():
+    pool = get_pool()
+    with pool.connection(dirty=True) as conn1:
+        conn1.broken = True
+    with pool.connection() as conn2:
+        pass
+    assert conn1 is not conn2
+    assert conn1.closed
+    assert pool.get_metrics()['discarded_unhealthy'] == 1
+
+
+def test_discard_connection_on_error():
+    pool = get_pool()
+    try:
+        with pool.connection() as conn1:
+            raise ValueError()
+    except ValueError:
+        pass
+    assert conn1.closed
+    assert pool.size == 0
+
+
+def test_check_idle_connection():
+    pool = get_pool(check_interval=0)
+    with pool.connection() as conn1:
+        conn1.broken = True
+    time.sleep(0.01)
+    with pool.connection() as conn2:
+        pass
+    assert conn1 is not conn2
+
+
+def test_max_age():
+    pool = get_pool(max_age=0)
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        pass
+    assert conn1 is not conn2
+    assert conn1.closed
+
+
+def test_timeout_when_exhausted():
+    pool = get_pool(max_size=1)
+    conn = pool.acquire()
+    try:
+        pool.acquire()
+    except ConnectionPoolTimeout:
+        pass
+    else:
+        assert False, 'Should timeout'
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_release_in_generator():
+    pool = get_pool()
+
+    def iter_values():
+        with pool.connection():
+            yield 1
+            yield 2
+
+    values = iter_values()
+    next(values)
+    values.close()
+    assert pool.get_metrics()['in_use'] == 0
+    assert pool.idle_size == 1
+
+
+def test_concurrent_acquire():
+    pool = get_pool(max_size=3, timeout=5)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(50):
+                with pool.connection(dirty=True):
+                    time.sleep(0.001)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert pool.size <= 3
+    assert pool.get_metrics()['created'] <= 3
@@ -0,0 +1,64 @@
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from common.db import router
+from common.db.router import (
+    ReadReplicaRouter, db_read_state, is_atomic_request_view, set_db_in_atomic_request
+)
+
+
+class FakeConnection:
+    def __init__(self, in_atomic_block=False, savepoint_ids=None, atomic_requests=True):
+        self.in_atomic_block = in_atomic_block
+        self.savepoint_ids = savepoint_ids or []
+        self.settings_dict = {'ATOMIC_REQUESTS': atomic_requests}
+
+
+def use_connection(monkeypatch, conn):
+    monkeypatch.setattr(router, 'connections', {DEFAULT_DB_ALIAS: conn})
+    monkeypatch.setattr(ReadReplicaRouter, 'replicas', ['replica'])
+
+
+def view(request):
+    pass
+
+
+def test_is_atomic_request_view(monkeypatch):
+    use_connection(monkeypatch, FakeConnection())
+    assert is_atomic_request_view(view)
+    assert not is_atomic_request_view(transaction.non_atomic_requests(lambda request: None))
+
+    use_connection(monkeypatch, FakeConnection(atomic_requests=False))
+    assert not is_atomic_request_view(view)
+
+
+def test_read_replica_in_atomic_request(monkeypatch):
+    # ATOMIC_REQUESTS 的事务中读从库
+    use_connection(monkeypatch, FakeConnection(in_atomic_block=True))
+    with db_read_state(replica=True):
+        set_db_in_atomic_request(True)
+        assert ReadReplicaRouter().db_for_read(None) == 'replica'
+
+
+def test_read_primary_in_explicit_atomic(monkeypatch):
+    conn = FakeConnection(in_atomic_block=True, savepoint_ids=['s1'])
+    use_connection(monkeypatch, conn)
+    with db_read_state(replica=True):
+        set_db_in_atomic_request(True)
+        assert ReadReplicaRouter().db_for_read(None) == DEFAULT_DB_ALIAS
+
+        # NonAtomicRequestsMixin 的视图没有请求级别的事务，最外层的事务是显式开启的
+        conn.savepoint_ids = []
+        set_db_in_atomic_request(False)
+        assert ReadReplicaRouter().db_for_read(None) == DEFAULT_DB_ALIAS
+
+        conn.in_atomic_block = False
+        assert ReadReplicaRouter().db_for_read(None) == 'replica'
+
+
+def test_read_primary_after_write(monkeypatch):
+    use_connection(monkeypatch, FakeConnection())
+    with db_read_state(replica=True):
+        ReadReplicaRouter().db_for_write(None)
+        assert ReadReplicaRouter().db_for_read(None) == DEFAULT_DB_ALIAS
+    with db_read_state(replica=True, primary=True):
+        assert ReadReplicaRouter().db_for_read(None) == DEFAULT_DB_ALIAS
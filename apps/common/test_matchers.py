@@ -0,0 +1,128 @@
+import random
+from datetime import datetime, timedelta
+from ipaddress import ip_address, ip_network
+
+from common.utils.ip import (
+    IPGroupMatcher, contains_ip, is_ip_address, is_ip_network, is_ip_segment, in_ip_segment
+)
+from common.utils.time_period import TimePeriodMatcher
+
+
+def contains_ip_one_by_one(ip, ip_group):
+    """ 之前的实现: 逐个解析、比较 """
+    if '*' in ip_group:
+        return True
+
+    for _ip in ip_group:
+        if is_ip_address(_ip):
+            if ip == _ip:
+                return True
+        elif is_ip_network(_ip) and is_ip_address(ip):
+            if ip_address(ip) in ip_network(_ip):
+                return True
+        elif is_ip_segment(_ip) and is_ip_address(ip):
+            if in_ip_segment(ip, _ip):
+                return True
+        else:
+            if ip == _ip:
+                return True
+    return False
+
+
+def contains_time_period_one_by_one(time_periods, now):
+    """ 之前的实现，当前时间作为参数传入 """
+    if not time_periods:
+        return False
+
+    current_time = now.strftime('%H:%M')
+    today_time_period = next(filter(lambda x: str(x['id']) == now.strftime("%w"), time_periods))
+    today_time_period = today_time_period['value']
+    if not today_time_period:
+        return False
+
+    for time in today_time_period.split('、'):
+        start, end = time.split('~')
+        end = "24:00" if end == "00:00" else end
+        if start <= current_time <= end:
+            return True
+    return False
+
+
+IP_GROUPS = [
+    [],
+    ['*'],
+    ['192.168.10.1'],
+    ['192.168.1.0/24', '10.1.1.1-10.1.1.20'],
+    ['10.1.1.20-10.1.1.1', '10.1.1.15-10.1.1.30', '10.1.1.31'],
+    ['172.16.0.0/12', '172.16.5.0/24', 'jumpserver.example.com'],
+    ['2001:db8:2de::e13', '2001:db8:1a:1110::/64', '192.168.0.0/16'],
+    ['0.0.0.0/0'],
+]
+
+IPS = [
+    '192.168.10.1', '192.168.10.2', '192.168.1.0', '192.168.1.255', '192.168.2.0', '10.1.1.0',
+    '10.1.1.1', '10.1.1.20', '10.1.1.21', '10.1.1.30', '10.1.1.31', '10.1.1.32', '172.31.255.255',
+    '172.32.0.0', 'jumpserver.example.com', 'example.com', '2001:db8:2de::e13', '2001:db8:2de::e14',
+    '2001:db8:1a:1110::1', '2001:db8:1a:1111::1', '::1', '127.0.0.1', '', 'not-an-ip',
+]
+
+
+def test_ip_group_matcher_same_as_one_by_one():
+    for ip_group in IP_GROUPS:
+        matcher = IPGroupMatcher(ip_group)
+        for ip in IPS:
+            expected = contains_ip_one_by_one(ip, ip_group)
+            assert matcher.contains(ip) == expected, (ip_group, ip)
+            assert contains_ip(ip, ip_group) == expected, (ip_group, ip)
+
+
+def test_ip_group_matcher_random():
+    rand = random.Random(0)
+
+    def random_ip():
+        return '10.0.{}.{}'.format(rand.randint(0, 3), rand.randint(0, 255))
+
+    for _ in range(200):
+        ip_group = []
+        for __ in range(rand.randint(1, 6)):
+            kind = rand.randint(0, 2)
+            if kind == 0:
+                ip_group.append(random_ip())
+            elif kind == 1:
+                ip_group.append('10.0.{}.0/{}'.format(rand.randint(0, 3), rand.choice([22, 24, 26, 30])))
+            else:
+                ip_group.append('{}-{}'.format(random_ip(), random_ip()))
+        # 网段的主机位不为 0 时不是合法的网段，两种实现都当作普通字符串
+        matcher = IPGroupMatcher(ip_group)
+        for __ in range(50):
+            ip = random_ip()
+            assert matcher.contains(ip) == contains_ip_one_by_one(ip, ip_group), (ip_group, ip)
+
+
+def get_time_periods(values):
+    return [{'id': i, 'value': values.get(i, '')} for i in range(7)]
+
+
+TIME_PERIODS = [
+    get_time_periods({}),
+    get_time_periods({i: '00:00~00:00' for i in range(7)}),
+    get_time_periods({1: '00:00~07:30、10:00~13:00', 3: '09:00~18:00'}),
+    get_time_periods({0: '23:59~00:00', 2: '07:30~07:30', 4: '13:00~10:00', 6: '00:00~00:01'}),
+    get_time_periods({5: '08:00~12:00、11:00~14:30、18:00~00:00'}),
+]
+
+
+def test_time_period_matcher_same_as_one_by_one():
+    # 2021-12-05 是星期日，覆盖一周中每一天的每一分钟
+    start = datetime(2021, 12, 5)
+    for time_periods in TIME_PERIODS:
+        matcher = TimePeriodMatcher(time_periods)
+        for minute in range(7 * 24 * 60):
+            now = start + timedelta(minutes=minute, seconds=30)
+            expected = contains_time_period_one_by_one(time_periods, now)
+            assert matcher.contains(now) == expected, (time_periods, now)
+
+
+def test_time_period_matcher_empty():
+    assert not TimePeriodMatcher([]).contains(datetime(2021, 12, 5))
+    assert not TimePeriodMatcher(None).contains(datetime(2021, 12, 5))
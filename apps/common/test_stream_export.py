@@ -0,0 +1,49 @@
+import pytest
+from django.test import TestCase
+
+from common.db.utils import iter_queryset_chunks
+from common.drf.renders.csv import CSVFileRenderer
+from users.models import User
+
+
+def test_csv_stream_error_marker():
+    renderer = CSVFileRenderer()
+
+    def iter_rows():
+        yield ['a1', 'b1']
+        yield ['a2', 'b2']
+        raise ValueError('Database gone away')
+
+    chunks = []
+    with pytest.raises(ValueError):
+        for chunk in renderer.iter_stream_content_safe(['A', 'B'], iter_rows()):
+            chunks.append(chunk)
+    lines = b''.join(chunks).decode('utf-8-sig').splitlines()
+    assert lines == ['A,B', 'a1,b1', 'a2,b2', renderer.stream_error_message]
+
+
+class IterQuerysetChunksTestCase(TestCase):
+    def setUp(self):
+        for i in range(7):
+            User.objects.create(
+                username=f'chunk_test_user_{i}', name=f'chunk_test_{i % 3}',
+                email=f'chunk_test_user_{i}@example.com'
+            )
+        self.queryset = User.objects.filter(username__startswith='chunk_test_user_')
+
+    def assert_same_as_queryset(self, queryset):
+        objs = [obj for chunk in iter_queryset_chunks(queryset, chunk_size=3) for obj in chunk]
+        self.assertEqual(objs, list(queryset))
+        return objs
+
+    def test_keyset_ordering(self):
+        self.assert_same_as_queryset(self.queryset.order_by('-username'))
+
+    def test_other_ordering(self):
+        self.assert_same_as_queryset(self.queryset.order_by('name', '-username'))
+
+    def test_other_ordering_with_prefetch(self):
+        queryset = self.queryset.order_by('name', '-username').prefetch_related('groups')
+        objs = self.assert_same_as_queryset(queryset)
+        for obj in objs:
+            self.assertIn('groups', obj._prefetched_objects_cache)
@@ -222,6 +222,18 @@ def group_obj_by_count(objs, count=50):
     return objs_grouped
 
 
+def iter_chunks(iterable, count=50):
+    """ 与 group_obj_by_count 相同，但可以是生成器，每次只保留一组 """
+    chunk = []
+    for obj in iterable:
+        chunk.append(obj)
+        if len(chunk) >= count:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def dict_get_any(d, keys):
     for key in keys:
         value = d.get(key)
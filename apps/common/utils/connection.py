@@ -1,22 +1,132 @@
 import json
+import threading
+from urllib.parse import urlparse
 
 import redis
-from django.conf import settings
+from redis.sentinel import Sentinel
+from django_redis.pool import ConnectionFactory
 
 from common.db.utils import safe_db_connection
 from common.utils import get_logger
+from jumpserver.const import CONFIG
 
 logger = get_logger(__name__)
 
 
-def get_redis_client(db):
-    rc = redis.StrictRedis(
-        host=settings.REDIS_HOST,
-        port=settings.REDIS_PORT,
-        password=settings.REDIS_PASSWORD,
-        db=db
-    )
-    return rc
+class RedisClientRegistry:
+    """
+    进程内共享的 redis 客户端，每个 db 一个连接池，
+    锁、缓存、订阅等都从这里取客户端，而不是每次新建连接
+
+    redis-py 的连接池在 fork 之后会自动重建，所以不用担心多进程共用连接
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._sentinel = None
+
+    @staticmethod
+    def get_sentinel_hosts():
+        return CONFIG.get_redis_sentinel_hosts()
+
+    @staticmethod
+    def get_ssl_kwargs():
+        return CONFIG.get_redis_ssl_kwargs()
+
+    def get_connection_kwargs(self):
+        kwargs = {
+            'password': CONFIG.REDIS_PASSWORD or None,
+            'max_connections': CONFIG.REDIS_MAX_CONNECTIONS or None,
+            'health_check_interval': 30,
+        }
+        kwargs.update(self.get_ssl_kwargs())
+        return kwargs
+
+    def get_sentinel(self):
+        if self._sentinel is None:
+            sentinel_kwargs = {
+                'password': CONFIG.REDIS_SENTINEL_PASSWORD or None,
+                'socket_timeout': CONFIG.REDIS_SENTINEL_SOCKET_TIMEOUT,
+            }
+            self._sentinel = Sentinel(
+                self.get_sentinel_hosts(), sentinel_kwargs=sentinel_kwargs,
+                socket_timeout=CONFIG.REDIS_SENTINEL_SOCKET_TIMEOUT
+            )
+        return self._sentinel
+
+    def get_master_address(self):
+        """ 当前的 master 地址，不能使用 redis-py 客户端的地方(如 websocket)使用 """
+        if self.get_sentinel_hosts():
+            return self.get_sentinel().discover_master(CONFIG.REDIS_SENTINEL_SERVICE_NAME)
+        return CONFIG.REDIS_HOST, CONFIG.REDIS_PORT
+
+    def create_client(self, db, **kwargs):
+        kwargs = {**self.get_connection_kwargs(), **kwargs}
+        if self.get_sentinel_hosts():
+            sentinel = self.get_sentinel()
+            return sentinel.master_for(CONFIG.REDIS_SENTINEL_SERVICE_NAME, db=db, **kwargs)
+        return redis.Redis(host=CONFIG.REDIS_HOST, port=CONFIG.REDIS_PORT, db=db, **kwargs)
+
+    def get_client(self, db=0):
+        client = self._clients.get(db)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(db)
+            if client is None:
+                client = self.create_client(db)
+                self._clients[db] = client
+        return client
+
+    def get_pool_metrics(self):
+        """
+        :return: {db: {'created': x, 'in_use': x, 'available': x, 'max': x}}
+        """
+        metrics = {}
+        for db, client in list(self._clients.items()):
+            pool = client.connection_pool
+            available = len(pool._available_connections)
+            in_use = len(pool._in_use_connections)
+            metrics[db] = {
+                'created': pool._created_connections,
+                'in_use': in_use,
+                'available': available,
+                'max': pool.max_connections,
+            }
+        return metrics
+
+    def get_prometheus_metrics_text(self):
+        prometheus_metrics = [
+            '## Redis 连接池',
+            '# HELP jumpserver_redis_pool_connections Redis connection pool connections in this process',
+            '# TYPE jumpserver_redis_pool_connections gauge',
+        ]
+        for db, metrics in sorted(self.get_pool_metrics().items()):
+            for state in ('created', 'in_use', 'available'):
+                prometheus_metrics.append(
+                    f'jumpserver_redis_pool_connections{{db="{db}", state="{state}"}} {metrics[state]}'
+                )
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+redis_client_registry = RedisClientRegistry()
+
+
+def get_redis_client(db=0):
+    return redis_client_registry.get_client(db)
+
+
+class DjangoRedisConnectionFactory(ConnectionFactory):
+    """
+    django 缓存使用注册表中的客户端，与锁、授权树标记等使用同一个 redis(sentinel、ssl 配置也相同)，
+    缓存 LOCATION 中只有 db 有用
+    """
+
+    def connect(self, url):
+        db = urlparse(url).path.strip('/') or 0
+        return get_redis_client(int(db))
 
 
 class RedisPubSub:
@@ -0,0 +1,236 @@
+import time
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from .common import get_logger
+
+logger = get_logger(__name__)
+
+__all__ = [
+    'ConnectionPool', 'ConnectionPoolTimeout', 'ConnectionPoolRegistry', 'connection_pool_registry',
+]
+
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.date_created = time.time()
+        self.date_used = self.date_created
+        # 归还时状态可能被改变(如以其它身份绑定)，下次取出前需要重置
+        self.dirty = False
+
+
+class ConnectionPool:
+    """
+    线程安全的连接池，与具体的连接类型无关:
+    - create(): 创建一个可用的连接
+    - check(conn): 空闲超过 check_interval 的连接取出前检查，返回 False 或抛出异常时丢弃
+    - reset(conn): 归还时标记为 dirty 的连接取出前重置，抛出异常时丢弃
+    - close(conn): 关闭连接
+    超过 max_age 的连接不再使用；连接数达到 max_size 时等待归还，超过 timeout 抛出 ConnectionPoolTimeout
+    """
+
+    def __init__(self, name, create, check=None, reset=None, close=None,
+                 max_size=10, max_age=600, check_interval=30, timeout=10):
+        self.name = name
+        self._create = create
+        self._check = check
+        self._reset = reset
+        self._close = close
+        self.max_size = max_size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.timeout = timeout
+        # 后进先出，常用的连接保持活跃，多余的连接空闲后过期
+        self._idle = deque()
+        # { id(conn): PooledConnection }
+        self._in_use = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self.closed = False
+        self.metrics = Counter()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_size(self):
+        return len(self._idle)
+
+    def _incr(self, event, amount=1):
+        with self._cond:
+            self.metrics[event] += amount
+
+    def _discard(self, item, reason):
+        try:
+            if self._close:
+                self._close(item.conn)
+        except Exception as e:
+            logger.debug(f'Close pooled connection error: {self.name} {e}')
+        with self._cond:
+            self._size -= 1
+            self._incr(f'discarded_{reason}')
+            self._cond.notify()
+
+    def _prepare(self, item):
+        """ 取出的空闲连接是否可用，不可用时已经丢弃 """
+        now = time.time()
+        if now - item.date_created > self.max_age:
+            self._discard(item, 'expired')
+            return False
+        try:
+            if item.dirty and self._reset:
+                self._reset(item.conn)
+                item.dirty = False
+            elif self._check and now - item.date_used > self.check_interval:
+                if self._check(item.conn) is False:
+                    self._discard(item, 'unhealthy')
+                    return False
+        except Exception as e:
+            logger.debug(f'Pooled connection unhealthy: {self.name} {e}')
+            self._discard(item, 'unhealthy')
+            return False
+        return True
+
+    def _acquire_item(self):
+        deadline = time.time() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._incr('timeout')
+                        raise ConnectionPoolTimeout(f'Connection pool {self.name} is exhausted')
+                    self._incr('wait')
+                    self._cond.wait(remaining)
+                if self._idle:
+                    item = self._idle.pop()
+                else:
+                    item = None
+                    self._size += 1
+
+            # 网络操作不在锁中执行
+            if item is not None:
+                if self._prepare(item):
+                    self._incr('reused')
+                    return item
+                continue
+
+            try:
+                conn = self._create()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._incr('create_error')
+                    self._cond.notify()
+                raise
+            self._incr('created')
+            return PooledConnection(conn)
+
+    def acquire(self):
+        item = self._acquire_item()
+        with self._cond:
+            self._in_use[id(item.conn)] = item
+        return item.conn
+
+    def release(self, conn, dirty=False, broken=False):
+        """
+        :param dirty: 连接状态被改变，下次使用前需要 reset
+        :param broken: 使用中出错，直接丢弃
+        """
+        with self._cond:
+            item = self._in_use.pop(id(conn), None)
+        if item is None:
+            return
+        if broken:
+            self._discard(item, 'broken')
+            return
+        if self.closed or time.time() - item.date_created > self.max_age:
+            self._discard(item, 'expired')
+            return
+        item.dirty = item.dirty or dirty
+        item.date_used = time.time()
+        with self._cond:
+            self._idle.append(item)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, dirty=False):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = True
+            raise
+        finally:
+            # 生成器中使用时，没有读完就关闭(GeneratorExit)的连接仍然可用
+            self.release(conn, dirty=dirty, broken=broken)
+
+    def clear(self):
+        """ 关闭所有空闲连接，使用中的连接归还后仍可使用 """
+        with self._cond:
+            items, self._idle = list(self._idle), deque()
+        for item in items:
+            self._discard(item, 'cleared')
+
+    def close(self):
+        """ 不再使用的连接池，使用中的连接归还时关闭 """
+        self.closed = True
+        self.clear()
+
+    def get_metrics(self):
+        with self._cond:
+            metrics = dict(self.metrics)
+            metrics['size'] = self._size
+            metrics['idle'] = len(self._idle)
+            metrics['in_use'] = len(self._in_use)
+        return metrics
+
+
+class ConnectionPoolRegistry:
+    """
+    按 key(如服务器地址和绑定账号) 保存连接池，配置变化后使用新的连接池，旧的连接池关闭
+    """
+
+    def __init__(self):
+        # { name: (key, pool) }
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, name, key, **kwargs):
+        item = self.pools.get(name)
+        if item and item[0] == key:
+            return item[1]
+        with self.lock:
+            item = self.pools.get(name)
+            if item and item[0] == key:
+                return item[1]
+            pool = ConnectionPool(name, **kwargs)
+            self.pools[name] = (key, pool)
+        if item:
+            item[1].close()
+        return pool
+
+    def get_prometheus_metrics_text(self):
+        prometheus_metrics = [
+            '## 连接池',
+            '# HELP jumpserver_connection_pool Connection pool size and events',
+            '# TYPE jumpserver_connection_pool gauge',
+        ]
+        for name, (__, pool) in sorted(self.pools.items()):
+            for metric, value in sorted(pool.get_metrics().items()):
+                prometheus_metrics.append(
+                    f'jumpserver_connection_pool{{pool="{name}",metric="{metric}"}} {value}'
+                )
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+connection_pool_registry = ConnectionPoolRegistry()
@@ -1,3 +1,5 @@
+from bisect import bisect_right
+from functools import lru_cache
 from ipaddress import ip_network, ip_address
 
 
@@ -37,32 +39,88 @@ def in_ip_segment(ip, ip_segment):
     return min(ip1, ip2) <= ip <= max(ip1, ip2)
 
 
-def contains_ip(ip, ip_group):
+class IPGroupMatcher:
     """
-    ip_group:
-    [192.168.10.1, 192.168.1.0/24, 10.1.1.1-10.1.1.20, 2001:db8:2de::e13, 2001:db8:1a:1110::/64.]
-
+    预先解析好的 ip 组，ip、网段、ip 范围都转换为整数区间，排序合并后二分查找
     """
 
-    if '*' in ip_group:
-        return True
+    def __init__(self, ip_group):
+        ip_group = list(ip_group or [])
+        self.match_all = '*' in ip_group
+        # 域名等无法解析的，与原值比较
+        self.values = set(ip_group)
+        # { version: ([start, ...], [end, ...]) }
+        self.intervals = {}
+        self.compile(ip_group)
 
-    for _ip in ip_group:
+    def compile(self, ip_group):
+        intervals = {4: [], 6: []}
+        for _ip in ip_group:
+            interval = self.parse_interval(_ip)
+            if interval is None:
+                continue
+            version, start, end = interval
+            intervals[version].append((start, end))
+
+        for version, _intervals in intervals.items():
+            merged = []
+            for start, end in sorted(_intervals):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.intervals[version] = (
+                [start for start, __ in merged], [end for __, end in merged]
+            )
+
+    @staticmethod
+    def parse_interval(_ip):
+        """
+        :return: (version, start, end)，不是 ip、网段、ip 范围时返回 None
+        """
         if is_ip_address(_ip):
             # 192.168.10.1
-            if ip == _ip:
-                return True
-        elif is_ip_network(_ip) and is_ip_address(ip):
+            address = ip_address(_ip)
+            return address.version, int(address), int(address)
+        elif is_ip_network(_ip):
             # 192.168.1.0/24
-            if ip_address(ip) in ip_network(_ip):
-                return True
-        elif is_ip_segment(_ip) and is_ip_address(ip):
+            network = ip_network(_ip)
+            return network.version, int(network.network_address), int(network.broadcast_address)
+        elif is_ip_segment(_ip):
             # 10.1.1.1-10.1.1.20
-            if in_ip_segment(ip, _ip):
-                return True
-        else:
-            # is domain name
-            if ip == _ip:
-                return True
-
-    return False
+            ip1, ip2 = [ip_address(i) for i in _ip.split('-')]
+            if ip1.version != ip2.version:
+                return None
+            start, end = sorted([int(ip1), int(ip2)])
+            return ip1.version, start, end
+        return None
+
+    def contains(self, ip):
+        if self.match_all or ip in self.values:
+            return True
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            return False
+        starts, ends = self.intervals.get(address.version, ([], []))
+        value = int(address)
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+
+@lru_cache(maxsize=1024)
+def _get_ip_group_matcher(ip_group):
+    return IPGroupMatcher(ip_group)
+
+
+def get_ip_group_matcher(ip_group):
+    return _get_ip_group_matcher(tuple(ip_group or ()))
+
+
+def contains_ip(ip, ip_group):
+    """
+    ip_group:
+    [192.168.10.1, 192.168.1.0/24, 10.1.1.1-10.1.1.20, 2001:db8:2de::e13, 2001:db8:1a:1110::/64.]
+
+    """
+    return get_ip_group_matcher(ip_group).contains(ip)
@@ -5,12 +5,11 @@ from redis_lock import (
     Lock as RedisLock, NotAcquired, UNLOCK_SCRIPT,
     EXTEND_SCRIPT, RESET_SCRIPT, RESET_ALL_SCRIPT
 )
-from redis import Redis
 from django.db import transaction
 
 from common.utils import get_logger
 from common.utils.inspect import copy_function_args
-from jumpserver.const import CONFIG
+from common.utils.connection import get_redis_client
 from common.local import thread_local
 
 logger = get_logger(__file__)
@@ -44,7 +43,7 @@ class DistributedLock(RedisLock):
             是否可重入
         """
         self.kwargs_copy = copy_function_args(self.__init__, locals())
-        redis = Redis(host=CONFIG.REDIS_HOST, port=CONFIG.REDIS_PORT, password=CONFIG.REDIS_PASSWORD)
+        redis = get_redis_client()
 
         if expire is None:
             expire = auto_renewal_seconds
@@ -1,22 +1,65 @@
+from functools import lru_cache
+
 from common.utils.timezone import local_now
 
 
+class TimePeriodMatcher:
+    """
+    预先解析好的时间段，每天一个位图，每一位表示一分钟
+    """
+
+    def __init__(self, time_periods):
+        # { 星期几(0 是星期日): bitmap }
+        self.day_bitmaps = {}
+        for time_period in time_periods or []:
+            self.day_bitmaps[str(time_period['id'])] = self.to_bitmap(time_period['value'])
+
+    @staticmethod
+    def to_minute(value):
+        hour, minute = value.split(':')
+        return int(hour) * 60 + int(minute)
+
+    @classmethod
+    def to_bitmap(cls, value):
+        """
+        value: 00:00~07:30、10:00~13:00，开始和结束的分钟都包含在内，结束时间 00:00 表示 24:00
+        """
+        bitmap = 0
+        if not value:
+            return bitmap
+        for time in value.split('、'):
+            start, end = time.split('~')
+            start = cls.to_minute(start)
+            end = 24 * 60 if end == '00:00' else cls.to_minute(end)
+            if start > end:
+                continue
+            bitmap |= ((1 << (end - start + 1)) - 1) << start
+        return bitmap
+
+    def contains(self, dt=None):
+        dt = dt or local_now()
+        bitmap = self.day_bitmaps.get(dt.strftime('%w'))
+        if not bitmap:
+            return False
+        minute = dt.hour * 60 + dt.minute
+        return bool(bitmap >> minute & 1)
+
+
+@lru_cache(maxsize=1024)
+def _get_time_period_matcher(time_periods):
+    time_periods = [{'id': i, 'value': value} for i, value in time_periods]
+    return TimePeriodMatcher(time_periods)
+
+
+def get_time_period_matcher(time_periods):
+    time_periods = tuple((str(i['id']), i['value']) for i in time_periods or [])
+    return _get_time_period_matcher(time_periods)
+
+
 def contains_time_period(time_periods):
     """
     time_periods: [{"id": 1, "value": "00:00~07:30、10:00~13:00"}, {"id": 2, "value": "00:00~00:00"}]
     """
     if not time_periods:
         return False
-
-    current_time = local_now().strftime('%H:%M')
-    today_time_period = next(filter(lambda x: str(x['id']) == local_now().strftime("%w"), time_periods))
-    today_time_period = today_time_period['value']
-    if not today_time_period:
-        return False
-
-    for time in today_time_period.split('、'):
-        start, end = time.split('~')
-        end = "24:00" if end == "00:00" else end
-        if start <= current_time <= end:
-            return True
-    return False
+    return get_time_period_matcher(time_periods).contains()
@@ -3,20 +3,26 @@ import time
 from django.core.cache import cache
 from django.utils import timezone
 from django.utils.timesince import timesince
-from django.db.models import Count, Max
+from django.db.models import Count, Max, Sum
 from django.http.response import JsonResponse, HttpResponse
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
-from collections import Counter
 from rest_framework.response import Response
 
 from users.models import User
 from assets.models import Asset
-from terminal.models import Session
+from assets.models.node import node_assets_mapping_metrics
+from perms.utils.asset.decision_cache import asset_permission_decision_cache
+from terminal.models import Session, SessionDailyStatistics
 from terminal.utils import ComponentsPrometheusMetricsUtil
 from orgs.utils import current_org
 from common.permissions import IsOrgAdmin, IsOrgAuditor
 from common.utils import lazyproperty, get_request_ip
+from common.mixins.api import NonAtomicRequestsMixin
+from common.db.utils import db_connection_metrics
+from common.utils.connection import redis_client_registry
+from common.utils.connection_pool import connection_pool_registry
+from audits.writer import audit_log_writer
 from orgs.caches import OrgResourceStatisticsCache
 
 
@@ -39,8 +45,9 @@ class DatesLoginMetricMixin:
 
     @lazyproperty
     def session_dates_list(self):
-        now = timezone.now()
-        dates = [(now - timezone.timedelta(days=i)).date() for i in range(self.days)]
+        # 与会话每日统计一样按本地时区分天
+        today = timezone.localdate()
+        dates = [today - timezone.timedelta(days=i) for i in range(self.days)]
         dates.reverse()
         # dates = self.sessions_queryset.dates('date_start', 'day')
         return dates
@@ -49,89 +56,41 @@ class DatesLoginMetricMixin:
         dates_metrics_date = [d.strftime('%m-%d') for d in self.session_dates_list] or ['0']
         return dates_metrics_date
 
-    @staticmethod
-    def get_cache_key(date, tp):
-        date_str = date.strftime("%Y%m%d")
-        key = "SESSION_DATE_{}_{}_{}".format(current_org.id, tp, date_str)
-        return key
-
-    def __get_data_from_cache(self, date, tp):
-        if date == timezone.now().date():
-            return None
-        cache_key = self.get_cache_key(date, tp)
-        count = cache.get(cache_key)
-        return count
+    @lazyproperty
+    def statistics_queryset(self):
+        date_from = self.session_dates_list[0]
+        return SessionDailyStatistics.objects.filter(date__gte=date_from)
 
-    def __set_data_to_cache(self, date, tp, count):
-        cache_key = self.get_cache_key(date, tp)
-        cache.set(cache_key, count, 3600*24*7)
+    @lazyproperty
+    def user_statistics_queryset(self):
+        return self.statistics_queryset.filter(type=SessionDailyStatistics.Type.user)
 
-    @staticmethod
-    def get_date_start_2_end(d):
-        time_min = timezone.datetime.min.time()
-        time_max = timezone.datetime.max.time()
-        tz = timezone.get_current_timezone()
-        ds = timezone.datetime.combine(d, time_min).replace(tzinfo=tz)
-        de = timezone.datetime.combine(d, time_max).replace(tzinfo=tz)
-        return ds, de
-
-    def get_date_login_count(self, date):
-        tp = "LOGIN"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = Session.objects.filter(date_start__range=(ds, de)).count()
-        self.__set_data_to_cache(date, tp, count)
-        return count
+    @lazyproperty
+    def asset_statistics_queryset(self):
+        return self.statistics_queryset.filter(type=SessionDailyStatistics.Type.asset)
+
+    def get_dates_metrics(self, queryset, aggregation):
+        """ 按天汇总，一次查询 """
+        rows = queryset.values('date').annotate(value=aggregation).values_list('date', 'value')
+        date_value_mapper = dict(rows)
+        return [date_value_mapper.get(d) or 0 for d in self.session_dates_list]
 
     def get_dates_metrics_total_count_login(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_login_count(d)
-            data.append(count)
+        # 每个会话都有一条用户统计，用户统计的总数就是会话数
+        data = self.get_dates_metrics(self.user_statistics_queryset, Sum('count'))
         if len(data) == 0:
             data = [0]
         return data
 
-    def get_date_user_count(self, date):
-        tp = "USER"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = len(set(Session.objects.filter(date_start__range=(ds, de)).values_list('user_id', flat=True)))
-        self.__set_data_to_cache(date, tp, count)
-        return count
-
     def get_dates_metrics_total_count_active_users(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_user_count(d)
-            data.append(count)
-        return data
-
-    def get_date_asset_count(self, date):
-        tp = "ASSET"
-        count = self.__get_data_from_cache(date, tp)
-        if count is not None:
-            return count
-        ds, de = self.get_date_start_2_end(date)
-        count = len(set(Session.objects.filter(date_start__range=(ds, de)).values_list('asset', flat=True)))
-        self.__set_data_to_cache(date, tp, count)
-        return count
+        return self.get_dates_metrics(self.user_statistics_queryset, Count('key', distinct=True))
 
     def get_dates_metrics_total_count_active_assets(self):
-        data = []
-        for d in self.session_dates_list:
-            count = self.get_date_asset_count(d)
-            data.append(count)
-        return data
+        return self.get_dates_metrics(self.asset_statistics_queryset, Count('key', distinct=True))
 
     @lazyproperty
     def dates_total_count_active_users(self):
-        count = len(set(self.sessions_queryset.values_list('user_id', flat=True)))
-        return count
+        return self.user_statistics_queryset.values('key').distinct().count()
 
     @lazyproperty
     def dates_total_count_inactive_users(self):
@@ -148,7 +107,7 @@ class DatesLoginMetricMixin:
 
     @lazyproperty
     def dates_total_count_active_assets(self):
-        return len(set(self.sessions_queryset.values_list('asset', flat=True)))
+        return self.asset_statistics_queryset.values('key').distinct().count()
 
     @lazyproperty
     def dates_total_count_inactive_assets(self):
@@ -164,36 +123,39 @@ class DatesLoginMetricMixin:
         return Asset.objects.filter(is_active=False).count()
 
     # 以下是从week中而来
+    def get_top_statistics(self, queryset, limit):
+        rows = queryset.values('key') \
+            .annotate(total=Sum('count')) \
+            .annotate(name=Max('name')) \
+            .annotate(last=Max('date_last')).order_by('-total')[:limit]
+        return list(rows)
+
     def get_dates_login_times_top5_users(self):
-        users = self.sessions_queryset.values_list('user_id', flat=True)
         users = [
-            {'user': user, 'total': total}
-            for user, total in Counter(users).most_common(5)
+            {'user': row['key'], 'total': row['total']}
+            for row in self.get_top_statistics(self.user_statistics_queryset, 5)
         ]
         return users
 
     def get_dates_total_count_login_users(self):
-        return len(set(self.sessions_queryset.values_list('user_id', flat=True)))
+        return self.dates_total_count_active_users
 
     def get_dates_total_count_login_times(self):
-        return self.sessions_queryset.count()
+        return self.user_statistics_queryset.aggregate(total=Sum('count'))['total'] or 0
 
     def get_dates_login_times_top10_assets(self):
-        assets = self.sessions_queryset.values("asset") \
-                     .annotate(total=Count("asset")) \
-                     .annotate(last=Max("date_start")).order_by("-total")[:10]
-        for asset in assets:
-            asset['last'] = str(asset['last'])
-        return list(assets)
+        assets = [
+            {'asset': row['key'], 'total': row['total'], 'last': str(row['last'])}
+            for row in self.get_top_statistics(self.asset_statistics_queryset, 10)
+        ]
+        return assets
 
     def get_dates_login_times_top10_users(self):
-        users = self.sessions_queryset.values("user_id") \
-                    .annotate(total=Count("user_id")) \
-                    .annotate(user=Max('user')) \
-                    .annotate(last=Max("date_start")).order_by("-total")[:10]
-        for user in users:
-            user['last'] = str(user['last'])
-        return list(users)
+        users = [
+            {'user_id': row['key'], 'user': row['name'], 'total': row['total'], 'last': str(row['last'])}
+            for row in self.get_top_statistics(self.user_statistics_queryset, 10)
+        ]
+        return users
 
     def get_dates_login_record_top10_sessions(self):
         sessions = self.sessions_queryset.order_by('-date_start')[:10]
@@ -212,7 +174,7 @@ class DatesLoginMetricMixin:
         return sessions
 
 
-class IndexApi(DatesLoginMetricMixin, APIView):
+class IndexApi(NonAtomicRequestsMixin, DatesLoginMetricMixin, APIView):
     permission_classes = (IsOrgAdmin | IsOrgAuditor,)
     http_method_names = ['get']
 
@@ -296,7 +258,7 @@ class IndexApi(DatesLoginMetricMixin, APIView):
         return JsonResponse(data, status=200)
 
 
-class HealthApiMixin(APIView):
+class HealthApiMixin(NonAtomicRequestsMixin, APIView):
     pass
 
     # 先去掉 Health Api 的权限校验，方便各组件直接调用
@@ -377,5 +339,11 @@ class PrometheusMetricsApi(HealthApiMixin):
     def get(self, request, *args, **kwargs):
         util = ComponentsPrometheusMetricsUtil()
         metrics_text = util.get_prometheus_metrics_text()
+        metrics_text += node_assets_mapping_metrics.get_prometheus_metrics_text()
+        metrics_text += redis_client_registry.get_prometheus_metrics_text()
+        metrics_text += asset_permission_decision_cache.get_prometheus_metrics_text()
+        metrics_text += connection_pool_registry.get_prometheus_metrics_text()
+        metrics_text += audit_log_writer.get_prometheus_metrics_text()
+        metrics_text += db_connection_metrics.get_prometheus_metrics_text()
         return HttpResponse(metrics_text, content_type='text/plain; version=0.0.4; charset=utf-8')
 
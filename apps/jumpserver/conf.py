@@ -134,6 +134,13 @@ class Config(dict):
         'DB_PORT': 3306,
         'DB_USER': 'root',
         'DB_PASSWORD': '',
+        # 只读从库，如: [{"HOST": "10.1.1.2", "PORT": 3306}]，其它配置与主库相同
+        'DB_READ_REPLICAS': [],
+        'DB_READ_REPLICA_STICKY_SECONDS': 5,
+        # 数据库持久连接的最长时间(秒)，0 为每次请求结束关闭连接
+        'DB_CONN_MAX_AGE': 0,
+        # 复用持久连接前检查连接是否可用
+        'DB_CONN_HEALTH_CHECKS': True,
         'REDIS_HOST': '127.0.0.1',
         'REDIS_PORT': 6379,
         'REDIS_PASSWORD': '',
@@ -142,6 +149,18 @@ class Config(dict):
         'REDIS_DB_CACHE': 4,
         'REDIS_DB_SESSION': 5,
         'REDIS_DB_WS': 6,
+        # 进程内每个 db 连接池的最大连接数，0 为不限制
+        'REDIS_MAX_CONNECTIONS': 0,
+        'REDIS_USE_SSL': False,
+        'REDIS_SSL_CA': '',
+        'REDIS_SSL_CERT': '',
+        'REDIS_SSL_KEY': '',
+        'REDIS_SSL_REQUIRED': 'required',
+        # 多个以逗号分隔: host1:26379,host2:26379，配置后通过 sentinel 获取 master
+        'REDIS_SENTINEL_HOSTS': '',
+        'REDIS_SENTINEL_SERVICE_NAME': 'mymaster',
+        'REDIS_SENTINEL_PASSWORD': '',
+        'REDIS_SENTINEL_SOCKET_TIMEOUT': 0.5,
 
         'GLOBAL_ORG_DISPLAY_NAME': '',
         'SITE_URL': 'http://localhost:8080',
@@ -176,6 +195,9 @@ class Config(dict):
         'AUTH_LDAP_SYNC_CRONTAB': None,
         'AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS': False,
         'AUTH_LDAP_OPTIONS_OPT_REFERRALS': -1,
+        'AUTH_LDAP_POOL_SIZE': 10,
+        'AUTH_LDAP_POOL_MAX_AGE': 600,
+        'AUTH_LDAP_POOL_CHECK_INTERVAL': 30,
 
         # OpenID 配置参数
         # OpenID 公有配置参数 (version <= 1.5.8 或 version >= 1.5.8)
@@ -384,6 +406,12 @@ class Config(dict):
         'PERM_SINGLE_ASSET_TO_UNGROUP_NODE': False,
         'WINDOWS_SSH_DEFAULT_SHELL': 'cmd',
         'PERIOD_TASK_ENABLED': True,
+        # 推送系统用户时 ansible 的并发数
+        'PUSH_SYSTEM_USER_FORKS': 10,
+        # 测试可连接性时，主机数量超过这个值就拆分成多个任务并行执行
+        'CONNECTIVITY_TEST_SHARD_SIZE': 200,
+        # 资产和节点关系变化时，事务提交后合并更新节点资产数量，而不是每次变化都加锁更新
+        'NODE_ASSETS_AMOUNT_DEFERRED_UPDATE': True,
 
         # 导航栏 帮助
         'HELP_DOCUMENT_URL': 'http://docs.jumpserver.org',
@@ -476,6 +504,32 @@ class Config(dict):
         if openid_config:
             self.set_openid_config(openid_config)
 
+    def get_redis_sentinel_hosts(self):
+        hosts = []
+        for host in (self.REDIS_SENTINEL_HOSTS or '').split(','):
+            host = host.strip()
+            if not host:
+                continue
+            host, port = host.rsplit(':', 1)
+            hosts.append((host, int(port)))
+        return hosts
+
+    def get_redis_ssl_kwargs(self):
+        """ redis-py 连接的 ssl 参数，缓存、session、celery 等共用 """
+        if not self.REDIS_USE_SSL:
+            return {}
+        kwargs = {
+            'ssl': True,
+            'ssl_cert_reqs': self.REDIS_SSL_REQUIRED or None,
+        }
+        if self.REDIS_SSL_CA:
+            kwargs['ssl_ca_certs'] = self.REDIS_SSL_CA
+        if self.REDIS_SSL_CERT:
+            kwargs['ssl_certfile'] = self.REDIS_SSL_CERT
+        if self.REDIS_SSL_KEY:
+            kwargs['ssl_keyfile'] = self.REDIS_SSL_KEY
+        return kwargs
+
     def compatible(self):
         """
         对配置做兼容处理
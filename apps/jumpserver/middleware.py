@@ -3,12 +3,17 @@
 import os
 import re
 import pytz
+import hashlib
 from django.utils import timezone
+from django.core.cache import cache
 from django.shortcuts import HttpResponse
 from django.conf import settings
 from django.core.exceptions import MiddlewareNotUsed
 from django.http.response import HttpResponseForbidden
 
+from common.db.router import (
+    db_read_state, is_db_written, is_atomic_request_view, set_db_in_atomic_request
+)
 from .utils import set_current_request
 
 
@@ -92,3 +97,51 @@ class RefererCheckMiddleware:
             return HttpResponseForbidden('CSRF CHECK ERROR')
         response = self.get_response(request)
         return response
+
+
+class DBReadReplicaMiddleware:
+    """
+    安全方法的请求读从库，写过数据的用户(按登录凭证区分)之后一段时间内读主库，
+    请求头 `X-JMS-DB-READ: primary` 要求读主库(需要最新数据时)
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+    sticky_key_template = 'DB_READ_PRIMARY_STICKY_{}'
+
+    def __init__(self, get_response):
+        if not settings.DB_READ_REPLICA_ALIASES:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    @classmethod
+    def get_sticky_key(cls, request):
+        # 这时还没有认证用户，使用登录凭证区分用户，不需要查询数据库
+        credential = request.META.get('HTTP_AUTHORIZATION') or \
+            request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not credential:
+            return None
+        digest = hashlib.md5(credential.encode()).hexdigest()
+        return cls.sticky_key_template.format(digest)
+
+    def should_read_primary(self, request, sticky_key):
+        if request.META.get('HTTP_X_JMS_DB_READ', '').lower() == 'primary':
+            return True
+        return bool(sticky_key and cache.get(sticky_key))
+
+    def __call__(self, request):
+        sticky_key = self.get_sticky_key(request)
+        replica = request.method in self.SAFE_METHODS
+        primary = replica and self.should_read_primary(request, sticky_key)
+
+        with db_read_state(replica=replica, primary=primary):
+            response = self.get_response(request)
+            written = is_db_written()
+
+        if written and sticky_key:
+            cache.set(sticky_key, 1, settings.DB_READ_REPLICA_STICKY_SECONDS)
+        return response
+
+    @staticmethod
+    def process_view(request, view_func, view_args, view_kwargs):
+        # 这里的 view_func 还没有被 ATOMIC_REQUESTS 的事务包装，按视图记录是否有请求级别的事务
+        set_db_in_atomic_request(is_atomic_request_view(view_func))
+        return None
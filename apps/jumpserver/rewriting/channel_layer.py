@@ -0,0 +1,47 @@
+import ssl
+
+from channels_redis.core import RedisChannelLayer as _RedisChannelLayer, ConnectionPool
+
+from common.utils.connection import redis_client_registry
+from jumpserver.const import CONFIG
+
+
+def get_ssl_context():
+    kwargs = CONFIG.get_redis_ssl_kwargs()
+    if not kwargs:
+        return None
+    context = ssl.create_default_context(cafile=kwargs.get('ssl_ca_certs'))
+    if kwargs.get('ssl_certfile'):
+        context.load_cert_chain(kwargs['ssl_certfile'], kwargs.get('ssl_keyfile'))
+    if kwargs.get('ssl_cert_reqs') != 'required':
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class MasterConnectionPool(ConnectionPool):
+    """
+    aioredis 不支持 sentinel，新建连接时取当前的 master 地址，主从切换后新的连接会连到新的 master
+    """
+
+    @property
+    def host(self):
+        host = dict(self._host)
+        host['address'] = redis_client_registry.get_master_address()
+        return host
+
+    @host.setter
+    def host(self, value):
+        self._host = value
+
+
+class RedisChannelLayer(_RedisChannelLayer):
+    """ 与缓存、锁使用相同的 redis 配置(sentinel、ssl) """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        context = get_ssl_context()
+        if context:
+            for host in self.hosts:
+                host['ssl'] = context
+        self.pools = [MasterConnectionPool(host) for host in self.hosts]
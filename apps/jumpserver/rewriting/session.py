@@ -1,9 +1,32 @@
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase
+from django.utils.functional import LazyObject
 from redis_sessions.session import force_unicode, SessionStore as RedisSessionStore
 from redis import exceptions
 
+from common.utils.connection import redis_client_registry
+
+
+class SessionRedisClient(LazyObject):
+    def _setup(self):
+        # 与缓存、锁使用相同的连接配置(sentinel、ssl)，保留较短的超时，redis 异常时请求不会一直等待
+        self._wrapped = redis_client_registry.create_client(
+            settings.SESSION_REDIS['db'],
+            socket_timeout=settings.SESSION_REDIS['socket_timeout'],
+            retry_on_timeout=settings.SESSION_REDIS['retry_on_timeout'],
+        )
+
+
+session_redis_client = SessionRedisClient()
+
 
 class SessionStore(RedisSessionStore):
 
+    def __init__(self, session_key=None):
+        # 不使用 redis_sessions 根据 SESSION_REDIS 创建的连接
+        SessionBase.__init__(self, session_key)
+        self.server = session_redis_client
+
     def load(self):
         try:
             session_data = self.server.get(
@@ -44,6 +44,11 @@ AUTH_LDAP_SYNC_IS_PERIODIC = CONFIG.AUTH_LDAP_SYNC_IS_PERIODIC
 AUTH_LDAP_SYNC_INTERVAL = CONFIG.AUTH_LDAP_SYNC_INTERVAL
 AUTH_LDAP_SYNC_CRONTAB = CONFIG.AUTH_LDAP_SYNC_CRONTAB
 AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS = CONFIG.AUTH_LDAP_USER_LOGIN_ONLY_IN_USERS
+# 认证和同步共用的 LDAP 连接池，每个进程一个
+AUTH_LDAP_POOL_SIZE = CONFIG.AUTH_LDAP_POOL_SIZE
+AUTH_LDAP_POOL_MAX_AGE = CONFIG.AUTH_LDAP_POOL_MAX_AGE
+AUTH_LDAP_POOL_CHECK_INTERVAL = CONFIG.AUTH_LDAP_POOL_CHECK_INTERVAL
+AUTH_LDAP_CONNECT_TIMEOUT = CONFIG.AUTH_LDAP_CONNECT_TIMEOUT
 
 
 # ==============================================================================
@@ -82,6 +82,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'jumpserver.middleware.TimezoneMiddleware',
     'jumpserver.middleware.DemoMiddleware',
+    'jumpserver.middleware.DBReadReplicaMiddleware',
     'jumpserver.middleware.RequestMiddleware',
     'jumpserver.middleware.RefererCheckMiddleware',
     'orgs.middleware.OrgMiddleware',
@@ -130,6 +131,7 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 SESSION_EXPIRE_AT_BROWSER_CLOSE_FORCE = CONFIG.SESSION_EXPIRE_AT_BROWSER_CLOSE_FORCE
 SESSION_SAVE_EVERY_REQUEST = CONFIG.SESSION_SAVE_EVERY_REQUEST
 SESSION_ENGINE = 'jumpserver.rewriting.session'
+# 连接由 jumpserver.rewriting.session 使用公共的 redis 配置(sentinel、ssl)创建，这里只用 db、prefix、超时
 SESSION_REDIS = {
     'host': CONFIG.REDIS_HOST,
     'port': CONFIG.REDIS_PORT,
@@ -154,15 +156,33 @@ DATABASES = {
         'USER': CONFIG.DB_USER,
         'PASSWORD': CONFIG.DB_PASSWORD,
         'ATOMIC_REQUESTS': True,
+        'CONN_MAX_AGE': CONFIG.DB_CONN_MAX_AGE,
         'OPTIONS': DB_OPTIONS
     }
 }
+DB_CONN_HEALTH_CHECKS = CONFIG.DB_CONN_HEALTH_CHECKS
 DB_CA_PATH = os.path.join(PROJECT_DIR, 'data', 'certs', 'db_ca.pem')
 if CONFIG.DB_ENGINE.lower() == 'mysql':
     DB_OPTIONS['init_command'] = "SET sql_mode='STRICT_TRANS_TABLES'"
     if os.path.isfile(DB_CA_PATH):
         DB_OPTIONS['ssl'] = {'ca': DB_CA_PATH}
 
+# 只读从库，每个从库只需配置与主库不同的项，如: [{"HOST": "10.1.1.2"}]
+DB_READ_REPLICA_ALIASES = []
+for i, replica in enumerate(CONFIG.DB_READ_REPLICAS or []):
+    alias = 'replica_{}'.format(i)
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        **{k.upper(): v for k, v in replica.items()},
+        'ATOMIC_REQUESTS': False,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DB_READ_REPLICA_ALIASES.append(alias)
+# 写过数据后，同一个用户多长时间内读主库，避免从库延迟读不到刚写入的数据
+DB_READ_REPLICA_STICKY_SECONDS = CONFIG.DB_READ_REPLICA_STICKY_SECONDS
+if DB_READ_REPLICA_ALIASES:
+    DATABASE_ROUTERS = ['common.db.router.ReadReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -257,6 +277,8 @@ CACHES = {
         }
     }
 }
+# 缓存与锁、授权树标记等使用同一个连接池，sentinel、ssl 配置也相同
+DJANGO_REDIS_CONNECTION_FACTORY = 'common.utils.connection.DjangoRedisConnectionFactory'
 
 FORCE_SCRIPT_NAME = CONFIG.FORCE_SCRIPT_NAME
 SESSION_COOKIE_SECURE = CONFIG.SESSION_COOKIE_SECURE
@@ -90,6 +90,9 @@ FLOWER_URL = CONFIG.FLOWER_URL
 
 # Enable internal period task
 PERIOD_TASK_ENABLED = CONFIG.PERIOD_TASK_ENABLED
+PUSH_SYSTEM_USER_FORKS = CONFIG.PUSH_SYSTEM_USER_FORKS
+CONNECTIVITY_TEST_SHARD_SIZE = CONFIG.CONNECTIVITY_TEST_SHARD_SIZE
+NODE_ASSETS_AMOUNT_DEFERRED_UPDATE = CONFIG.NODE_ASSETS_AMOUNT_DEFERRED_UPDATE
 
 # only allow single machine login with the same account
 USER_LOGIN_SINGLE_MACHINE_ENABLED = CONFIG.USER_LOGIN_SINGLE_MACHINE_ENABLED
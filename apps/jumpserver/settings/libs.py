@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import ssl
+
 from ..const import CONFIG, PROJECT_DIR
 
 REST_FRAMEWORK = {
@@ -82,16 +84,16 @@ BOOTSTRAP3 = {
 
 
 # Django channels support websocket
-CHANNEL_REDIS = "redis://:{}@{}:{}/{}".format(
-    CONFIG.REDIS_PASSWORD, CONFIG.REDIS_HOST, CONFIG.REDIS_PORT,
-    CONFIG.REDIS_DB_WS,
-)
-
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # 地址(sentinel 时是当前的 master)、ssl 在 backend 中设置
+        'BACKEND': 'jumpserver.rewriting.channel_layer.RedisChannelLayer',
         'CONFIG': {
-            "hosts": [CHANNEL_REDIS],
+            "hosts": [{
+                'address': (CONFIG.REDIS_HOST, CONFIG.REDIS_PORT),
+                'db': CONFIG.REDIS_DB_WS,
+                'password': CONFIG.REDIS_PASSWORD or None,
+            }],
         },
     },
 }
@@ -102,12 +104,39 @@ ASGI_APPLICATION = 'jumpserver.routing.application'
 CELERY_LOG_DIR = os.path.join(PROJECT_DIR, 'data', 'celery')
 
 # Celery using redis as broker
-CELERY_BROKER_URL = 'redis://:%(password)s@%(host)s:%(port)s/%(db)s' % {
-    'password': CONFIG.REDIS_PASSWORD,
-    'host': CONFIG.REDIS_HOST,
-    'port': CONFIG.REDIS_PORT,
-    'db': CONFIG.REDIS_DB_CELERY,
+# 与缓存、锁使用相同的 redis 配置(sentinel、ssl)
+REDIS_SENTINEL_HOSTS = CONFIG.get_redis_sentinel_hosts()
+REDIS_SSL_OPTIONS = {
+    k: v for k, v in CONFIG.get_redis_ssl_kwargs().items() if k != 'ssl'
 }
+if REDIS_SSL_OPTIONS:
+    REDIS_SSL_OPTIONS['ssl_cert_reqs'] = {
+        'required': ssl.CERT_REQUIRED, 'optional': ssl.CERT_OPTIONAL,
+    }.get(REDIS_SSL_OPTIONS.get('ssl_cert_reqs'), ssl.CERT_NONE)
+
+if REDIS_SENTINEL_HOSTS:
+    CELERY_BROKER_URL = ';'.join(
+        'sentinel://:%(password)s@%(host)s:%(port)s/%(db)s' % {
+            'password': CONFIG.REDIS_PASSWORD,
+            'host': host,
+            'port': port,
+            'db': CONFIG.REDIS_DB_CELERY,
+        } for host, port in REDIS_SENTINEL_HOSTS
+    )
+    CELERY_BROKER_TRANSPORT_OPTIONS = CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS = {
+        'master_name': CONFIG.REDIS_SENTINEL_SERVICE_NAME,
+        'sentinel_kwargs': {'password': CONFIG.REDIS_SENTINEL_PASSWORD or None},
+    }
+else:
+    CELERY_BROKER_URL = '%(scheme)s://:%(password)s@%(host)s:%(port)s/%(db)s' % {
+        'scheme': 'rediss' if REDIS_SSL_OPTIONS else 'redis',
+        'password': CONFIG.REDIS_PASSWORD,
+        'host': CONFIG.REDIS_HOST,
+        'port': CONFIG.REDIS_PORT,
+        'db': CONFIG.REDIS_DB_CELERY,
+    }
+if REDIS_SSL_OPTIONS:
+    CELERY_BROKER_USE_SSL = CELERY_REDIS_BACKEND_USE_SSL = REDIS_SSL_OPTIONS
 CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_RESULT_SERIALIZER = 'pickle'
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
@@ -132,3 +161,4 @@ ANSIBLE_LOG_DIR = os.path.join(PROJECT_DIR, 'data', 'ansible')
 REDIS_HOST = CONFIG.REDIS_HOST
 REDIS_PORT = CONFIG.REDIS_PORT
 REDIS_PASSWORD = CONFIG.REDIS_PASSWORD
+REDIS_DB_CACHE = CONFIG.REDIS_DB_CACHE
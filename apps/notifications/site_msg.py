@@ -1,4 +1,4 @@
-from django.db.models import F
+from django.db.models import F, Count
 from django.db import transaction
 
 from common.utils.timezone import local_now
@@ -92,3 +92,19 @@ class SiteMessageUtil:
 
         SiteMessageUsers.objects.bulk_update(
             site_msg_users, fields=('has_read', 'read_at'))
+
+    @classmethod
+    def get_users_unread_msgs_count(cls, user_ids):
+        """
+        一次查询多个用户的未读数量
+        :return: {user_id: count}，没有未读的用户为 0
+        """
+        user_ids = [str(i) for i in user_ids]
+        rows = SiteMessageUsers.objects.filter(
+            user_id__in=user_ids, has_read=False
+        ).order_by().values('user_id').annotate(
+            count=Count('sitemessage_id', distinct=True)
+        ).values_list('user_id', 'count')
+        users_count = dict.fromkeys(user_ids, 0)
+        users_count.update({str(user_id): count for user_id, count in rows})
+        return users_count
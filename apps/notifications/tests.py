@@ -1,3 +1,60 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .ws import SiteMsgHub
+
+
+class FakeChannelLayer:
+    """ 记录发送的消息以及发送时所在的事件循环 """
+
+    def __init__(self, fail_channels=()):
+        self.sent = []
+        self.loops = set()
+        self.fail_channels = set(fail_channels)
+
+    async def send(self, channel_name, message):
+        self.loops.add(id(asyncio.get_event_loop()))
+        if channel_name in self.fail_channels:
+            raise ConnectionError('Channel full')
+        self.sent.append((channel_name, message))
+
+
+class SiteMsgHubFanOutTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.hub = SiteMsgHub()
+        # 不启动订阅线程
+        self.hub.start_if_need = lambda: None
+        self.hub.register('u1', 'c1')
+        self.hub.register('u1', 'c2')
+        self.hub.register('u2', 'c3')
+
+    def handle(self, channel_layer, users):
+        unread_count = {'u1': 3, 'u2': 5}
+        with mock.patch('notifications.ws.get_channel_layer', return_value=channel_layer), \
+                mock.patch('notifications.ws.SiteMessageUtil.get_users_unread_msgs_count',
+                           return_value=unread_count):
+            self.hub.handle_new_site_msg({'users': users})
+
+    def test_fan_out_in_one_loop(self):
+        channel_layer = FakeChannelLayer()
+        self.handle(channel_layer, ['u1', 'u2', 'u3'])
+        self.assertEqual(sorted(channel_layer.sent), [
+            ('c1', {'type': 'unread.count', 'unread_count': 3}),
+            ('c2', {'type': 'unread.count', 'unread_count': 3}),
+            ('c3', {'type': 'unread.count', 'unread_count': 5}),
+        ])
+        # 所有消息在同一个事件循环中发送，共用一个 redis 连接池
+        self.assertEqual(len(channel_layer.loops), 1)
+
+    def test_fan_out_only_local_users(self):
+        channel_layer = FakeChannelLayer()
+        self.handle(channel_layer, ['u3'])
+        self.assertEqual(channel_layer.sent, [])
+
+    def test_send_error_not_affect_others(self):
+        channel_layer = FakeChannelLayer(fail_channels=['c1'])
+        self.handle(channel_layer, ['u1', 'u2'])
+        self.assertEqual(sorted(name for name, __ in channel_layer.sent), ['c2', 'c3'])
@@ -1,6 +1,12 @@
+import time
+import asyncio
 import threading
 import json
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
 from channels.generic.websocket import JsonWebsocketConsumer
+from channels.layers import get_channel_layer
 
 from common.utils import get_logger
 from common.db.utils import safe_db_connection
@@ -10,6 +16,88 @@ from .signals_handler import new_site_msg_chan
 logger = get_logger(__name__)
 
 
+class SiteMsgHub:
+    """
+    每个进程一个站内信订阅，按 user_id 找到本进程中连接的 websocket，
+    批量查询这些用户的未读数量后，通过 channel layer 发送给对应的 consumer
+    """
+    restart_interval = 5
+
+    def __init__(self):
+        # { user_id: {channel_name, ...} }
+        self.user_channels_mapper = defaultdict(set)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, user_id, channel_name):
+        with self.lock:
+            self.user_channels_mapper[str(user_id)].add(channel_name)
+            self.start_if_need()
+
+    def unregister(self, user_id, channel_name):
+        user_id = str(user_id)
+        with self.lock:
+            channels = self.user_channels_mapper.get(user_id)
+            if channels is None:
+                return
+            channels.discard(channel_name)
+            if not channels:
+                self.user_channels_mapper.pop(user_id, None)
+
+    def get_users_channels(self, user_ids):
+        with self.lock:
+            return {
+                user_id: list(self.user_channels_mapper[user_id])
+                for user_id in user_ids if user_id in self.user_channels_mapper
+            }
+
+    def start_if_need(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.keep_watch, daemon=True)
+        self.thread.start()
+
+    def keep_watch(self):
+        # 订阅断开后重新订阅
+        while True:
+            new_site_msg_chan.keep_handle_msg(self.handle_new_site_msg)
+            logger.warning('Site msg subscription closed, restart later')
+            time.sleep(self.restart_interval)
+
+    def handle_new_site_msg(self, msg):
+        users = {str(user_id) for user_id in msg.get('users', [])}
+        users_channels = self.get_users_channels(users)
+        logger.debug('New site msg recv, message users: {}, local users: {}'.format(
+            len(users), len(users_channels)
+        ))
+        if not users_channels:
+            return
+        users_unread_count = SiteMessageUtil.get_users_unread_msgs_count(users_channels.keys())
+        channel_messages = []
+        for user_id, channels in users_channels.items():
+            message = {'type': 'unread.count', 'unread_count': users_unread_count.get(user_id, 0)}
+            channel_messages.extend((channel_name, message) for channel_name in channels)
+
+        # 所有消息在一个事件循环中并发发送，channels_redis 的连接池按事件循环区分，
+        # 每次 async_to_sync 都会新建事件循环和 redis 连接
+        try:
+            results = async_to_sync(self.send_messages)(get_channel_layer(), channel_messages)
+        except Exception as e:
+            logger.error(f'Send unread count to channels error: {e}')
+            return
+        for (channel_name, __), result in zip(channel_messages, results):
+            if isinstance(result, Exception):
+                logger.error(f'Send unread count to channel error: {channel_name} {result}')
+
+    @staticmethod
+    async def send_messages(channel_layer, channel_messages):
+        sends = [channel_layer.send(channel_name, message) for channel_name, message in channel_messages]
+        return await asyncio.gather(*sends, return_exceptions=True)
+
+
+site_msg_hub = SiteMsgHub()
+
+
 class SiteMsgWebsocket(JsonWebsocketConsumer):
     refresh_every_seconds = 10
 
@@ -17,12 +105,19 @@ class SiteMsgWebsocket(JsonWebsocketConsumer):
         user = self.scope["user"]
         if user.is_authenticated:
             self.accept()
+            site_msg_hub.register(user.id, self.channel_name)
 
-            thread = threading.Thread(target=self.watch_recv_new_site_msg)
-            thread.start()
+            # 先发一个消息再说
+            with safe_db_connection():
+                self.send_unread_msg_count()
         else:
             self.close()
 
+    def disconnect(self, code):
+        user = self.scope["user"]
+        if user.is_authenticated:
+            site_msg_hub.unregister(user.id, self.channel_name)
+
     def receive(self, text_data=None, bytes_data=None, **kwargs):
         data = json.loads(text_data)
         refresh_every_seconds = data.get('refresh_every_seconds')
@@ -42,18 +137,6 @@ class SiteMsgWebsocket(JsonWebsocketConsumer):
         logger.debug('Send unread count to user: {} {}'.format(user_id, unread_count))
         self.send_json({'type': 'unread_count', 'unread_count': unread_count})
 
-    def watch_recv_new_site_msg(self):
-        ws = self
-        user_id = str(self.scope["user"].id)
-
-        # 先发一个消息再说
-        with safe_db_connection():
-            self.send_unread_msg_count()
-
-        def handle_new_site_msg_recv(msg):
-            users = msg.get('users', [])
-            logger.debug('New site msg recv, message users: {}'.format(users))
-            if user_id in users:
-                ws.send_unread_msg_count()
-
-        new_site_msg_chan.keep_handle_msg(handle_new_site_msg_recv)
+    def unread_count(self, event):
+        """ SiteMsgHub 通过 channel layer 发来的未读数量 """
+        self.send_json({'type': 'unread_count', 'unread_count': event['unread_count']})
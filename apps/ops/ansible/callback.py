@@ -11,9 +11,15 @@ from ansible.plugins.callback.default import CallbackModule
 from ansible.plugins.callback.minimal import CallbackModule as CMDCallBackModule
 
 from common.utils.strings import safe_str
+from common.utils import get_logger
+
+logger = get_logger(__name__)
 
 
 class CallbackMixin:
+    # 每台主机每个任务有结果时调用: handler(t, host, task_name, task_result)
+    host_result_handler = None
+
     def __init__(self, display=None):
         # result_raw example: {
         #   "ok": {"hostname": {"task_name": {}，...},..},
@@ -61,6 +67,15 @@ class CallbackMixin:
 
         self.results_raw[t][host][task_name] = task_result
         self.clean_result(t, host, task_name, task_result)
+        self.handle_host_result(t, host, task_name, task_result)
+
+    def handle_host_result(self, t, host, task_name, task_result):
+        if not self.host_result_handler:
+            return
+        try:
+            self.host_result_handler(t, host, task_name, task_result)
+        except Exception as e:
+            logger.error(f'Handle host result error: host={host} task={task_name} {e}', exc_info=True)
 
     def close(self):
         if hasattr(self._display, 'close'):
@@ -125,9 +125,13 @@ class AdHocRunner:
     default_options = get_default_options()
     command_modules_choices = ('shell', 'raw', 'command', 'script', 'win_shell')
 
-    def __init__(self, inventory, options=None):
+    def __init__(self, inventory, options=None, host_result_handler=None):
+        """
+        :param host_result_handler: 每台主机的结果返回时就调用，不用等全部执行完
+        """
         self.options = self.update_options(options)
         self.inventory = inventory
+        self.host_result_handler = host_result_handler
         self.loader = DataLoader()
         self.variable_manager = VariableManager(
             loader=self.loader, inventory=self.inventory
@@ -202,6 +206,7 @@ class AdHocRunner:
         """
         self.check_pattern(pattern)
         self.results_callback = self.get_result_callback(execution_id)
+        self.results_callback.host_result_handler = self.host_result_handler
         cleaned_tasks = self.clean_tasks(tasks)
         self.set_control_master_if_need(cleaned_tasks)
         context.CLIARGS = ImmutableDict(self.options)
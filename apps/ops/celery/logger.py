@@ -8,6 +8,7 @@ from kombu import Connection, Exchange, Queue, Producer
 from kombu.mixins import ConsumerMixin
 
 from .utils import get_celery_task_log_path
+from ..task_log import TaskLogEndMark
 
 routing_key = 'celery_log'
 celery_log_exchange = Exchange('celery_log_exchange', type='direct')
@@ -185,6 +186,7 @@ class CeleryTaskFileHandler(CeleryTaskLoggerHandler):
 
     def handle_task_end(self, task_id):
         self.f and self.f.close()
+        TaskLogEndMark.mark(task_id)
 
 
 class CeleryThreadTaskFileHandler(CeleryThreadingLoggerHandler):
@@ -219,3 +221,5 @@ class CeleryThreadTaskFileHandler(CeleryThreadingLoggerHandler):
         if f and not f.closed:
             f.close()
         self.task_id_thread_id_mapper.pop(task_id, None)
+        # 文件关闭后再标记结束，读取日志的一方看到标记时内容已经写完
+        TaskLogEndMark.mark(task_id)
@@ -13,6 +13,7 @@ from django_celery_beat.models import (
 
 from common.utils.timezone import local_now
 from common.utils import get_logger
+from common.utils.connection import get_redis_client
 
 logger = get_logger(__name__)
 
@@ -126,8 +127,7 @@ def get_celery_status():
 
 
 def get_beat_status():
-    CONFIG = settings.CONFIG
-    r = redis.Redis(host=CONFIG.REDIS_HOST, port=CONFIG.REDIS_PORT, password=CONFIG.REDIS_PASSWORD)
+    r = get_redis_client()
     lock = redis_lock.Lock(r, name="beat-distribute-start-lock")
     try:
         locked = lock.locked()
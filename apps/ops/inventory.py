@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 #
+import random
+from collections import defaultdict
 
 from django.conf import settings
+from django.db.models import prefetch_related_objects
+from ansible.utils.unsafe_proxy import wrap_var
 from .ansible.inventory import BaseInventory
 
 from common.utils import get_logger
@@ -17,6 +21,69 @@ logger = get_logger(__file__)
 class JMSBaseInventory(BaseInventory):
     windows_ssh_default_shell = settings.WINDOWS_SSH_DEFAULT_SHELL
 
+    def prefetch_assets(self, assets, system_user_ids=()):
+        """
+        一次性查出生成主机信息需要的关联数据: 平台、网域、网关、标签、管理用户、特殊认证，
+        查询的次数与主机的数量无关
+        """
+        from assets.models import Gateway, AuthBook
+
+        assets = list(assets)
+        prefetch_related_objects(assets, 'platform', 'domain', 'admin_user', 'labels')
+
+        # domain_id --> [gateway, ]
+        self.domain_gateways_mapper = defaultdict(list)
+        domain_ids = {asset.domain_id for asset in assets if asset.domain_id}
+        if domain_ids:
+            gateways = Gateway.objects.filter(domain_id__in=domain_ids, is_active=True)
+            for gateway in gateways:
+                self.domain_gateways_mapper[gateway.domain_id].append(gateway)
+
+        # (asset_id, systemuser_id) --> [auth_book, ]
+        self.auth_books_mapper = defaultdict(list)
+        system_user_ids = {asset.admin_user_id for asset in assets if asset.admin_user_id} | set(system_user_ids)
+        if assets and system_user_ids:
+            auth_books = AuthBook.objects.filter(
+                asset_id__in=[asset.id for asset in assets],
+                systemuser_id__in=system_user_ids
+            ).select_related('systemuser')
+            for auth_book in auth_books:
+                auth_book.load_auth()
+                self.auth_books_mapper[(auth_book.asset_id, auth_book.systemuser_id)].append(auth_book)
+        return assets
+
+    def get_special_auth_book(self, asset, system_user, username=''):
+        """ 与 `SystemUser.load_asset_special_auth` 的选择规则一致 """
+        auth_books = self.auth_books_mapper.get((asset.id, system_user.id))
+        if not auth_books:
+            return None
+        if len(auth_books) == 1:
+            return auth_books[0]
+        auth_books = sorted(auth_books, key=lambda x: 1 if x.username == username else 0, reverse=True)
+        return auth_books[0]
+
+    def get_admin_auth_info(self, asset):
+        """ 与 `Asset.get_auth_info` 一致，不修改共享的管理用户对象 """
+        admin_user = asset.admin_user
+        if not admin_user:
+            return {}
+        auth = self.get_special_auth_book(asset, admin_user) or admin_user
+        return {
+            'username': admin_user.username,
+            'password': auth.password,
+            'private_key': auth.private_key_file,
+        }
+
+    def get_random_gateway(self, asset):
+        gateways = self.domain_gateways_mapper.get(asset.domain_id)
+        if not gateways:
+            return None
+        connective_gateways = [gw for gw in gateways if gw.is_connective]
+        if connective_gateways:
+            return random.choice(connective_gateways)
+        logger.warn(f'Gateway all bad. domain={asset.domain}, gateway_num={len(gateways)}.')
+        return random.choice(gateways)
+
     def convert_to_ansible(self, asset, run_as_admin=False):
         info = {
             'id': asset.id,
@@ -26,10 +93,11 @@ class JMSBaseInventory(BaseInventory):
             'vars': dict(),
             'groups': [],
         }
-        if asset.domain and asset.domain.has_gateway():
-            info["vars"].update(self.make_proxy_command(asset))
+        gateway = self.get_random_gateway(asset)
+        if gateway:
+            info["vars"].update(self.make_proxy_command(gateway))
         if run_as_admin:
-            info.update(asset.get_auth_info())
+            info.update(self.get_admin_auth_info(asset))
             if asset.is_unixlike():
                 info["become"] = {
                     "method": 'sudo',
@@ -52,8 +120,7 @@ class JMSBaseInventory(BaseInventory):
         return info
 
     @staticmethod
-    def make_proxy_command(asset):
-        gateway = asset.domain.random_gateway()
+    def make_proxy_command(gateway):
         proxy_command_list = [
             "ssh", "-o", "Port={}".format(gateway.port),
             "-o", "StrictHostKeyChecking=no",
@@ -80,45 +147,52 @@ class JMSInventory(JMSBaseInventory):
     write you own inventory, construct you inventory,
     user_info  is obtained from admin_user or asset_user
     """
-    def __init__(self, assets, run_as_admin=False, run_as=None, become_info=None, system_user=None):
+    def __init__(self, assets, run_as_admin=False, run_as=None, become_info=None, system_user=None,
+                 host_vars=None):
         """
         :param assets: assets
         :param run_as_admin: True 是否使用管理用户去执行, 每台服务器的管理用户可能不同
         :param run_as: 用户名(添加了统一的资产用户管理器之后AssetUserManager加上之后修改为username)
         :param become_info: 是否become成某个用户去执行
+        :param host_vars: 每台主机额外的变量 {asset_id: {k: v}}, 不会被模版渲染，可以放认证信息
         """
-        self.assets = assets
         self.using_admin = run_as_admin
         self.run_as = run_as
         self.system_user = system_user
         self.become_info = become_info
+        system_user_ids = [system_user.id] if system_user else []
+        self.assets = self.prefetch_assets(assets, system_user_ids=system_user_ids)
 
         host_list = []
 
-        for asset in assets:
+        for asset in self.assets:
             host = self.convert_to_ansible(asset, run_as_admin=run_as_admin)
             if run_as is not None:
-                run_user_info = self.get_run_user_info(host)
+                run_user_info = self.get_run_user_info(asset)
                 host.update(run_user_info)
             if become_info and asset.is_unixlike():
                 host.update(become_info)
+            if host_vars and str(asset.id) in host_vars:
+                host['vars'].update(wrap_var(host_vars[str(asset.id)]))
             host_list.append(host)
 
         super().__init__(host_list=host_list)
 
-    def get_run_user_info(self, host):
+    def get_run_user_info(self, asset):
         if not self.run_as and not self.system_user:
             return {}
 
-        asset_id = host.get('id', '')
-        asset = self.assets.filter(id=asset_id).first()
-        if not asset:
-            logger.error('Host not found: ', asset_id)
-            return {}
-
         if self.system_user:
-            self.system_user.load_asset_special_auth(asset=asset, username=self.run_as)
-            return self.system_user._to_secret_json()
+            # 与 `load_asset_special_auth` + `_to_secret_json` 一致，不修改系统用户对象
+            system_user = self.system_user
+            auth = self.get_special_auth_book(asset, system_user, username=self.run_as) or system_user
+            return {
+                'name': system_user.name,
+                'username': system_user.username,
+                'password': auth.password,
+                'public_key': auth.public_key,
+                'private_key': auth.private_key_file,
+            }
         else:
             return {}
 
@@ -132,7 +206,7 @@ class JMSCustomInventory(JMSBaseInventory):
     def __init__(self, assets, username, password=None, public_key=None, private_key=None):
         """
         """
-        self.assets = assets
+        self.assets = self.prefetch_assets(assets)
         self.username = username
         self.password = password
         self.public_key = public_key
@@ -140,7 +214,7 @@ class JMSCustomInventory(JMSBaseInventory):
 
         host_list = []
 
-        for asset in assets:
+        for asset in self.assets:
             host = self.convert_to_ansible(asset)
             run_user_info = self.get_run_user_info()
             host.update(run_user_info)
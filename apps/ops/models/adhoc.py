@@ -20,6 +20,7 @@ from orgs.mixins.models import OrgModelMixin
 from ..ansible import AdHocRunner, AnsibleError
 from ..inventory import JMSInventory
 from ..mixin import PeriodTaskModelMixin
+from ..task_log import TaskLogEndMark
 
 __all__ = ["Task", "AdHoc", "AdHocExecution"]
 
@@ -99,10 +100,10 @@ class Task(PeriodTaskModelMixin, OrgModelMixin):
     def get_run_execution(self):
         return self.execution.all()
 
-    def run(self):
+    def run(self, host_vars=None, host_result_handler=None):
         latest_adhoc = self.get_latest_adhoc()
         if latest_adhoc:
-            return latest_adhoc.run()
+            return latest_adhoc.run(host_vars=host_vars, host_result_handler=host_result_handler)
         else:
             return {'error': 'No adhoc'}
 
@@ -157,6 +158,12 @@ class AdHoc(OrgModelMixin):
 
     @property
     def inventory(self):
+        return self.get_inventory()
+
+    def get_inventory(self, host_vars=None):
+        """
+        :param host_vars: 每台主机额外的变量，只在本次执行时使用，不保存
+        """
         if self.become:
             become_info = {
                 'become': {
@@ -168,7 +175,8 @@ class AdHoc(OrgModelMixin):
 
         inventory = JMSInventory(
             self.hosts.all(), run_as_admin=self.run_as_admin,
-            run_as=self.run_as, become_info=become_info, system_user=self.run_system_user
+            run_as=self.run_as, become_info=become_info, system_user=self.run_system_user,
+            host_vars=host_vars
         )
         return inventory
 
@@ -178,7 +186,7 @@ class AdHoc(OrgModelMixin):
             return self.become.get("user", "")
         return ""
 
-    def run(self):
+    def run(self, host_vars=None, host_result_handler=None):
         try:
             celery_task_id = current_task.request.id
         except AttributeError:
@@ -192,7 +200,7 @@ class AdHoc(OrgModelMixin):
             hosts_amount=self.hosts.count(),
         )
         execution.save()
-        return execution.start()
+        return execution.start(host_vars=host_vars, host_result_handler=host_result_handler)
 
     @property
     def short_id(self):
@@ -265,8 +273,12 @@ class AdHocExecution(OrgModelMixin):
             os.makedirs(log_dir)
         return os.path.join(log_dir, str(self.id) + '.log')
 
-    def start_runner(self):
-        runner = AdHocRunner(self.adhoc.inventory, options=self.adhoc.options)
+    def start_runner(self, host_vars=None, host_result_handler=None):
+        inventory = self.adhoc.get_inventory(host_vars=host_vars)
+        runner = AdHocRunner(
+            inventory, options=self.adhoc.options,
+            host_result_handler=host_result_handler
+        )
         try:
             result = runner.run(
                 self.adhoc.tasks,
@@ -279,7 +291,7 @@ class AdHocExecution(OrgModelMixin):
             logger.warn("Failed run adhoc {}, {}".format(self.task.name, e))
             return {}, {}
 
-    def start(self):
+    def start(self, host_vars=None, host_result_handler=None):
         self.task.latest_execution = self
         self.task.save()
         time_start = time.time()
@@ -287,7 +299,7 @@ class AdHocExecution(OrgModelMixin):
         raw = ''
 
         try:
-            raw, summary = self.start_runner()
+            raw, summary = self.start_runner(host_vars=host_vars, host_result_handler=host_result_handler)
         except Exception as e:
             logger.error(e, exc_info=True)
             raw = {"dark": {"all": str(e)}, "contacted": []}
@@ -309,6 +321,7 @@ class AdHocExecution(OrgModelMixin):
             timedelta=time.time() - time_start,
             summary=summary
         )
+        TaskLogEndMark.mark(self.id)
 
     @property
     def success_hosts(self):
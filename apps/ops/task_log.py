@@ -0,0 +1,295 @@
+import os
+import time
+import asyncio
+import codecs
+
+from django.core.cache import cache
+
+from common.utils import get_logger
+from orgs.utils import tmp_to_root_org
+from .celery.utils import get_celery_task_log_path
+from .ansible.utils import get_ansible_task_log_path
+
+logger = get_logger(__name__)
+
+__all__ = ['TaskLogEndMark', 'TaskLogTail', 'TaskLogTailHub', 'task_log_tail_hub']
+
+
+class TaskLogEndMark:
+    """
+    任务结束时(日志文件已经关闭)写入的标记，读取日志的一方看到标记，读完文件后就可以结束了
+    """
+    cache_key_template = 'OPS_TASK_LOG_END_{}'
+    ttl = 3600 * 24
+
+    @classmethod
+    def mark(cls, task_id):
+        cache.set(cls.cache_key_template.format(task_id), 1, cls.ttl)
+
+    @classmethod
+    def is_ended(cls, task_id):
+        return bool(cache.get(cls.cache_key_template.format(task_id)))
+
+
+class TaskLogTail:
+    """
+    一个任务的日志只由一个协程读取，读到的内容发给所有订阅的 websocket
+    """
+    log_types = {
+        'celery': get_celery_task_log_path,
+        'ansible': get_ansible_task_log_path
+    }
+    chunk_size = 64 * 1024
+    min_interval = 0.2
+    max_interval = 1
+    wait_file_interval = 1
+    # 没有结束标记时(部署前的任务、标记过期、worker 被杀掉)，隔一段时间检查一次任务状态
+    state_check_interval = 5
+    # 日志文件这么久没有增长，并且任务状态也不能说明在运行，就结束
+    idle_timeout = 600
+    # 旧的日志中任务结束时输出的内容
+    end_markers = (b'succeeded in',)
+
+    def __init__(self, hub, log_type, task_id):
+        self.hub = hub
+        self.log_type = log_type
+        self.task_id = task_id
+        # { subscriber: offset }, 等待补发 offset 之后内容的订阅者
+        self.pending_subscribers = {}
+        self.subscribers = set()
+        self.position = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.task = None
+        self.seen_markers = set()
+        self.last_data = b''
+        self.last_growth_time = time.time()
+        self.last_state_check_time = time.time()
+
+    @property
+    def key(self):
+        return self.log_type, self.task_id
+
+    def get_log_path(self):
+        func = self.log_types.get(self.log_type)
+        if func:
+            return func(self.task_id)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def subscribe(self, subscriber, offset=0):
+        self.pending_subscribers[subscriber] = max(int(offset or 0), 0)
+
+    def unsubscribe(self, subscriber):
+        self.pending_subscribers.pop(subscriber, None)
+        self.subscribers.discard(subscriber)
+
+    @property
+    def has_subscribers(self):
+        return bool(self.subscribers or self.pending_subscribers)
+
+    async def run_sync(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def send(self, subscribers, data):
+        for subscriber in list(subscribers):
+            try:
+                await subscriber.send_json(data)
+            except Exception as e:
+                logger.debug(f'Send task log error, unsubscribe: {self.task_id} {e}')
+                self.unsubscribe(subscriber)
+
+    @staticmethod
+    def to_message(data):
+        return data.replace('\n', '\r\n')
+
+    async def wait_util_log_path_exist(self, log_path):
+        while self.has_subscribers:
+            exist = await self.run_sync(os.path.exists, log_path)
+            if exist:
+                return True
+            ended = await self.run_sync(self.is_task_ended)
+            if ended:
+                await self.send_end()
+                return False
+            await self.send(self.subscribers | set(self.pending_subscribers), {'message': '.', 'task': self.task_id})
+            await asyncio.sleep(self.wait_file_interval)
+        return False
+
+    @staticmethod
+    def read_range(f, offset, size):
+        f.seek(offset)
+        return f.read(size)
+
+    async def send_pending(self, f):
+        """
+        新的订阅者，先把 offset 到当前位置的内容发给它，之后再接收新内容;
+        offset 超过当前位置的(断线重连)，等读到那个位置再处理
+        """
+        for subscriber, offset in list(self.pending_subscribers.items()):
+            if offset > self.position:
+                continue
+            self.pending_subscribers.pop(subscriber, None)
+            await self.send([subscriber], {'message': '\r\n', 'task': self.task_id})
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+            while offset < self.position:
+                size = min(self.chunk_size, self.position - offset)
+                data = await self.run_sync(self.read_range, f, offset, size)
+                if not data:
+                    break
+                offset += len(data)
+                message = self.to_message(decoder.decode(data, final=offset >= self.position))
+                await self.send([subscriber], {'message': message, 'task': self.task_id, 'offset': offset})
+            self.subscribers.add(subscriber)
+
+    @property
+    def markers(self):
+        return (*self.end_markers, self.task_id.encode())
+
+    def check_end_markers(self, data):
+        # 拼上上次内容的结尾，标记可能被分在两次读取中
+        text = self.last_data[-64:] + data
+        for marker in self.markers:
+            if marker in text:
+                self.seen_markers.add(marker)
+        self.last_data = data
+
+    def is_markers_seen(self):
+        return len(self.seen_markers) == len(self.markers)
+
+    def get_task_state(self):
+        """
+        :return: True 已结束，False 在运行，None 不知道(任务记录不存在或结果已过期)
+        """
+        if self.log_type == 'ansible':
+            from .models import AdHocExecution
+            try:
+                with tmp_to_root_org():
+                    execution = AdHocExecution.objects.filter(id=self.task_id).only('is_finished').first()
+            except Exception:
+                return None
+            if execution is None:
+                return None
+            return execution.is_finished
+
+        from celery.result import AsyncResult
+        from celery import states
+        state = AsyncResult(self.task_id).state
+        if state == states.PENDING:
+            return None
+        return state in states.READY_STATES
+
+    def is_task_ended(self):
+        if self.is_markers_seen() or TaskLogEndMark.is_ended(self.task_id):
+            return True
+        now = time.time()
+        if now - self.last_state_check_time < self.state_check_interval:
+            return False
+        self.last_state_check_time = now
+        state = self.get_task_state()
+        if state:
+            return True
+        idle = now - self.last_growth_time > self.idle_timeout
+        if idle:
+            logger.debug(f'Task log idle too long, end it: {self.task_id} state={state}')
+        return idle
+
+    async def read_new(self, f):
+        data = await self.run_sync(self.read_range, f, self.position, self.chunk_size)
+        if not data:
+            return False
+        self.position += len(data)
+        self.last_growth_time = time.time()
+        self.check_end_markers(data)
+        message = self.to_message(self.decoder.decode(data))
+        await self.send(self.subscribers, {'message': message, 'task': self.task_id, 'offset': self.position})
+        return True
+
+    async def send_end(self):
+        logger.debug('Task log end: {}'.format(self.task_id))
+        subscribers = self.subscribers | set(self.pending_subscribers)
+        await self.send(subscribers, {'event': 'end', 'task': self.task_id})
+
+    async def run(self):
+        try:
+            await self._run()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f'Tail task log error: {self.task_id} {e}', exc_info=True)
+        finally:
+            self.hub.remove(self)
+
+    async def _run(self):
+        log_path = await self.run_sync(self.get_log_path)
+        if not log_path or not await self.wait_util_log_path_exist(log_path):
+            return
+        logger.debug('Task log path: {}'.format(log_path))
+        try:
+            f = await self.run_sync(open, log_path, 'rb')
+        except OSError:
+            logger.debug('Task log file is None: {}'.format(self.task_id))
+            return
+
+        interval = self.min_interval
+        try:
+            while self.has_subscribers:
+                if self.pending_subscribers:
+                    await self.send_pending(f)
+                if await self.read_new(f):
+                    # 有新内容时马上继续读，一次发送最多 chunk_size 的内容
+                    interval = self.min_interval
+                    continue
+                # 先检查是否结束再读一次，结束前写入的内容不会丢
+                ended = await self.run_sync(self.is_task_ended)
+                if ended:
+                    while await self.read_new(f):
+                        pass
+                    if self.pending_subscribers:
+                        await self.send_pending(f)
+                    await self.send_end()
+                    break
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_interval)
+        finally:
+            f.close()
+
+
+class TaskLogTailHub:
+    """
+    每个进程一个，同一个任务的多个 websocket 共用一个 TaskLogTail
+    """
+
+    def __init__(self):
+        self.tails = {}
+
+    def subscribe(self, subscriber, log_type, task_id, offset=0):
+        key = (log_type, task_id)
+        tail = self.tails.get(key)
+        is_new = tail is None
+        if is_new:
+            tail = TaskLogTail(self, log_type, task_id)
+            self.tails[key] = tail
+        tail.subscribe(subscriber, offset)
+        if is_new:
+            tail.start()
+        return tail
+
+    def unsubscribe(self, subscriber):
+        for tail in list(self.tails.values()):
+            tail.unsubscribe(subscriber)
+            if not tail.has_subscribers:
+                self.remove(tail)
+                tail.stop()
+
+    def remove(self, tail):
+        if self.tails.get(tail.key) is tail:
+            self.tails.pop(tail.key, None)
+
+
+task_log_tail_hub = TaskLogTailHub()
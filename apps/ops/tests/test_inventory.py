@@ -0,0 +1,70 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from assets.models import Asset, Domain, Gateway, Label, SystemUser, AuthBook
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from ops.inventory import JMSInventory
+
+
+class JMSInventoryQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.org = Organization.objects.create(name='test-inventory')
+        with tmp_to_org(self.org):
+            self.admin_user = SystemUser.objects.create(
+                name='admin', username='root', password='admin-password',
+                type=SystemUser.Type.admin
+            )
+            self.system_user = SystemUser.objects.create(
+                name='web', username='web', password='web-password'
+            )
+            self.domain = Domain.objects.create(name='test-domain')
+            Gateway.objects.create(
+                name='gateway', username='gateway', ip='10.0.0.1', domain=self.domain
+            )
+            self.label = Label.objects.create(name='env', value='test')
+        self.amount = 0
+
+    def create_assets(self, amount):
+        with tmp_to_org(self.org):
+            for i in range(self.amount, self.amount + amount):
+                asset = Asset.objects.create(
+                    hostname=f'host-{i}', ip=f'10.0.1.{i}', protocols='ssh/22',
+                    admin_user=self.admin_user, domain=self.domain
+                )
+                asset.labels.add(self.label)
+                AuthBook.objects.create(
+                    asset=asset, systemuser=self.system_user, password=f'special-{i}'
+                )
+        self.amount += amount
+
+    def build_inventory(self):
+        with tmp_to_org(self.org):
+            assets = Asset.objects.all()
+            with CaptureQueriesContext(connection) as context:
+                inventory = JMSInventory(
+                    assets, run_as_admin=True, run_as='web', system_user=self.system_user
+                )
+        return inventory, len(context.captured_queries)
+
+    def test_query_count_not_grow_with_hosts(self):
+        self.create_assets(2)
+        _, few_hosts_queries = self.build_inventory()
+
+        self.create_assets(20)
+        inventory, many_hosts_queries = self.build_inventory()
+
+        self.assertEqual(few_hosts_queries, many_hosts_queries)
+        self.assertEqual(len(inventory.host_list), 22)
+
+    def test_host_info(self):
+        self.create_assets(2)
+        inventory, _ = self.build_inventory()
+
+        for host in inventory.host_list:
+            i = host['hostname'].split('-')[-1]
+            self.assertEqual(host['password'], f'special-{i}')
+            self.assertEqual(host['username'], 'web')
+            self.assertEqual(host['vars']['env'], 'test')
+            self.assertIn('ansible_ssh_common_args', host['vars'])
@@ -1,89 +1,36 @@
-import time
-import os
-import threading
-import json
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
 from common.utils import get_logger
-from common.db.utils import close_old_connections
-from .celery.utils import get_celery_task_log_path
-from .ansible.utils import get_ansible_task_log_path
+from .task_log import task_log_tail_hub, TaskLogTail
 
 logger = get_logger(__name__)
 
 
-class TaskLogWebsocket(JsonWebsocketConsumer):
-    disconnected = False
+class TaskLogWebsocket(AsyncJsonWebsocketConsumer):
+    """
+    发送 {"task": "<task_id>", "type": "celery", "offset": 0} 订阅任务日志，
+    offset 是已经收到的字节数，断线重连时从这里继续;
+    收到的日志消息中带有 offset，任务结束时收到 {"event": "end"}
+    """
 
-    log_types = {
-        'celery': get_celery_task_log_path,
-        'ansible': get_ansible_task_log_path
-    }
-
-    def connect(self):
+    async def connect(self):
         user = self.scope["user"]
         if user.is_authenticated:
-            self.accept()
+            await self.accept()
         else:
-            self.close()
-
-    def get_log_path(self, task_id):
-        func = self.log_types.get(self.log_type)
-        if func:
-            return func(task_id)
-
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
-        data = json.loads(text_data)
-        task_id = data.get('task')
-        self.log_type = data.get('type', 'celery')
-        if task_id:
-            self.handle_task(task_id)
+            await self.close()
 
-    def wait_util_log_path_exist(self, task_id):
-        log_path = self.get_log_path(task_id)
-        while not self.disconnected:
-            if not os.path.exists(log_path):
-                self.send_json({'message': '.', 'task': task_id})
-                time.sleep(0.5)
-                continue
-            self.send_json({'message': '\r\n'})
-            try:
-                logger.debug('Task log path: {}'.format(log_path))
-                task_log_f = open(log_path, 'rb')
-                return task_log_f
-            except OSError:
-                return None
-
-    def read_log_file(self, task_id):
-        task_log_f = self.wait_util_log_path_exist(task_id)
-        if not task_log_f:
-            logger.debug('Task log file is None: {}'.format(task_id))
+    async def receive_json(self, content, **kwargs):
+        task_id = content.get('task')
+        log_type = content.get('type', 'celery')
+        if not task_id or log_type not in TaskLogTail.log_types:
             return
-
-        task_end_mark = []
-        while not self.disconnected:
-            data = task_log_f.read(4096)
-            if data:
-                data = data.replace(b'\n', b'\r\n')
-                self.send_json(
-                    {'message': data.decode(errors='ignore'), 'task': task_id}
-                )
-                if data.find(b'succeeded in') != -1:
-                    task_end_mark.append(1)
-                if data.find(bytes(task_id, 'utf8')) != -1:
-                    task_end_mark.append(1)
-            elif len(task_end_mark) == 2:
-                logger.debug('Task log end: {}'.format(task_id))
-                break
-            time.sleep(0.2)
-        task_log_f.close()
-
-    def handle_task(self, task_id):
+        try:
+            offset = int(content.get('offset') or 0)
+        except (TypeError, ValueError):
+            offset = 0
         logger.info("Task id: {}".format(task_id))
-        thread = threading.Thread(target=self.read_log_file, args=(task_id,))
-        thread.start()
+        task_log_tail_hub.subscribe(self, log_type, str(task_id), offset)
 
-    def disconnect(self, close_code):
-        self.disconnected = True
-        self.close()
-        close_old_connections()
+    async def disconnect(self, close_code):
+        task_log_tail_hub.unsubscribe(self)
@@ -5,7 +5,7 @@ from rest_framework_bulk import BulkModelViewSet
 from rest_framework.exceptions import MethodNotAllowed
 from django.utils.translation import ugettext_lazy as _
 
-from common.mixins import CommonApiMixin, RelationMixin
+from common.mixins import CommonApiMixin, RelationMixin, StreamExportMixin
 from orgs.utils import current_org
 
 from ..utils import set_to_root_org
@@ -46,7 +46,7 @@ class OrgViewSetMixin(OrgQuerySetMixin):
     pass
 
 
-class OrgModelViewSet(CommonApiMixin, OrgViewSetMixin, ModelViewSet):
+class OrgModelViewSet(CommonApiMixin, OrgViewSetMixin, StreamExportMixin, ModelViewSet):
     pass
 
 
@@ -54,7 +54,7 @@ class OrgGenericViewSet(CommonApiMixin, OrgViewSetMixin, GenericViewSet):
     pass
 
 
-class OrgBulkModelViewSet(CommonApiMixin, OrgViewSetMixin, BulkModelViewSet):
+class OrgBulkModelViewSet(CommonApiMixin, OrgViewSetMixin, StreamExportMixin, BulkModelViewSet):
     def allow_bulk_destroy(self, qs, filtered):
         qs_count = qs.count()
         filtered_count = filtered.count()
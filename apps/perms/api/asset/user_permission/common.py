@@ -12,9 +12,14 @@ from rest_framework.generics import (
 )
 
 from orgs.utils import tmp_to_root_org
-from perms.utils.asset.permission import get_asset_system_user_ids_with_actions_by_user, validate_permission
+from perms.models import Action
+from perms.utils.asset.permission import (
+    get_asset_system_user_ids_with_actions_by_user, get_user_asset_permission_decision,
+    get_user_asset_permission_decisions_with_cache,
+)
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAdmin, IsValidUser
-from common.utils import get_logger, lazyproperty
+from common.utils import get_logger, lazyproperty, is_uuid
+from common.mixins.api import NonAtomicRequestsMixin
 
 from perms.hands import User, Asset, SystemUser
 from perms import serializers
@@ -25,14 +30,25 @@ __all__ = [
     'RefreshAssetPermissionCacheApi',
     'UserGrantedAssetSystemUsersForAdminApi',
     'ValidateUserAssetPermissionApi',
+    'ValidateUserAssetPermissionBatchApi',
     'GetUserAssetPermissionActionsApi',
     'UserAssetPermissionsCacheApi',
     'MyGrantedAssetSystemUsersApi',
 ]
 
 
+def get_decision_data(decision, action_name):
+    actions = Action.value_to_choices(decision.actions)
+    return {
+        # TODO: 组件改造API完成后统一通过actions判断has_perm
+        'has_permission': action_name in actions,
+        'actions': actions,
+        'expire_at': int(decision.expire_at)
+    }
+
+
 @method_decorator(tmp_to_root_org(), name='get')
-class GetUserAssetPermissionActionsApi(RetrieveAPIView):
+class GetUserAssetPermissionActionsApi(NonAtomicRequestsMixin, RetrieveAPIView):
     permission_classes = (IsOrgAdminOrAppUser,)
     serializer_class = serializers.ActionsSerializer
 
@@ -60,7 +76,7 @@ class GetUserAssetPermissionActionsApi(RetrieveAPIView):
 
 
 @method_decorator(tmp_to_root_org(), name='get')
-class ValidateUserAssetPermissionApi(APIView):
+class ValidateUserAssetPermissionApi(NonAtomicRequestsMixin, APIView):
     permission_classes = (IsOrgAdminOrAppUser,)
 
     def get_cache_policy(self):
@@ -80,21 +96,45 @@ class ValidateUserAssetPermissionApi(APIView):
 
         if not all((user_id, asset_id, system_id, action_name)):
             return Response(data)
+        if not is_uuid([user_id, asset_id, system_id]):
+            return Response(data, status=status.HTTP_403_FORBIDDEN)
 
-        user = User.objects.get(id=user_id)
-        asset = Asset.objects.valid().get(id=asset_id)
-        system_user = SystemUser.objects.get(id=system_id)
-
-        has_perm, actions, expire_at = validate_permission(user, asset, system_user, action_name)
-        status_code = status.HTTP_200_OK if has_perm else status.HTTP_403_FORBIDDEN
-        data = {
-            'has_permission': has_perm,
-            'actions': actions,
-            'expire_at': int(expire_at)
-        }
+        # 结果有缓存，不需要查询用户、资产、系统用户
+        decision = get_user_asset_permission_decision(user_id, asset_id, system_id)
+        data = get_decision_data(decision, action_name)
+        status_code = status.HTTP_200_OK if data['has_permission'] else status.HTTP_403_FORBIDDEN
         return Response(data, status=status_code)
 
 
+@method_decorator(tmp_to_root_org(), name='post')
+class ValidateUserAssetPermissionBatchApi(NonAtomicRequestsMixin, APIView):
+    """
+    一次验证用户对多个 (资产, 系统用户) 的权限
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+    serializer_class = serializers.ValidateUserAssetPermissionBatchSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_id = serializer.validated_data['user_id']
+        items = serializer.validated_data['items']
+
+        pairs = [(str(item['asset_id']), str(item['system_user_id'])) for item in items]
+        decisions = get_user_asset_permission_decisions_with_cache(user_id, pairs)
+
+        results = []
+        for pair, item in zip(pairs, items):
+            data = get_decision_data(decisions[pair], item['action_name'])
+            data.update({
+                'asset_id': pair[0],
+                'system_user_id': pair[1],
+                'action_name': item['action_name'],
+            })
+            results.append(data)
+        return Response(results)
+
+
 # TODO 删除
 class RefreshAssetPermissionCacheApi(RetrieveAPIView):
     permission_classes = (IsOrgAdmin,)
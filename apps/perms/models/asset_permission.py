@@ -3,11 +3,11 @@ import logging
 from django.utils.translation import ugettext_lazy as _
 from django.db.models import F
 
-from common.db.models import TextChoices
+from common.db.models import TextChoices, replace_prefix
 from orgs.mixins.models import OrgModelMixin
 from common.db import models
 from common.utils import lazyproperty
-from assets.models import Asset, SystemUser, Node, FamilyMixin
+from assets.models import Asset, SystemUser, Node, FamilyMixin, compute_parent_key
 
 from .base import BasePermission
 
@@ -110,6 +110,24 @@ class UserAssetGrantedTreeNodeRelation(OrgModelMixin, FamilyMixin, models.JMSBas
     def parent_key(self):
         return self.node_parent_key
 
+    @classmethod
+    def replace_node_key_prefix(cls, old_key, new_key):
+        """
+        节点移动后，一条 update 替换授权树中该节点及其后代的 node_key、node_parent_key，
+        返回有这些节点的用户
+        """
+        descendants = cls.objects.filter(node_key__startswith=f'{old_key}:')
+        user_ids = set(descendants.values_list('user_id', flat=True).distinct())
+        descendants.update(
+            node_key=replace_prefix('node_key', old_key, new_key),
+            node_parent_key=replace_prefix('node_parent_key', old_key, new_key),
+        )
+
+        rels = cls.objects.filter(node_key=old_key)
+        user_ids.update(rels.values_list('user_id', flat=True).distinct())
+        rels.update(node_key=new_key, node_parent_key=compute_parent_key(new_key))
+        return user_ids
+
     @classmethod
     def get_node_granted_status(cls, user, key):
         ancestor_keys = set(cls.get_node_ancestor_keys(key, with_self=True))
@@ -12,6 +12,7 @@ __all__ = [
     'NodeGrantedSerializer',
     'AssetGrantedSerializer',
     'ActionsSerializer', 'AssetSystemUserSerializer',
+    'ValidateUserAssetPermissionBatchSerializer',
     'RemoteAppSystemUserSerializer',
     'DatabaseAppSystemUserSerializer',
     'K8sAppSystemUserSerializer',
@@ -66,6 +67,25 @@ class ActionsSerializer(serializers.Serializer):
     actions = ActionsField(read_only=True)
 
 
+class ValidateUserAssetPermissionItemSerializer(serializers.Serializer):
+    asset_id = serializers.UUIDField()
+    system_user_id = serializers.UUIDField()
+    action_name = serializers.CharField(default='connect')
+
+
+class ValidateUserAssetPermissionBatchSerializer(serializers.Serializer):
+    user_id = serializers.UUIDField()
+    items = ValidateUserAssetPermissionItemSerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        max_amount = 500
+        if len(items) > max_amount:
+            raise serializers.ValidationError(
+                _('Ensure this field has no more than {} elements').format(max_amount)
+            )
+        return items
+
+
 # TODO: 删除
 class RemoteAppSystemUserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -1,3 +1,4 @@
 from . import asset_permission
 from . import app_permission
 from . import refresh_perms
+from . import permission_decision
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from assets.models import Asset, SystemUser
+from common.utils import get_logger
+from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
+from perms.models import AssetPermission
+from perms.utils.asset.decision_cache import asset_permission_decision_cache
+from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
+
+
+logger = get_logger(__file__)
+
+# 授权树不关心的变化(动作、系统用户、资产协议等)，但会影响授权判断的结果
+
+
+def expire_asset_perm_users_decisions(asset_perm_ids):
+    user_ids = UserGrantedTreeRefreshController.get_asset_perms_related_user_ids(asset_perm_ids)
+    asset_permission_decision_cache.expire_users(user_ids)
+
+
+@receiver(post_save, sender=AssetPermission)
+def on_asset_perm_post_save(sender, instance, created, **kwargs):
+    if created:
+        return
+    # 动作、有效期等变化
+    expire_asset_perm_users_decisions([instance.id])
+
+
+@receiver(m2m_changed, sender=AssetPermission.system_users.through)
+def on_asset_perm_system_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in (POST_ADD, POST_REMOVE, POST_CLEAR):
+        return
+    if not reverse:
+        asset_perm_ids = [instance.id]
+    elif action == POST_CLEAR:
+        # 系统用户 `post_clear` 没有 `pk_set`，不知道影响了哪些授权
+        asset_permission_decision_cache.expire_all()
+        return
+    else:
+        asset_perm_ids = pk_set
+    expire_asset_perm_users_decisions(asset_perm_ids)
+
+
+@receiver([post_save, post_delete], sender=Asset)
+@receiver([post_save, post_delete], sender=SystemUser)
+def on_asset_or_system_user_change(sender, instance, **kwargs):
+    # 资产的协议、状态，系统用户的协议
+    asset_permission_decision_cache.expire_objects([instance.id])
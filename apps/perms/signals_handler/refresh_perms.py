@@ -4,12 +4,13 @@ from django.db.models.signals import m2m_changed, pre_delete, pre_save, post_sav
 from django.dispatch import receiver
 
 from users.models import User, UserGroup
-from assets.models import Asset
+from assets.models import Asset, Node, compute_parent_key
+from assets.signals import post_node_moved
 from orgs.utils import current_org, tmp_to_org
 from common.utils import get_logger
 from common.exceptions import M2MReverseNotAllowed
 from common.const.signals import POST_ADD, POST_REMOVE, POST_CLEAR
-from perms.models import AssetPermission
+from perms.models import AssetPermission, UserAssetGrantedTreeNodeRelation
 from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
 
 
@@ -76,12 +77,39 @@ def on_asset_perm_post_save(sender, instance, created, **kwargs):
         UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
 
 
+@receiver(post_node_moved, sender=Node)
+def on_node_moved(sender, instance, old_key, **kwargs):
+    """
+    节点移动后先替换授权树中的 key，再增量更新：
+    原父节点和新位置的祖先节点资产数量变化，新位置的祖先节点的授权也会影响该节点，
+    授权了原位置或新位置祖先节点的用户，能访问的资产都发生了变化
+    """
+    with tmp_to_org(instance.org_id):
+        user_ids = UserAssetGrantedTreeNodeRelation.replace_node_key_prefix(old_key, instance.key)
+        ancestor_keys = set(Node.get_node_ancestor_keys(old_key))
+        ancestor_keys.update(Node.get_node_ancestor_keys(instance.key))
+        ancestor_ids = Node.objects.filter(key__in=ancestor_keys).values_list('id', flat=True)
+        asset_perm_ids = AssetPermission.nodes.through.objects.filter(
+            node_id__in=ancestor_ids
+        ).values_list('assetpermission_id', flat=True)
+        # 事务提交后 `add_changed_node_keys_for_users` 会清除这些用户的授权判断缓存
+        user_ids.update(UserGrantedTreeRefreshController.get_asset_perms_related_user_ids(asset_perm_ids))
+        changed_keys = {instance.key}
+        old_parent_key = compute_parent_key(old_key)
+        if old_parent_key:
+            changed_keys.add(old_parent_key)
+        UserGrantedTreeRefreshController.add_changed_node_keys_for_users(
+            current_org.id, user_ids, changed_keys
+        )
+        UserGrantedTreeRefreshController.add_need_refresh_on_nodes_assets_relate_change([instance.id], [])
+
+
 def need_rebuild_mapping_node(action):
     return action in (POST_REMOVE, POST_ADD, POST_CLEAR)
 
 
 @receiver(m2m_changed, sender=AssetPermission.nodes.through)
-def on_permission_nodes_changed(sender, instance, action, reverse, **kwargs):
+def on_permission_nodes_changed(sender, instance, action, reverse, pk_set, **kwargs):
     if reverse:
         raise M2MReverseNotAllowed
 
@@ -89,7 +117,13 @@ def on_permission_nodes_changed(sender, instance, action, reverse, **kwargs):
         return
 
     with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+        if action == POST_CLEAR:
+            # `post_clear` 没有 `pk_set`，不知道移除了哪些，只能全量重建
+            UserGrantedTreeRefreshController.add_need_rebuild_by_asset_perm_ids([instance.id])
+            return
+        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids(
+            [instance.id], node_ids=pk_set
+        )
 
 
 @receiver(m2m_changed, sender=AssetPermission.assets.through)
@@ -100,7 +134,13 @@ def on_permission_assets_changed(sender, instance, action, reverse, pk_set, mode
     if not need_rebuild_mapping_node(action):
         return
     with tmp_to_org(instance.org):
-        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids([instance.id])
+        if action == POST_CLEAR:
+            # `post_clear` 没有 `pk_set`，不知道移除了哪些，只能全量重建
+            UserGrantedTreeRefreshController.add_need_rebuild_by_asset_perm_ids([instance.id])
+            return
+        UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids(
+            [instance.id], asset_ids=pk_set
+        )
 
 
 @receiver(m2m_changed, sender=AssetPermission.users.through)
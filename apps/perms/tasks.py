@@ -7,7 +7,7 @@ from django.db.transaction import atomic
 from django.conf import settings
 from celery import shared_task
 
-from orgs.utils import tmp_to_root_org
+from orgs.utils import tmp_to_root_org, tmp_to_org
 from common.utils import get_logger
 from common.utils.timezone import local_now, dt_formatter, dt_parser
 from ops.celery.decorator import register_as_period_task
@@ -16,7 +16,9 @@ from perms.notifications import (
     PermedAppsWillExpireUserMsg, AppPermsWillExpireForOrgAdminMsg
 )
 from perms.models import AssetPermission, ApplicationPermission
-from perms.utils.asset.user_permission import UserGrantedTreeRefreshController
+from perms.utils.asset.user_permission import (
+    UserGrantedTreeRefreshController, UserGrantedTreeBulkBuildUtils
+)
 
 logger = get_logger(__file__)
 
@@ -55,6 +57,15 @@ def check_asset_permission_expired():
     UserGrantedTreeRefreshController.add_need_refresh_by_asset_perm_ids_cross_orgs(asset_perm_ids)
 
 
+@shared_task()
+def rebuild_users_granted_tree_task(org_id, user_ids):
+    """
+    授权变化影响大量用户时，预先构建这些用户的授权树，避免用户登录时再构建
+    """
+    with tmp_to_org(org_id):
+        UserGrantedTreeBulkBuildUtils(user_ids).rebuild()
+
+
 @register_as_period_task(crontab='0 10 * * *')
 @shared_task()
 @atomic()
@@ -1,3 +1,218 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
 
-from django.contrib.sessions.backends import file, db, cache
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from assets.models import Asset, Node, SystemUser
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from users.models import User
+from perms.models import AssetPermission, UserAssetGrantedTreeNodeRelation, Action
+from perms.utils.asset.user_permission import UserGrantedTreeBuildUtils
+from perms.utils.asset.decision_cache import asset_permission_decision_cache
+from perms.utils.asset.permission import (
+    get_user_asset_permission_decisions, get_user_asset_permission_decisions_with_cache,
+)
+
+
+class UserGrantedTreeUpdateTestCase(TestCase):
+    """
+    增量更新(`update_user_granted_tree`)与全量重建(`rebuild_user_granted_tree`)的结果要相同
+    """
+
+    def setUp(self):
+        self.org = Organization.default()
+        with tmp_to_org(self.org):
+            self.user = User.objects.create(
+                username='tree_test_user', name='tree_test_user', email='tree_test_user@example.com'
+            )
+            self.root = Node.org_root()
+            self.a = self.root.create_child('a')
+            self.a1 = self.a.create_child('a1')
+            self.b = self.root.create_child('b')
+            self.b1 = self.b.create_child('b1')
+            self.b2 = self.b.create_child('b2')
+
+            self.h1 = self.create_asset('h1', self.a1)
+            self.h2 = self.create_asset('h2', self.b1)
+            self.h3 = self.create_asset('h3', self.b)
+            self.h4 = self.create_asset('h4', self.a1, self.b1)
+            self.h5 = self.create_asset('h5', self.b2)
+
+            self.node_perm = self.create_perm('tree_test_node_perm')
+            self.node_perm.nodes.add(self.a)
+            self.asset_perm = self.create_perm('tree_test_asset_perm')
+            self.asset_perm.assets.add(self.h2, self.h4)
+            self.rebuild()
+
+    @staticmethod
+    def create_asset(hostname, *nodes):
+        asset = Asset.objects.create(hostname=hostname, ip='127.0.0.1')
+        asset.nodes.set(nodes)
+        return asset
+
+    def create_perm(self, name):
+        perm = AssetPermission.objects.create(name=name)
+        perm.users.add(self.user)
+        return perm
+
+    def get_relations(self):
+        rels = UserAssetGrantedTreeNodeRelation.objects.filter(user=self.user).values_list(
+            'node_key', 'node_parent_key', 'node_from', 'node_assets_amount'
+        )
+        return sorted(rels)
+
+    def rebuild(self):
+        UserGrantedTreeBuildUtils(self.user).rebuild_user_granted_tree()
+
+    def assert_update_same_as_rebuild(self, changed_node_keys):
+        with tmp_to_org(self.org):
+            UserGrantedTreeBuildUtils(self.user).update_user_granted_tree(changed_node_keys)
+            updated = self.get_relations()
+            self.rebuild()
+            rebuilt = self.get_relations()
+        self.assertEqual(updated, rebuilt)
+
+    def test_grant_asset(self):
+        self.asset_perm.assets.add(self.h3, self.h5)
+        self.assert_update_same_as_rebuild({self.b.key, self.b2.key})
+
+    def test_revoke_asset(self):
+        self.asset_perm.assets.remove(self.h2)
+        self.assert_update_same_as_rebuild({self.b1.key})
+
+    def test_grant_node(self):
+        self.node_perm.nodes.add(self.b1)
+        self.assert_update_same_as_rebuild({self.b1.key})
+
+    def test_revoke_node(self):
+        self.node_perm.nodes.remove(self.a)
+        self.assert_update_same_as_rebuild({self.a.key})
+
+    def test_node_assets_change(self):
+        self.h5.nodes.add(self.b1)
+        self.h2.nodes.set([self.b2])
+        self.assert_update_same_as_rebuild({self.b1.key, self.b2.key})
+
+    def test_unrelated_change(self):
+        self.h1.nodes.add(self.b2)
+        self.assert_update_same_as_rebuild({self.b2.key})
+
+
+class AssetPermissionDecisionTestCase(TransactionTestCase):
+    """
+    授权判断的结果、缓存以及缓存失效；信号在事务提交后清除缓存，所以使用 TransactionTestCase
+    """
+
+    def setUp(self):
+        self.org = Organization.default()
+        with tmp_to_org(self.org):
+            self.user = User.objects.create(
+                username='decision_test_user', name='decision_test_user',
+                email='decision_test_user@example.com'
+            )
+            self.node = Node.org_root().create_child('decision')
+            self.asset = Asset.objects.create(hostname='decision_host', ip='127.0.0.1')
+            self.asset.nodes.set([self.node])
+            self.other_asset = Asset.objects.create(hostname='decision_other_host', ip='127.0.0.2')
+            self.system_user = SystemUser.objects.create(
+                name='decision_system_user', username='root', protocol='ssh'
+            )
+            self.perm = AssetPermission.objects.create(
+                name='decision_perm', actions=Action.CONNECT | Action.UPLOAD
+            )
+            self.perm.users.add(self.user)
+            self.perm.nodes.add(self.node)
+            self.perm.system_users.add(self.system_user)
+        self.pair = (str(self.asset.id), str(self.system_user.id))
+        self.other_pair = (str(self.other_asset.id), str(self.system_user.id))
+
+    def get_decisions(self):
+        return get_user_asset_permission_decisions_with_cache(self.user.id, [self.pair, self.other_pair])
+
+    def assert_cached(self, cached=True):
+        decisions, missed = asset_permission_decision_cache.get_many(self.user.id, [self.pair])
+        self.assertEqual(bool(decisions), cached)
+        self.assertEqual(bool(missed), not cached)
+
+    def test_decisions(self):
+        decisions = get_user_asset_permission_decisions(self.user, [self.pair, self.other_pair])
+        decision = decisions[self.pair]
+        self.assertEqual(decision.actions, Action.CONNECT | Action.UPLOAD)
+        self.assertEqual(int(decision.expire_at), int(self.perm.date_expired.timestamp()))
+        self.assertLessEqual(decision.valid_until, time.time() + asset_permission_decision_cache.ttl)
+        self.assertEqual(decisions[self.other_pair].actions, Action.NONE)
+
+    def test_no_perm_decision_valid_until_next_perm_start(self):
+        date_start = timezone.now() + timedelta(seconds=60)
+        perm = AssetPermission.objects.create(name='decision_future_perm', date_start=date_start)
+        perm.users.add(self.user)
+        perm.assets.add(self.other_asset)
+        perm.system_users.add(self.system_user)
+
+        decisions = get_user_asset_permission_decisions(self.user, [self.pair, self.other_pair])
+        self.assertEqual(decisions[self.other_pair].actions, Action.NONE)
+        self.assertLessEqual(decisions[self.other_pair].valid_until, date_start.timestamp())
+        self.assertLessEqual(decisions[self.pair].valid_until, date_start.timestamp())
+
+    def test_cache_hit(self):
+        first = self.get_decisions()
+        self.assert_cached()
+        self.assertEqual(self.get_decisions(), first)
+
+    def test_expire_on_perm_actions_change(self):
+        self.get_decisions()
+        self.perm.actions = Action.CONNECT
+        self.perm.save()
+        self.assert_cached(False)
+        self.assertEqual(self.get_decisions()[self.pair].actions, Action.CONNECT)
+
+    def test_expire_on_perm_users_change(self):
+        self.get_decisions()
+        self.perm.users.remove(self.user)
+        self.assert_cached(False)
+        self.assertEqual(self.get_decisions()[self.pair].actions, Action.NONE)
+
+    def test_expire_on_node_assets_change(self):
+        self.get_decisions()
+        self.asset.nodes.set([Node.org_root()])
+        self.assert_cached(False)
+        self.assertEqual(self.get_decisions()[self.pair].actions, Action.NONE)
+
+    def test_expire_on_system_user_change(self):
+        self.get_decisions()
+        self.system_user.protocol = 'rdp'
+        self.system_user.save()
+        self.assert_cached(False)
+        self.assertEqual(self.get_decisions()[self.pair].actions, Action.NONE)
+
+    def test_validate_batch_api(self):
+        admin = User.objects.create(
+            username='decision_test_admin', name='decision_test_admin',
+            email='decision_test_admin@example.com', role=User.ROLE.ADMIN
+        )
+        client = APIClient()
+        client.force_authenticate(admin)
+        url = reverse('api-perms:validate-user-asset-permission-batch')
+        data = {
+            'user_id': str(self.user.id),
+            'items': [
+                {'asset_id': self.pair[0], 'system_user_id': self.pair[1], 'action_name': 'upload_file'},
+                {'asset_id': self.pair[0], 'system_user_id': self.pair[1], 'action_name': 'download_file'},
+                {'asset_id': self.other_pair[0], 'system_user_id': self.other_pair[1]},
+            ]
+        }
+        response = client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(
+            [r['has_permission'] for r in results], [True, False, False]
+        )
+        self.assertEqual(results[2]['action_name'], 'connect')
+
+        data['items'] = []
+        response = client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 400)
@@ -98,6 +98,7 @@ permission_urlpatterns = [
 
     # 验证用户是否有某个资产和系统用户的权限
     path('user/validate/', api.ValidateUserAssetPermissionApi.as_view(), name='validate-user-asset-permission'),
+    path('user/validate/batch/', api.ValidateUserAssetPermissionBatchApi.as_view(), name='validate-user-asset-permission-batch'),
     path('user/actions/', api.GetUserAssetPermissionActionsApi.as_view(), name='get-user-asset-permission-actions'),
 
     # 刷新缓存
@@ -0,0 +1,206 @@
+import json
+import time
+import threading
+from collections import Counter, namedtuple
+
+from django.conf import settings
+
+from common.utils import get_logger
+from common.utils.connection import get_redis_client
+from common.decorator import on_transaction_commit
+
+logger = get_logger(__name__)
+
+__all__ = [
+    'PermissionDecision', 'AssetPermissionDecisionCache', 'asset_permission_decision_cache',
+]
+
+# actions: 授权的动作(Action 的位值)，expire_at: 授权最晚的过期时间,
+# valid_until: 这个结果的有效期，之后授权可能过期或生效，需要重新计算
+PermissionDecision = namedtuple('PermissionDecision', ('actions', 'expire_at', 'valid_until'))
+
+
+class AssetPermissionDecisionCache:
+    """
+    用户对 (资产, 系统用户) 的授权判断结果缓存
+
+    每个用户一个 redis hash，field 是 `资产id:系统用户id`，值中记录了计算时
+    全局、用户、资产、系统用户 的版本号，任何一个版本号变化，这个结果就失效了:
+    - 用户: 与 `UserGrantedTreeRefreshController` 相同的信号，授权相关的变化都会使相关用户失效
+    - 资产、系统用户: 资产的协议、状态，系统用户的协议变化
+    - 全局: 无法确定影响范围的变化
+    查询时版本号与结果在一次 redis 请求中获取
+    """
+    key_template = 'perms.user.asset_permission_decisions.user_id:{user_id}'
+    generation_key_template = 'perms.asset_permission_decision.generation.{}'
+    global_generation_key = generation_key_template.format('global')
+    metrics_key = 'perms.asset_permission_decision.metrics'
+    metrics_flush_interval = 10
+    # 没有授权时，结果最长保存时间，避免之后生效的授权一直无法使用
+    ttl = 600
+
+    def __init__(self):
+        self._counter = Counter()
+        self._lock = threading.Lock()
+        self._last_flush_time = time.time()
+
+    @property
+    def client(self):
+        return get_redis_client(settings.REDIS_DB_CACHE)
+
+    @classmethod
+    def get_field(cls, asset_id, system_user_id):
+        return f'{asset_id}:{system_user_id}'
+
+    def get_generation_keys(self, user_id, asset_id, system_user_id):
+        return [
+            self.global_generation_key,
+            self.generation_key_template.format(user_id),
+            self.generation_key_template.format(asset_id),
+            self.generation_key_template.format(system_user_id),
+        ]
+
+    def get_many(self, user_id, pairs):
+        """
+        :param pairs: [(asset_id, system_user_id), ...]
+        :return: ({(asset_id, system_user_id): PermissionDecision}, {(asset_id, system_user_id): generations})
+            第二个值是未命中的项当前的版本号，计算完成后用它保存，计算期间发生的变化会使保存的结果失效
+        """
+        pairs = [(str(asset_id), str(system_user_id)) for asset_id, system_user_id in pairs]
+        if not pairs:
+            return {}, {}
+        gen_keys = []
+        for asset_id, system_user_id in pairs:
+            gen_keys.extend(self.get_generation_keys(user_id, asset_id, system_user_id))
+        gen_keys = list(dict.fromkeys(gen_keys))
+        fields = [self.get_field(*pair) for pair in pairs]
+
+        with self.client.pipeline(transaction=False) as p:
+            p.mget(gen_keys)
+            p.hmget(self.key_template.format(user_id=user_id), fields)
+            gen_values, values = p.execute()
+
+        key_gen_mapper = {k: int(v or 0) for k, v in zip(gen_keys, gen_values)}
+        now = time.time()
+        decisions = {}
+        missed = {}
+        for pair, value in zip(pairs, values):
+            generations = [key_gen_mapper[k] for k in self.get_generation_keys(user_id, *pair)]
+            decision = self.load_value(value, generations, now)
+            if decision is None:
+                missed[pair] = generations
+            else:
+                decisions[pair] = decision
+        self.incr_metrics(hit=len(decisions), miss=len(missed))
+        return decisions, missed
+
+    @staticmethod
+    def load_value(value, generations, now):
+        if not value:
+            return None
+        try:
+            *decision, value_generations = json.loads(value)
+        except (ValueError, TypeError):
+            return None
+        decision = PermissionDecision(*decision)
+        if value_generations != generations or decision.valid_until <= now:
+            return None
+        return decision
+
+    def set_many(self, user_id, decisions, generations):
+        """
+        :param decisions: {(asset_id, system_user_id): PermissionDecision}
+        :param generations: `get_many` 返回的版本号
+        """
+        mapping = {}
+        for pair, decision in decisions.items():
+            pair = (str(pair[0]), str(pair[1]))
+            if pair not in generations:
+                continue
+            value = json.dumps([*decision, generations[pair]])
+            mapping[self.get_field(*pair)] = value
+        if not mapping:
+            return
+        key = self.key_template.format(user_id=user_id)
+        with self.client.pipeline(transaction=False) as p:
+            p.hset(key, mapping=mapping)
+            p.expire(key, self.ttl)
+            p.execute()
+
+    def _incr_generations(self, ids, delete_user_ids=()):
+        keys = [self.generation_key_template.format(i) for i in ids]
+        with self.client.pipeline(transaction=False) as p:
+            for key in keys:
+                p.incr(key)
+                # 版本号过期时，之前的结果也已经过期，不会误用
+                p.expire(key, self.ttl * 2)
+            for user_id in delete_user_ids:
+                p.delete(self.key_template.format(user_id=user_id))
+            p.execute()
+
+    @on_transaction_commit
+    def expire_users(self, user_ids):
+        user_ids = {str(user_id) for user_id in user_ids}
+        if not user_ids:
+            return
+        self._incr_generations(user_ids, delete_user_ids=user_ids)
+        logger.debug(f'Expire users asset permission decisions: {user_ids}')
+
+    @on_transaction_commit
+    def expire_objects(self, object_ids):
+        """ 资产、系统用户变化 """
+        object_ids = {str(i) for i in object_ids}
+        if not object_ids:
+            return
+        self._incr_generations(object_ids)
+
+    @on_transaction_commit
+    def expire_all(self):
+        self._incr_generations(['global'])
+
+    # 命中统计，各进程先在内存中计数，定期累加到 redis 中
+    def incr_metrics(self, **events):
+        with self._lock:
+            self._counter.update(events)
+            need_flush = time.time() - self._last_flush_time > self.metrics_flush_interval
+        if need_flush:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        with self._lock:
+            counter, self._counter = self._counter, Counter()
+            self._last_flush_time = time.time()
+        counter = +counter
+        if not counter:
+            return
+        try:
+            with self.client.pipeline(transaction=False) as p:
+                for event, amount in counter.items():
+                    p.hincrby(self.metrics_key, event, amount)
+                p.execute()
+        except Exception as e:
+            logger.error(f'Flush asset permission decision metrics error: {e}')
+
+    def get_metrics(self):
+        metrics = {'hit': 0, 'miss': 0}
+        for event, amount in self.client.hgetall(self.metrics_key).items():
+            event = event.decode() if isinstance(event, bytes) else event
+            metrics[event] = int(amount)
+        return metrics
+
+    def get_prometheus_metrics_text(self):
+        self.flush_metrics()
+        prometheus_metrics = [
+            '## 资产授权判断缓存',
+            '# HELP jumpserver_asset_permission_decision_cache_total Asset permission decision cache lookups',
+            '# TYPE jumpserver_asset_permission_decision_cache_total counter',
+        ]
+        for event, amount in sorted(self.get_metrics().items()):
+            prometheus_metrics.append(
+                f'jumpserver_asset_permission_decision_cache_total{{event="{event}"}} {amount}'
+            )
+        prometheus_metrics.append('\n')
+        return '\n'.join(prometheus_metrics)
+
+
+asset_permission_decision_cache = AssetPermissionDecisionCache()
@@ -1,71 +1,174 @@
 import time
 from collections import defaultdict
 
-from django.db.models import Q
+from django.db.models import Q, Min
+from django.utils import timezone
 
 from common.utils import get_logger
+from common.db.router import use_primary_db
 from perms.models import AssetPermission, Action
 from perms.hands import Asset, User, UserGroup, SystemUser, Node
-from perms.utils.asset.user_permission import get_user_all_asset_perm_ids
+from perms.utils.asset.user_permission import get_user_all_asset_perm_ids, get_user_related_asset_perm_ids
+from perms.utils.asset.decision_cache import PermissionDecision, asset_permission_decision_cache
 
 logger = get_logger(__file__)
 
 
-def validate_permission(user, asset, system_user, action='connect'):
-
-    if not system_user.protocol in asset.protocols_as_dict.keys():
-        return False, time.time()
-
-    asset_perm_ids = get_user_all_asset_perm_ids(user)
-
-    asset_perm_ids_from_asset = AssetPermission.assets.through.objects.filter(
-        assetpermission_id__in=asset_perm_ids,
-        asset_id=asset.id
-    ).values_list('assetpermission_id', flat=True)
-
-    nodes = asset.get_nodes()
-    node_keys = set()
-    for node in nodes:
-        ancestor_keys = node.get_ancestor_keys(with_self=True)
-        node_keys.update(ancestor_keys)
-    node_ids = Node.objects.filter(key__in=node_keys).values_list('id', flat=True)
-
-    node_ids = set(node_ids)
-
-    asset_perm_ids_from_node = AssetPermission.nodes.through.objects.filter(
-        assetpermission_id__in=asset_perm_ids,
-        node_id__in=node_ids
-    ).values_list('assetpermission_id', flat=True)
-
-    asset_perm_ids = {*asset_perm_ids_from_asset, *asset_perm_ids_from_node}
-
-    asset_perm_ids = AssetPermission.system_users.through.objects.filter(
-        assetpermission_id__in=asset_perm_ids,
-        systemuser_id=system_user.id
-    ).values_list('assetpermission_id', flat=True)
-
-    asset_perm_ids = set(asset_perm_ids)
-
-    asset_perms = AssetPermission.objects.filter(
-        id__in=asset_perm_ids
-    ).order_by('-date_expired')
+def get_user_next_asset_perm_start_time(user):
+    """
+    用户还未生效的授权中最早的生效时间，到时授权判断的结果可能变化，没有返回 None
+    """
+    now = timezone.now()
+    date_start = AssetPermission.objects.filter(
+        id__in=get_user_related_asset_perm_ids(user), is_active=True,
+        date_start__gt=now, date_expired__gt=now
+    ).aggregate(date_start=Min('date_start'))['date_start']
+    return date_start.timestamp() if date_start else None
+
+
+def get_user_asset_permission_decisions(user, pairs):
+    """
+    计算用户对多个 (资产, 系统用户) 的授权，查询次数与数量无关
+    :param pairs: [(asset_id, system_user_id), ...]
+    :return: {(asset_id, system_user_id): PermissionDecision}，id 都是字符串
+    """
+    pairs = {(str(asset_id), str(system_user_id)) for asset_id, system_user_id in pairs}
+    now = time.time()
+    no_perm_decision = PermissionDecision(Action.NONE, now, now + asset_permission_decision_cache.ttl)
+    decisions = dict.fromkeys(pairs, no_perm_decision)
+
+    asset_ids = {asset_id for asset_id, __ in pairs}
+    system_user_ids = {system_user_id for __, system_user_id in pairs}
+    assets = Asset.objects.valid().filter(id__in=asset_ids).only('id', 'org_id', 'protocols')
+    asset_mapper = {str(asset.id): asset for asset in assets}
+    system_user_protocol_mapper = {
+        str(i): protocol for i, protocol in
+        SystemUser.objects.filter(id__in=system_user_ids).values_list('id', 'protocol')
+    }
+
+    # 资产不支持系统用户的协议，不用计算
+    pairs = {
+        (asset_id, system_user_id) for asset_id, system_user_id in pairs
+        if asset_id in asset_mapper and
+        system_user_protocol_mapper.get(system_user_id) in asset_mapper[asset_id].protocols_as_dict
+    }
+    if not pairs or user is None:
+        return decisions
+
+    # 之后生效的授权会改变结果，没有授权的结果也只能保存到那时
+    next_start_time = get_user_next_asset_perm_start_time(user)
+    if next_start_time is not None and next_start_time < no_perm_decision.valid_until:
+        no_perm_decision = no_perm_decision._replace(valid_until=next_start_time)
+        for pair in pairs:
+            decisions[pair] = no_perm_decision
+
+    asset_perm_ids = set(get_user_all_asset_perm_ids(user))
+    if not asset_perm_ids:
+        return decisions
+
+    asset_ids = {asset_id for asset_id, __ in pairs}
+    system_user_ids = {system_user_id for __, system_user_id in pairs}
+
+    # 资产所在的节点以及祖先节点，节点的 key 只在组织内唯一
+    asset_node_keys_mapper = defaultdict(set)
+    org_node_keys = set()
+    asset_node_keys = Asset.nodes.through.objects.filter(
+        asset_id__in=asset_ids
+    ).values_list('asset_id', 'node__key')
+    for asset_id, node_key in asset_node_keys:
+        asset_id = str(asset_id)
+        org_id = str(asset_mapper[asset_id].org_id)
+        for key in Node.get_node_ancestor_keys(node_key, with_self=True):
+            asset_node_keys_mapper[asset_id].add((org_id, key))
+            org_node_keys.add((org_id, key))
+
+    org_ids = {org_id for org_id, __ in org_node_keys}
+    node_keys = {key for __, key in org_node_keys}
+    nodes = Node.objects.filter(org_id__in=org_ids, key__in=node_keys).values_list('id', 'org_id', 'key')
+    node_id_mapper = {
+        (str(org_id), key): node_id for node_id, org_id, key in nodes
+        if (str(org_id), key) in org_node_keys
+    }
+
+    asset_perm_ids_mapper = defaultdict(set)
+    perm_assets = AssetPermission.assets.through.objects.filter(
+        assetpermission_id__in=asset_perm_ids, asset_id__in=asset_ids
+    ).values_list('asset_id', 'assetpermission_id')
+    for asset_id, perm_id in perm_assets:
+        asset_perm_ids_mapper[str(asset_id)].add(perm_id)
+
+    node_perm_ids_mapper = defaultdict(set)
+    perm_nodes = AssetPermission.nodes.through.objects.filter(
+        assetpermission_id__in=asset_perm_ids, node_id__in=node_id_mapper.values()
+    ).values_list('node_id', 'assetpermission_id')
+    for node_id, perm_id in perm_nodes:
+        node_perm_ids_mapper[node_id].add(perm_id)
+
+    for asset_id, keys in asset_node_keys_mapper.items():
+        for org_node_key in keys:
+            node_id = node_id_mapper.get(org_node_key)
+            asset_perm_ids_mapper[asset_id].update(node_perm_ids_mapper[node_id])
+
+    system_user_perm_ids_mapper = defaultdict(set)
+    perm_system_users = AssetPermission.system_users.through.objects.filter(
+        assetpermission_id__in=asset_perm_ids, systemuser_id__in=system_user_ids
+    ).values_list('systemuser_id', 'assetpermission_id')
+    for system_user_id, perm_id in perm_system_users:
+        system_user_perm_ids_mapper[str(system_user_id)].add(perm_id)
+
+    matched_perm_ids = set()
+    for asset_id, system_user_id in pairs:
+        matched_perm_ids.update(
+            asset_perm_ids_mapper[asset_id] & system_user_perm_ids_mapper[system_user_id]
+        )
+    perms = AssetPermission.objects.filter(id__in=matched_perm_ids).values_list('id', 'actions', 'date_expired')
+    perm_mapper = {perm_id: (actions, date_expired.timestamp()) for perm_id, actions, date_expired in perms}
+
+    for asset_id, system_user_id in pairs:
+        perm_ids = asset_perm_ids_mapper[asset_id] & system_user_perm_ids_mapper[system_user_id]
+        perm_values = [perm_mapper[i] for i in perm_ids if i in perm_mapper]
+        if not perm_values:
+            continue
+        actions = Action.NONE
+        for value, __ in perm_values:
+            actions |= value
+        expire_ats = [expire_at for __, expire_at in perm_values]
+        # 任何一个授权过期，结果都可能变化
+        valid_until = min(min(expire_ats), no_perm_decision.valid_until)
+        decisions[(asset_id, system_user_id)] = PermissionDecision(actions, max(expire_ats), valid_until)
+    return decisions
+
+
+def get_user_asset_permission_decisions_with_cache(user_id, pairs):
+    """
+    同 `get_user_asset_permission_decisions`，优先从缓存中获取，没有命中的再计算
+    """
+    pairs = [(str(asset_id), str(system_user_id)) for asset_id, system_user_id in pairs]
+    decisions, missed = asset_permission_decision_cache.get_many(user_id, pairs)
+    if not missed:
+        return decisions
+
+    # 结果会被缓存，从库的延迟会让刚撤销的授权被缓存下来，所以读主库
+    with use_primary_db():
+        user = User.objects.filter(id=user_id).first()
+        computed = get_user_asset_permission_decisions(user, missed.keys())
+    asset_permission_decision_cache.set_many(user_id, computed, missed)
+    decisions.update(computed)
+    return decisions
+
+
+def get_user_asset_permission_decision(user_id, asset_id, system_user_id):
+    pair = (str(asset_id), str(system_user_id))
+    decisions = get_user_asset_permission_decisions_with_cache(user_id, [pair])
+    return decisions[pair]
 
-    if asset_perms:
-        actions = set()
-        actions_values = asset_perms.values_list('actions', flat=True)
-        for value in actions_values:
-            _actions = Action.value_to_choices(value)
-            actions.update(_actions)
-        asset_perm: AssetPermission = asset_perms.first()
-        actions = list(actions)
-        expire_at = asset_perm.date_expired.timestamp()
-    else:
-        actions = []
-        expire_at = time.time()
 
+def validate_permission(user, asset, system_user, action='connect'):
+    decision = get_user_asset_permission_decision(user.id, asset.id, system_user.id)
+    actions = Action.value_to_choices(decision.actions)
     # TODO: 组件改造API完成后统一通过actions判断has_perm
     has_perm = action in actions
-    return has_perm, actions, expire_at
+    return has_perm, actions, decision.expire_at
 
 
 def get_asset_system_user_ids_with_actions(asset_perm_ids, asset: Asset):
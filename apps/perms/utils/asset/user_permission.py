@@ -1,16 +1,19 @@
 from collections import defaultdict
+from copy import copy
 from typing import List, Tuple
 import time
 
-from django.core.cache import cache
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q, QuerySet
 
 from common.db.models import output_as_string, UnionQuerySet
 from common.utils.common import lazyproperty, timeit
 from assets.utils import NodeAssetsUtil
 from common.utils import get_logger
+from common.utils.connection import get_redis_client
 from common.decorator import on_transaction_commit
+from common.db.router import use_read_replica, use_primary_db
 from orgs.utils import tmp_to_org, current_org, ensure_in_real_or_default_org, tmp_to_root_org
 from assets.models import (
     Asset, FavoriteAsset, AssetQuerySet, NodeQuerySet
@@ -21,6 +24,7 @@ from perms.models import (
 )
 from users.models import User
 from perms.locks import UserGrantedTreeRebuildLock
+from perms.utils.asset.decision_cache import asset_permission_decision_cache
 
 NodeFrom = UserAssetGrantedTreeNodeRelation.NodeFrom
 NODE_ONLY_FIELDS = ('id', 'key', 'parent_key', 'org_id')
@@ -29,6 +33,15 @@ logger = get_logger(__name__)
 
 
 def get_user_all_asset_perm_ids(user) -> set:
+    asset_perm_ids = get_user_related_asset_perm_ids(user)
+    asset_perm_ids = AssetPermission.objects.filter(
+        id__in=asset_perm_ids).valid().values_list('id', flat=True)
+    asset_perm_ids = set(asset_perm_ids)
+    return asset_perm_ids
+
+
+def get_user_related_asset_perm_ids(user) -> set:
+    """ 用户直接以及通过用户组关联的授权，包括无效的 """
     asset_perm_ids = set()
     user_perm_id = AssetPermission.users.through.objects \
         .filter(user_id=user.id) \
@@ -46,15 +59,16 @@ def get_user_all_asset_perm_ids(user) -> set:
         .values_list('assetpermission_id', flat=True) \
         .distinct()
     asset_perm_ids.update(groups_perm_id)
-
-    asset_perm_ids = AssetPermission.objects.filter(
-        id__in=asset_perm_ids).valid().values_list('id', flat=True)
-    asset_perm_ids = set(asset_perm_ids)
     return asset_perm_ids
 
 
 class UserGrantedTreeRefreshController:
     key_template = 'perms.user.node_tree.built_orgs.user_id:{user_id}'
+    changed_keys_key_template = 'perms.user.node_tree.changed_node_keys.user_id:{user_id}.org_id:{org_id}'
+    # 变化的节点超过这个数量，增量更新不再划算，直接全量重建
+    changed_node_keys_max_amount = 200
+    # 受影响的用户超过这个数量，后台预先构建授权树
+    prewarm_users_min_amount = 100
 
     def __init__(self, user):
         self.user = user
@@ -67,14 +81,17 @@ class UserGrantedTreeRefreshController:
         client = cls.get_redis_client()
         key_match = cls.key_template.format(user_id='*')
         keys = client.keys(key_match)
+        changed_key_match = cls.changed_keys_key_template.format(user_id='*', org_id='*')
+        keys.extend(client.keys(changed_key_match))
         with client.pipeline() as p:
             for key in keys:
                 p.delete(key)
             p.execute()
+        asset_permission_decision_cache.expire_all()
 
     @classmethod
     def get_redis_client(cls):
-        return cache.client.get_client(write=True)
+        return get_redis_client(settings.REDIS_DB_CACHE)
 
     def get_need_refresh_org_ids(self):
         org_ids = self.client.smembers(self.key)
@@ -121,7 +138,135 @@ class UserGrantedTreeRefreshController:
 
     @classmethod
     def add_need_refresh_orgs_for_users(cls, org_ids, user_ids):
+        user_ids = set(user_ids)
+        asset_permission_decision_cache.expire_users(user_ids)
         cls.remove_built_orgs_from_users(org_ids, user_ids)
+        cls.prewarm_users_tree_if_need(org_ids, user_ids)
+
+    @classmethod
+    def add_built_org_for_users(cls, org_id, user_ids):
+        """
+        与 `get_need_refresh_orgs_and_fill_up` 一样，要在读取授权数据之前标记，
+        构建期间提交的变化会在标记之后再清除标记、记录变化的节点，不会被覆盖
+        """
+        client = cls.get_redis_client()
+        org_id = str(org_id)
+
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                p.sadd(cls.key_template.format(user_id=user_id), org_id)
+                changed_keys_key = cls.changed_keys_key_template.format(user_id=user_id, org_id=org_id)
+                p.delete(changed_keys_key, changed_keys_key + '.processing')
+            p.execute()
+
+    @classmethod
+    @on_transaction_commit
+    def prewarm_users_tree_if_need(cls, org_ids, user_ids):
+        """
+        受影响的用户太多时，放到后台批量构建，避免用户首次访问时构建
+        """
+        from perms.tasks import rebuild_users_granted_tree_task
+
+        user_ids = [str(user_id) for user_id in user_ids]
+        if len(user_ids) < cls.prewarm_users_min_amount:
+            return
+        for org_id in org_ids:
+            rebuild_users_granted_tree_task.delay(str(org_id), user_ids)
+
+    def get_changed_keys_key(self, org_id):
+        return self.changed_keys_key_template.format(user_id=self.user.id, org_id=org_id)
+
+    @classmethod
+    @on_transaction_commit
+    def add_changed_node_keys_for_users(cls, org_id, user_ids, node_keys):
+        """
+        记录用户授权树中发生变化的节点，下次刷新时只增量更新这些节点相关的部分
+        """
+        node_keys = set(node_keys)
+        user_ids = set(user_ids)
+        asset_permission_decision_cache.expire_users(user_ids)
+        if not node_keys or not user_ids:
+            return
+
+        if len(node_keys) > cls.changed_node_keys_max_amount:
+            cls.add_need_refresh_orgs_for_users([org_id], user_ids)
+            return
+
+        client = cls.get_redis_client()
+        with client.pipeline() as p:
+            for user_id in user_ids:
+                key = cls.changed_keys_key_template.format(user_id=user_id, org_id=org_id)
+                p.sadd(key, *node_keys)
+            p.execute()
+        logger.info(f'Add changed node keys to users tree: users:{user_ids} '
+                    f'org:{org_id} keys:{node_keys}')
+
+    def get_changed_orgs(self):
+        orgs = list(self.orgs)
+        with self.client.pipeline() as p:
+            for org in orgs:
+                # 处理中的集合也要检查，处理过程中进程退出时留下的节点下次再处理
+                p.exists(self.get_changed_keys_key(org.id), self.get_processing_changed_keys_key(org.id))
+            ret = p.execute()
+        return {org for org, exists in zip(orgs, ret) if exists}
+
+    def get_processing_changed_keys_key(self, org_id):
+        return self.get_changed_keys_key(org_id) + '.processing'
+
+    def pop_changed_node_keys(self, org_id):
+        """
+        把变化的节点移到处理中的集合再读取，处理期间新加入的节点留在原集合，下次处理；
+        上次处理失败留下的也一起处理
+        """
+        key = self.get_changed_keys_key(org_id)
+        processing_key = self.get_processing_changed_keys_key(org_id)
+        with self.client.pipeline() as p:
+            p.sunionstore(processing_key, processing_key, key)
+            p.delete(key)
+            p.smembers(processing_key)
+            node_keys = p.execute()[-1]
+        return {node_key.decode() for node_key in node_keys}
+
+    def finish_changed_node_keys(self, org_id, success=True):
+        key = self.get_changed_keys_key(org_id)
+        processing_key = self.get_processing_changed_keys_key(org_id)
+        with self.client.pipeline() as p:
+            if not success:
+                # 放回去，下次访问时再处理
+                p.sunionstore(key, key, processing_key)
+            p.delete(processing_key)
+            p.execute()
+
+    def remove_changed_node_keys(self, org_id):
+        key = self.get_changed_keys_key(org_id)
+        self.client.delete(key, self.get_processing_changed_keys_key(org_id))
+
+    @classmethod
+    def get_asset_perms_related_node_keys(cls, asset_perm_ids, node_ids=(), asset_ids=()):
+        """
+        授权变化时，受影响的节点是授权的节点以及授权资产所在的节点；
+        `node_ids`, `asset_ids` 是已经从授权中移除的节点和资产
+        """
+        node_ids = set(node_ids)
+        asset_ids = set(asset_ids)
+
+        perm_node_ids = AssetPermission.nodes.through.objects.filter(
+            assetpermission_id__in=asset_perm_ids
+        ).values_list('node_id', flat=True)
+        node_ids.update(perm_node_ids)
+
+        perm_asset_ids = AssetPermission.assets.through.objects.filter(
+            assetpermission_id__in=asset_perm_ids
+        ).values_list('asset_id', flat=True)
+        asset_ids.update(perm_asset_ids)
+
+        asset_node_ids = Asset.nodes.through.objects.filter(
+            asset_id__in=asset_ids
+        ).values_list('node_id', flat=True)
+        node_ids.update(asset_node_ids)
+
+        node_keys = PermNode.objects.filter(id__in=node_ids).values_list('key', flat=True)
+        return set(node_keys)
 
     @classmethod
     @ensure_in_real_or_default_org
@@ -132,11 +277,13 @@ class UserGrantedTreeRefreshController:
         """
 
         node_ids = set(node_ids)
+        node_keys = set()
         ancestor_node_keys = set()
         asset_perm_ids = set()
 
         nodes = PermNode.objects.filter(id__in=node_ids).only('id', 'key')
         for node in nodes:
+            node_keys.add(node.key)
             ancestor_node_keys.update(node.get_ancestor_keys())
 
         ancestor_id = PermNode.objects.filter(key__in=ancestor_node_keys).values_list('id', flat=True)
@@ -152,7 +299,9 @@ class UserGrantedTreeRefreshController:
         ).values_list('assetpermission_id', flat=True)
         asset_perm_ids.update(nodes_related_perm_ids)
 
-        cls.add_need_refresh_by_asset_perm_ids(asset_perm_ids)
+        # 资产与节点关系变化，只影响这些节点及其祖先节点
+        user_ids = cls.get_asset_perms_related_user_ids(asset_perm_ids)
+        cls.add_changed_node_keys_for_users(current_org.id, user_ids, node_keys)
 
     @classmethod
     def add_need_refresh_by_asset_perm_ids_cross_orgs(cls, asset_perm_ids):
@@ -166,8 +315,19 @@ class UserGrantedTreeRefreshController:
 
     @classmethod
     @ensure_in_real_or_default_org
-    def add_need_refresh_by_asset_perm_ids(cls, asset_perm_ids):
+    def add_need_refresh_by_asset_perm_ids(cls, asset_perm_ids, node_ids=(), asset_ids=()):
+        user_ids = cls.get_asset_perms_related_user_ids(asset_perm_ids)
+        node_keys = cls.get_asset_perms_related_node_keys(asset_perm_ids, node_ids, asset_ids)
+        cls.add_changed_node_keys_for_users(current_org.id, user_ids, node_keys)
+
+    @classmethod
+    @ensure_in_real_or_default_org
+    def add_need_rebuild_by_asset_perm_ids(cls, asset_perm_ids):
+        user_ids = cls.get_asset_perms_related_user_ids(asset_perm_ids)
+        cls.add_need_refresh_orgs_for_users([current_org.id], user_ids)
 
+    @classmethod
+    def get_asset_perms_related_user_ids(cls, asset_perm_ids):
         group_ids = AssetPermission.user_groups.through.objects.filter(
             assetpermission_id__in=asset_perm_ids
         ).values_list('usergroup_id', flat=True)
@@ -182,10 +342,7 @@ class UserGrantedTreeRefreshController:
             usergroup_id__in=group_ids
         ).values_list('user_id', flat=True)
         user_ids.update(group_user_ids)
-
-        cls.remove_built_orgs_from_users(
-            [current_org.id], user_ids
-        )
+        return user_ids
 
     @lazyproperty
     def org_ids(self):
@@ -198,28 +355,49 @@ class UserGrantedTreeRefreshController:
         return orgs
 
     @timeit
+    @use_primary_db()
     def refresh_if_need(self, force=False):
         user = self.user
 
         with tmp_to_root_org():
             UserAssetGrantedTreeNodeRelation.objects.filter(user=user).exclude(org_id__in=self.org_ids).delete()
 
-        if force or self.have_need_refresh_orgs():
-            with UserGrantedTreeRebuildLock(user_id=user.id):
-                if force:
-                    orgs = self.orgs
-                    self.set_all_orgs_as_built()
-                else:
-                    orgs = self.get_need_refresh_orgs_and_fill_up()
+        if not (force or self.have_need_refresh_orgs() or self.get_changed_orgs()):
+            return
 
-                for org in orgs:
-                    with tmp_to_org(org):
-                        t_start = time.time()
-                        logger.info(f'Rebuild user tree: user={self.user} org={current_org}')
-                        utils = UserGrantedTreeBuildUtils(user)
-                        utils.rebuild_user_granted_tree()
-                        logger.info(
-                            f'Rebuild user tree ok: cost={time.time() - t_start} user={self.user} org={current_org}')
+        with UserGrantedTreeRebuildLock(user_id=user.id):
+            if force:
+                orgs = self.orgs
+                self.set_all_orgs_as_built()
+            else:
+                orgs = self.get_need_refresh_orgs_and_fill_up()
+
+            for org in orgs:
+                with tmp_to_org(org):
+                    t_start = time.time()
+                    logger.info(f'Rebuild user tree: user={self.user} org={current_org}')
+                    # 全量重建了，之前记录的变化节点也就没用了
+                    self.remove_changed_node_keys(org.id)
+                    utils = UserGrantedTreeBuildUtils(user)
+                    utils.rebuild_user_granted_tree()
+                    logger.info(
+                        f'Rebuild user tree ok: cost={time.time() - t_start} user={self.user} org={current_org}')
+
+            # 获取锁之后再取一次，等待锁期间可能已经被别的线程处理过了
+            for org in self.get_changed_orgs() - orgs:
+                with tmp_to_org(org):
+                    t_start = time.time()
+                    node_keys = self.pop_changed_node_keys(org.id)
+                    logger.info(f'Update user tree: user={self.user} org={current_org} keys={node_keys}')
+                    utils = UserGrantedTreeBuildUtils(user)
+                    try:
+                        utils.update_user_granted_tree(node_keys)
+                    except Exception:
+                        self.finish_changed_node_keys(org.id, success=False)
+                        raise
+                    self.finish_changed_node_keys(org.id)
+                    logger.info(
+                        f'Update user tree ok: cost={time.time() - t_start} user={self.user} org={current_org}')
 
 
 class UserGrantedUtilsBase:
@@ -281,12 +459,184 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
             return
         self.create_mapping_nodes(nodes)
 
+    @ensure_in_real_or_default_org
+    def update_user_granted_tree(self, changed_node_keys):
+        """
+        只更新授权树中受变化节点影响的部分，受影响的节点是：
+        变化节点、变化节点的祖先节点、变化节点的后代节点，
+        只计算这些节点的状态和资产数量(`compute_perm_nodes_tree_in_region`)，
+        结果与 `rebuild_user_granted_tree` 中这些节点的结果相同
+
+        注意：调用该方法一定要被 `UserGrantedTreeRebuildLock` 锁住
+        """
+        user = self.user
+        changed_node_keys = PermNode.clean_children_keys(changed_node_keys)
+        if not changed_node_keys:
+            return
+
+        ancestor_keys = set()
+        for key in changed_node_keys:
+            ancestor_keys.update(PermNode.get_node_ancestor_keys(key, with_self=True))
+
+        q = Q(node_key__in=ancestor_keys)
+        for key in changed_node_keys:
+            q |= Q(node_key__startswith=f'{key}:')
+        old_rels = UserAssetGrantedTreeNodeRelation.objects.filter(user=user).filter(q).only(
+            'id', 'node_key', 'node_parent_key', 'node_from', 'node_assets_amount'
+        )
+        old_rels = list(old_rels)
+
+        new_nodes = []
+        if self.asset_perm_ids:
+            new_nodes = self.compute_perm_nodes_tree_in_region(changed_node_keys)
+
+        if not old_rels and not new_nodes:
+            # 变化的节点与该用户的授权树无关
+            return
+
+        key_node_mapper = {node.key: node for node in new_nodes}
+
+        to_update = []
+        to_delete_ids = []
+        for rel in old_rels:
+            node = key_node_mapper.pop(rel.node_key, None)
+            if node is None:
+                to_delete_ids.append(rel.id)
+                continue
+            new_values = {
+                'node_parent_key': node.parent_key,
+                'node_from': node.node_from,
+                'node_assets_amount': node.assets_amount,
+            }
+            changed = False
+            for attr, value in new_values.items():
+                if getattr(rel, attr) != value:
+                    setattr(rel, attr, value)
+                    changed = True
+            if changed:
+                to_update.append(rel)
+
+        to_create = [self._to_mapping_node(node) for node in key_node_mapper.values()]
+
+        UserAssetGrantedTreeNodeRelation.objects.filter(id__in=to_delete_ids).delete()
+        UserAssetGrantedTreeNodeRelation.objects.bulk_update(
+            to_update, fields=('node_parent_key', 'node_from', 'node_assets_amount')
+        )
+        UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
+        logger.debug(f'Update user tree: user={user} created={len(to_create)} '
+                     f'updated={len(to_update)} deleted={len(to_delete_ids)}')
+
+    @timeit
+    def compute_perm_nodes_tree_in_region(self, changed_node_keys, node_only_fields=NODE_ONLY_FIELDS) -> list:
+        """
+        与 `compute_perm_nodes_tree` + `compute_node_assets_amount` 相同，
+        但只查询、计算区域(变化节点的祖先节点和后代节点)内的节点:
+
+        * 授权节点、授权资产所在节点只取 key，用来判断区域内节点的 `node_from`
+        * 区域外的授权节点、授权资产，资产计入区域内离它最近的祖先节点，
+          祖先节点的资产数量与整棵树计算的结果一样
+        """
+        org_id = current_org.id
+        changed_node_keys = set(changed_node_keys)
+        ancestor_keys = set()
+        for key in changed_node_keys:
+            ancestor_keys.update(PermNode.get_node_ancestor_keys(key, with_self=True))
+
+        def _in_region(key):
+            if key in ancestor_keys:
+                return True
+            return bool(set(PermNode.get_node_ancestor_keys(key)) & changed_node_keys)
+
+        granted_keys = set(self.get_direct_granted_nodes().values_list('key', flat=True))
+
+        def _has_ancestor_granted(key):
+            return bool(set(PermNode.get_node_ancestor_keys(key)) & granted_keys)
+
+        top_granted_keys = {key for key in granted_keys if not _has_ancestor_granted(key)}
+
+        node_asset_pairs = self.direct_granted_asset_id_node_id_str_pairs
+        asset_node_ids = {node_id for node_id, _ in node_asset_pairs}
+        node_id_key_mapper = {
+            node_id.hex: key
+            for node_id, key in PermNode.objects.filter(id__in=asset_node_ids).values_list('id', 'key')
+        }
+        asset_leaf_keys = set()
+        if not settings.PERM_SINGLE_ASSET_TO_UNGROUP_NODE:
+            asset_leaf_keys = {
+                key for key in node_id_key_mapper.values()
+                if key not in granted_keys and not _has_ancestor_granted(key)
+            }
+
+        leaf_keys = top_granted_keys | asset_leaf_keys
+        tree_keys = set(leaf_keys)
+        for key in leaf_keys:
+            tree_keys.update(PermNode.get_node_ancestor_keys(key))
+
+        region_keys = {key for key in tree_keys if _in_region(key)}
+        if not region_keys:
+            return []
+        nodes = self._get_nodes_by_keys(region_keys, node_only_fields)
+        for node in nodes:
+            if node.key in top_granted_keys:
+                node.node_from = NodeFrom.granted
+            elif node.key in asset_leaf_keys:
+                node.node_from = NodeFrom.asset
+            else:
+                node.node_from = NodeFrom.child
+
+        if tree_keys == top_granted_keys and len(tree_keys) == 1:
+            # 直接授权了根节点，整棵树只有它一个节点，与全量计算走同样的逻辑
+            self.compute_node_assets_amount(nodes)
+            return nodes
+
+        def _get_target_key(key):
+            # 区域内离它最近的(包含自己)树上节点
+            for k in PermNode.get_node_ancestor_keys(key, with_self=True):
+                if k in region_keys:
+                    return k
+            return None
+
+        nodekey_assetsid_mapper = defaultdict(set)
+        for key in top_granted_keys:
+            target_key = _get_target_key(key)
+            if target_key is None:
+                continue
+            asset_ids = PermNode.get_all_asset_ids_by_node_key(org_id, key)
+            nodekey_assetsid_mapper[target_key].update(asset_ids)
+
+        for node_id, asset_id in node_asset_pairs:
+            key = node_id_key_mapper.get(node_id)
+            # 全量计算只统计树上节点的直接授权资产，授权节点下的资产已经包含在授权节点中
+            if key is None or key not in tree_keys:
+                continue
+            target_key = _get_target_key(key)
+            if target_key is None:
+                continue
+            nodekey_assetsid_mapper[target_key].add(asset_id)
+
+        util = NodeAssetsUtil(nodes, nodekey_assetsid_mapper)
+        util.generate()
+        for node in nodes:
+            node.assets_amount = util.get_assets_amount(node.key)
+        return nodes
+
+    def _get_direct_granted_nodes(self, node_only_fields) -> list:
+        nodes = self.get_direct_granted_nodes().only(*node_only_fields)
+        return list(nodes)
+
+    def _get_nodes_by_ids(self, node_ids, node_only_fields) -> list:
+        nodes = PermNode.objects.filter(id__in=node_ids).distinct().only(*node_only_fields)
+        return list(nodes)
+
+    def _get_nodes_by_keys(self, node_keys, node_only_fields) -> list:
+        nodes = PermNode.objects.filter(key__in=node_keys).only(*node_only_fields)
+        return list(nodes)
+
     @timeit
     def compute_perm_nodes_tree(self, node_only_fields=NODE_ONLY_FIELDS) -> list:
 
         # 查询直接授权节点
-        nodes = self.get_direct_granted_nodes().only(*node_only_fields)
-        nodes = list(nodes)
+        nodes = self._get_direct_granted_nodes(node_only_fields)
 
         # 授权的节点 key 集合
         granted_key_set = {_node.key for _node in nodes}
@@ -313,10 +663,7 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
             # 查询直接授权资产
             node_ids = {node_id_str for node_id_str, _ in self.direct_granted_asset_id_node_id_str_pairs}
             # 查询授权资产关联的节点设置 2.80
-            granted_asset_nodes = PermNode.objects.filter(
-                id__in=node_ids
-            ).distinct().only(*node_only_fields)
-            granted_asset_nodes = list(granted_asset_nodes)
+            granted_asset_nodes = self._get_nodes_by_ids(node_ids, node_only_fields)
 
             # 给资产授权关联的节点设置 is_asset_granted 标识，同时去重
             for node in granted_asset_nodes:
@@ -340,29 +687,26 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
         # 从祖先节点 key 中去掉同时也是叶子节点的 key
         ancestor_keys -= key2leaf_nodes_mapper.keys()
         # 查出祖先节点
-        ancestors = PermNode.objects.filter(key__in=ancestor_keys).only(*node_only_fields)
-        ancestors = list(ancestors)
+        ancestors = self._get_nodes_by_keys(ancestor_keys, node_only_fields)
         for node in ancestors:
             node.node_from = NodeFrom.child
         result = [*leaf_nodes, *ancestors]
         return result
 
+    def _to_mapping_node(self, node):
+        return UserAssetGrantedTreeNodeRelation(
+            user=self.user,
+            node=node,
+            node_key=node.key,
+            node_parent_key=node.parent_key,
+            node_from=node.node_from,
+            node_assets_amount=node.assets_amount,
+            org_id=node.org_id
+        )
+
     @timeit
     def create_mapping_nodes(self, nodes):
-        user = self.user
-        to_create = []
-
-        for node in nodes:
-            to_create.append(UserAssetGrantedTreeNodeRelation(
-                user=user,
-                node=node,
-                node_key=node.key,
-                node_parent_key=node.parent_key,
-                node_from=node.node_from,
-                node_assets_amount=node.assets_amount,
-                org_id=node.org_id
-            ))
-
+        to_create = [self._to_mapping_node(node) for node in nodes]
         UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
 
     @timeit
@@ -449,6 +793,231 @@ class UserGrantedTreeBuildUtils(UserGrantedUtilsBase):
         return nodes
 
 
+class _PreloadedUserGrantedTreeBuildUtils(UserGrantedTreeBuildUtils):
+    """
+    使用 `UserGrantedTreeBulkBuildUtils` 预先加载好的数据计算授权树，不再查询数据库
+    """
+
+    def __init__(self, bulk_utils, asset_perm_ids):
+        super().__init__(user=None, asset_perm_ids=asset_perm_ids)
+        self.bulk_utils = bulk_utils
+
+    def _get_direct_granted_nodes(self, node_only_fields) -> list:
+        node_ids = set()
+        for perm_id in self.asset_perm_ids:
+            node_ids.update(self.bulk_utils.perm_node_ids_mapper[perm_id])
+        return self._get_nodes_by_ids(node_ids, node_only_fields)
+
+    def _get_nodes_by_ids(self, node_ids, node_only_fields) -> list:
+        # 节点会被设置 `node_from`、`assets_amount`，所以每组用户都要用自己的拷贝
+        mapper = self.bulk_utils.id_node_mapper
+        return [copy(mapper[node_id]) for node_id in node_ids if node_id in mapper]
+
+    def _get_nodes_by_keys(self, node_keys, node_only_fields) -> list:
+        mapper = self.bulk_utils.key_node_mapper
+        return [copy(mapper[key]) for key in node_keys if key in mapper]
+
+    @lazyproperty
+    def direct_granted_asset_ids(self) -> list:
+        asset_ids = set()
+        for perm_id in self.asset_perm_ids:
+            asset_ids.update(self.bulk_utils.perm_asset_ids_mapper[perm_id])
+        return list(asset_ids)
+
+    @lazyproperty
+    def direct_granted_asset_id_node_id_str_pairs(self):
+        mapper = self.bulk_utils.asset_node_ids_mapper
+        node_asset_pairs = [
+            (node_id, asset_id)
+            for asset_id in self.direct_granted_asset_ids
+            for node_id in mapper[asset_id]
+        ]
+        return node_asset_pairs
+
+
+class UserGrantedTreeBulkBuildUtils:
+    """
+    一次重建一个组织下大量用户的授权树:
+    1. 节点、授权与节点资产的关系只查询一次
+    2. 授权完全相同的用户只计算一次
+    3. 授权树批量写入
+    """
+    batch_size = 5000
+    # 用户很多时，不使用自动续期的锁，避免每个锁一个续期线程
+    lock_expire = 60 * 10
+    node_only_fields = NODE_ONLY_FIELDS + ('assets_amount',)
+
+    def __init__(self, user_ids):
+        self.user_ids = {str(user_id) for user_id in user_ids}
+
+    @lazyproperty
+    def user_perm_ids_mapper(self) -> dict:
+        user_perm_ids_mapper = defaultdict(set)
+
+        user_perm_id_pairs = AssetPermission.users.through.objects.filter(
+            user_id__in=self.user_ids
+        ).values_list('user_id', 'assetpermission_id')
+        for user_id, perm_id in user_perm_id_pairs:
+            user_perm_ids_mapper[str(user_id)].add(perm_id)
+
+        group_user_ids_mapper = defaultdict(set)
+        user_group_id_pairs = User.groups.through.objects.filter(
+            user_id__in=self.user_ids
+        ).values_list('user_id', 'usergroup_id')
+        for user_id, group_id in user_group_id_pairs:
+            group_user_ids_mapper[group_id].add(str(user_id))
+
+        group_perm_id_pairs = AssetPermission.user_groups.through.objects.filter(
+            usergroup_id__in=list(group_user_ids_mapper.keys())
+        ).values_list('usergroup_id', 'assetpermission_id')
+        for group_id, perm_id in group_perm_id_pairs:
+            for user_id in group_user_ids_mapper[group_id]:
+                user_perm_ids_mapper[user_id].add(perm_id)
+
+        all_perm_ids = set()
+        for perm_ids in user_perm_ids_mapper.values():
+            all_perm_ids.update(perm_ids)
+        valid_perm_ids = AssetPermission.objects.filter(
+            id__in=all_perm_ids
+        ).valid().values_list('id', flat=True)
+        valid_perm_ids = set(valid_perm_ids)
+
+        return {
+            user_id: frozenset(perm_ids & valid_perm_ids)
+            for user_id, perm_ids in user_perm_ids_mapper.items()
+        }
+
+    @lazyproperty
+    def all_perm_ids(self) -> set:
+        perm_ids = set()
+        for ids in self.user_perm_ids_mapper.values():
+            perm_ids.update(ids)
+        return perm_ids
+
+    @lazyproperty
+    def nodes(self) -> list:
+        nodes = PermNode.objects.annotate(
+            id_str=output_as_string('id')
+        ).only(*self.node_only_fields)
+        return list(nodes)
+
+    @lazyproperty
+    def id_node_mapper(self) -> dict:
+        # 与 `direct_granted_asset_id_node_id_str_pairs` 一致，使用数据库转换的字符串 id
+        return {node.id_str: node for node in self.nodes}
+
+    @lazyproperty
+    def key_node_mapper(self) -> dict:
+        return {node.key: node for node in self.nodes}
+
+    @lazyproperty
+    def perm_node_ids_mapper(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.nodes.through.objects.filter(
+            assetpermission_id__in=self.all_perm_ids
+        ).annotate(
+            node_id_str=output_as_string('node_id')
+        ).values_list('assetpermission_id', 'node_id_str')
+        for perm_id, node_id in pairs:
+            mapper[perm_id].add(node_id)
+        return mapper
+
+    @lazyproperty
+    def perm_asset_ids_mapper(self) -> dict:
+        mapper = defaultdict(set)
+        pairs = AssetPermission.assets.through.objects.filter(
+            assetpermission_id__in=self.all_perm_ids
+        ).annotate(
+            asset_id_str=output_as_string('asset_id')
+        ).values_list('assetpermission_id', 'asset_id_str')
+        for perm_id, asset_id in pairs:
+            mapper[perm_id].add(asset_id)
+        return mapper
+
+    @lazyproperty
+    def asset_node_ids_mapper(self) -> dict:
+        asset_ids = set()
+        for ids in self.perm_asset_ids_mapper.values():
+            asset_ids.update(ids)
+
+        mapper = defaultdict(list)
+        pairs = Asset.nodes.through.objects.filter(
+            asset_id__in=asset_ids
+        ).annotate(
+            asset_id_str=output_as_string('asset_id'),
+            node_id_str=output_as_string('node_id')
+        ).values_list('asset_id_str', 'node_id_str')
+        for asset_id, node_id in pairs:
+            mapper[asset_id].append(node_id)
+        return mapper
+
+    def group_users_by_perm_ids(self, user_ids) -> dict:
+        perm_ids_users_mapper = defaultdict(list)
+        for user_id in user_ids:
+            perm_ids = self.user_perm_ids_mapper.get(user_id, frozenset())
+            perm_ids_users_mapper[perm_ids].append(user_id)
+        return perm_ids_users_mapper
+
+    def acquire_users_lock(self):
+        """
+        正在被用户自己构建的跳过，后面由用户自己处理
+        """
+        locks = []
+        for user_id in self.user_ids:
+            lock = UserGrantedTreeRebuildLock(user_id=user_id, expire=self.lock_expire)
+            if lock.acquire(blocking=False):
+                locks.append((user_id, lock))
+        return locks
+
+    @timeit
+    @ensure_in_real_or_default_org
+    def rebuild(self):
+        org_id = current_org.id
+        locks = self.acquire_users_lock()
+        user_ids = [user_id for user_id, lock in locks]
+        logger.info(f'Bulk rebuild users tree: org={current_org} users={len(user_ids)} '
+                    f'skipped={len(self.user_ids) - len(user_ids)}')
+        try:
+            # 读取数据之前标记为已构建
+            UserGrantedTreeRefreshController.add_built_org_for_users(org_id, user_ids)
+            with transaction.atomic():
+                UserAssetGrantedTreeNodeRelation.objects.filter(user_id__in=user_ids).delete()
+                self._create_mapping_nodes(user_ids)
+        except Exception:
+            # 没有构建成功，用户访问时再构建
+            UserGrantedTreeRefreshController.remove_built_orgs_from_users([org_id], user_ids)
+            raise
+        finally:
+            for user_id, lock in locks:
+                lock.release()
+
+    def _create_mapping_nodes(self, user_ids):
+        to_create = []
+        for perm_ids, group_user_ids in self.group_users_by_perm_ids(user_ids).items():
+            if not perm_ids:
+                continue
+
+            utils = _PreloadedUserGrantedTreeBuildUtils(self, perm_ids)
+            nodes = utils.compute_perm_nodes_tree()
+            utils.compute_node_assets_amount(nodes)
+
+            for user_id in group_user_ids:
+                for node in nodes:
+                    to_create.append(UserAssetGrantedTreeNodeRelation(
+                        user_id=user_id,
+                        node_id=node.id,
+                        node_key=node.key,
+                        node_parent_key=node.parent_key,
+                        node_from=node.node_from,
+                        node_assets_amount=node.assets_amount,
+                        org_id=node.org_id
+                    ))
+                if len(to_create) >= self.batch_size:
+                    UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
+                    to_create = []
+        UserAssetGrantedTreeNodeRelation.objects.bulk_create(to_create)
+
+
 class UserGrantedAssetsQueryUtils(UserGrantedUtilsBase):
 
     def get_favorite_assets(self) -> QuerySet:
@@ -559,6 +1128,7 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
         nodes = sorted(nodes, key=lambda x: x.value)
         return nodes
 
+    @use_read_replica()
     def get_node_children(self, key):
         if not key:
             return self.get_top_level_nodes()
@@ -594,6 +1164,7 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
             node.use_granted_assets_amount()
         return nodes
 
+    @use_read_replica()
     def get_top_level_nodes(self):
         nodes = self.get_special_nodes()
         real_nodes = self.get_indirect_granted_node_children('')
@@ -620,6 +1191,7 @@ class UserGrantedNodesQueryUtils(UserGrantedUtilsBase):
         return nodes
 
     @timeit
+    @use_read_replica()
     def get_whole_tree_nodes(self, with_special=True):
         """
         这里的 granted nodes, 是整棵树需要的node，推算出来的也算
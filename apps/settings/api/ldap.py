@@ -106,7 +106,7 @@ class LDAPUserListApi(generics.ListAPIView):
 
     @staticmethod
     def processing_queryset(queryset):
-        db_username_list = User.objects.all().values_list('username', flat=True)
+        db_username_list = set(User.objects.all().values_list('username', flat=True))
         for q in queryset:
             q['id'] = q['username']
             q['existing'] = q['username'] in db_username_list
@@ -158,7 +158,11 @@ class LDAPUserListApi(generics.ListAPIView):
             return Response(data=data, status=409)
         # 同步任务正在执行
         if sync_util.task_is_running:
-            data = {'msg': _('Synchronization is running, please wait.')}
+            msg = _('Synchronization is running, please wait.')
+            progress = sync_util.get_task_progress()
+            if progress:
+                msg = '{} ({})'.format(msg, _('Synced {} users').format(progress))
+            data = {'msg': msg}
             return Response(data=data, status=409)
         # 同步任务执行结束
         if sync_util.task_is_over:
@@ -199,7 +203,8 @@ class LDAPUserImportAPI(APIView):
             return Response({'msg': _('Get ldap users is None')}, status=400)
 
         org = self.get_org()
-        errors = LDAPImportUtil().perform_import(users, org)
+        util_import = LDAPImportUtil(callback=LDAPImportUtil.set_task_progress)
+        errors = util_import.perform_import(users, org)
         if errors:
             return Response({'errors': errors}, status=400)
 
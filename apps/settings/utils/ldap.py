@@ -1,8 +1,11 @@
 # coding: utf-8
 #
 
+import re
 import json
-from ldap3 import Server, Connection, SIMPLE
+from contextlib import contextmanager
+
+from ldap3 import Server, Connection, SIMPLE, BASE
 from ldap3.core.exceptions import (
     LDAPSocketOpenError,
     LDAPSocketReceiveError,
@@ -18,12 +21,16 @@ from ldap3.core.exceptions import (
     LDAPAttributeError,
 )
 from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
 from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
 from copy import deepcopy
 
 from common.const import LDAP_AD_ACCOUNT_DISABLE
-from common.utils import timeit, get_logger
+from common.utils import timeit, get_logger, iter_chunks
+from common.utils.connection import get_redis_client
+from common.utils.connection_pool import connection_pool_registry
 from common.db.utils import close_old_connections
 from users.utils import construct_user_email
 from users.models import User
@@ -76,9 +83,34 @@ class LDAPConfig(object):
         self.auth_ldap = settings.AUTH_LDAP
 
 
+def get_ldap_server_connection_pool(config):
+    key = (config.server_uri, config.bind_dn, config.password, config.use_ssl)
+
+    def create():
+        server = Server(config.server_uri, use_ssl=config.use_ssl)
+        conn = Connection(server, config.bind_dn, config.password)
+        conn.bind()
+        return conn
+
+    def check(conn):
+        if conn.closed:
+            return False
+        # 读取 rootDSE，确认连接还可用
+        return conn.search('', '(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+
+    return connection_pool_registry.get_pool(
+        'ldap_server', key, create=create, check=check, close=lambda conn: conn.unbind(),
+        max_size=settings.AUTH_LDAP_POOL_SIZE, max_age=settings.AUTH_LDAP_POOL_MAX_AGE,
+        check_interval=settings.AUTH_LDAP_POOL_CHECK_INTERVAL,
+        timeout=settings.AUTH_LDAP_CONNECT_TIMEOUT,
+    )
+
+
 class LDAPServerUtil(object):
 
     def __init__(self, config=None):
+        # 使用系统设置时从连接池中取连接，测试传入的配置时单独创建连接
+        self.use_pool = config is None
         if isinstance(config, dict):
             self.config = LDAPConfig(config=config)
         elif isinstance(config, LDAPConfig):
@@ -100,6 +132,20 @@ class LDAPServerUtil(object):
         self._conn = conn
         return self._conn
 
+    @contextmanager
+    def pooled_connection(self):
+        """ 在这期间 self.connection 是从连接池中取出的连接 """
+        if not self.use_pool or self._conn:
+            yield self.connection
+            return
+        pool = get_ldap_server_connection_pool(self.config)
+        with pool.connection() as conn:
+            self._conn = conn
+            try:
+                yield conn
+            finally:
+                self._conn = None
+
     @staticmethod
     def get_paged_size():
         paged_size = settings.AUTH_LDAP_SEARCH_PAGED_SIZE
@@ -157,23 +203,34 @@ class LDAPServerUtil(object):
             distinct_user_entries.append(user_entry)
         return distinct_user_entries
 
-    @timeit
-    def search_user_entries(self, search_users=None, search_value=None):
-        logger.info("Search user entries")
+    def iter_user_entries(self, search_users=None, search_value=None):
+        """
+        逐页查询，每次只保留一页的 entry
+        """
         self.search_users = search_users
         self.search_value = search_value
-        user_entries = list()
+        user_entries_dn = set()
         search_ous = str(self.config.search_ou).split('|')
-        for search_ou in search_ous:
-            search_ou = search_ou.strip()
-            logger.info("Search user entries ou: {}".format(search_ou))
-            self.search_user_entries_ou(search_ou)
-            user_entries.extend(self.connection.entries)
-            while self.paged_cookie():
-                self.search_user_entries_ou(search_ou, self.paged_cookie())
-                user_entries.extend(self.connection.entries)
-        user_entries = self.distinct_user_entries(user_entries)
-        return user_entries
+        with self.pooled_connection():
+            for search_ou in search_ous:
+                search_ou = search_ou.strip()
+                logger.info("Search user entries ou: {}".format(search_ou))
+                paged_cookie = None
+                while True:
+                    self.search_user_entries_ou(search_ou, paged_cookie)
+                    for user_entry in self.connection.entries:
+                        if user_entry.entry_dn in user_entries_dn:
+                            continue
+                        user_entries_dn.add(user_entry.entry_dn)
+                        yield user_entry
+                    paged_cookie = self.paged_cookie()
+                    if not paged_cookie:
+                        break
+
+    @timeit
+    def search_user_entries(self, search_users=None, search_value=None):
+        logger.info("Search user entries")
+        return list(self.iter_user_entries(search_users=search_users, search_value=search_value))
 
     def user_entry_to_dict(self, entry):
         user = {}
@@ -195,6 +252,11 @@ class LDAPServerUtil(object):
             users.append(user)
         return users
 
+    def iter_users(self, search_users=None, search_value=None):
+        user_entries = self.iter_user_entries(search_users=search_users, search_value=search_value)
+        for user_entry in user_entries:
+            yield self.user_entry_to_dict(user_entry)
+
     def search_for_user_dn(self, username):
         user_entries = self.search_user_entries(search_users=[username])
         if len(user_entries) == 1:
@@ -215,48 +277,119 @@ class LDAPServerUtil(object):
 
 
 class LDAPCacheUtil(object):
-    CACHE_KEY_USERS = 'CACHE_KEY_LDAP_USERS'
+    """
+    同步的用户保存在 redis hash 中(username: 用户 json)，
+    另外有一个 set 作为搜索索引，成员是 `username\0小写的各属性值`，搜索时由 redis 匹配
+    """
+    CACHE_KEY_USERS = 'CACHE_KEY_LDAP_USERS_HASH'
+    CACHE_KEY_USERS_SEARCH_INDEX = 'CACHE_KEY_LDAP_USERS_SEARCH_INDEX'
+    # 同步完成的标记，值是用户数量，没有这个标记表示还没有同步
+    CACHE_KEY_USERS_COUNT = 'CACHE_KEY_LDAP_USERS_COUNT'
+    building_suffix = ':building'
+    chunk_size = 1000
+    index_sep = '\0'
 
     def __init__(self):
         self.search_users = None
         self.search_value = None
 
-    def set_users(self, users):
-        logger.info('Set ldap users to cache, count: {}'.format(len(users)))
-        cache.set(self.CACHE_KEY_USERS, users, None)
+    @property
+    def client(self):
+        return get_redis_client(settings.REDIS_DB_CACHE)
+
+    @classmethod
+    def get_search_index_member(cls, user):
+        search_text = ','.join([str(v) for v in user.values()]).lower()
+        return '{}{}{}'.format(user['username'], cls.index_sep, search_text)
+
+    def set_users(self, users, callback=None):
+        """
+        :param users: 可以是生成器，分批写入临时的 key，全部写完后再替换，同步期间搜索的还是之前的数据
+        :param callback: callback(count) 每写入一批调用一次
+        """
+        client = self.client
+        users_key = self.CACHE_KEY_USERS + self.building_suffix
+        index_key = self.CACHE_KEY_USERS_SEARCH_INDEX + self.building_suffix
+        client.delete(users_key, index_key)
+
+        count = 0
+        for chunk in iter_chunks(users, self.chunk_size):
+            mapping = {user['username']: json.dumps(user) for user in chunk}
+            members = [self.get_search_index_member(user) for user in chunk]
+            with client.pipeline(transaction=False) as p:
+                p.hset(users_key, mapping=mapping)
+                p.sadd(index_key, *members)
+                p.execute()
+            count += len(chunk)
+            if callback:
+                callback(count)
+
+        with client.pipeline() as p:
+            if count:
+                p.rename(users_key, self.CACHE_KEY_USERS)
+                p.rename(index_key, self.CACHE_KEY_USERS_SEARCH_INDEX)
+            else:
+                p.delete(self.CACHE_KEY_USERS, self.CACHE_KEY_USERS_SEARCH_INDEX)
+            p.set(self.CACHE_KEY_USERS_COUNT, count)
+            p.execute()
+        logger.info('Set ldap users to cache, count: {}'.format(count))
+        return count
+
+    def get_count(self):
+        count = self.client.get(self.CACHE_KEY_USERS_COUNT)
+        return count if count is None else int(count)
+
+    @staticmethod
+    def load_users(values):
+        return [json.loads(v) for v in values if v]
 
     def get_users(self):
-        users = cache.get(self.CACHE_KEY_USERS)
-        count = users if users is None else len(users)
-        logger.info('Get ldap users from cache, count: {}'.format(count))
+        if self.get_count() is None:
+            logger.info('Get ldap users from cache, count: None')
+            return None
+        users = self.load_users(self.client.hvals(self.CACHE_KEY_USERS))
+        logger.info('Get ldap users from cache, count: {}'.format(len(users)))
         return users
 
+    def get_users_by_username(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return []
+        return self.load_users(self.client.hmget(self.CACHE_KEY_USERS, usernames))
+
     def delete_users(self):
         logger.info('Delete ldap users from cache')
-        cache.delete(self.CACHE_KEY_USERS)
+        self.client.delete(
+            self.CACHE_KEY_USERS, self.CACHE_KEY_USERS_SEARCH_INDEX, self.CACHE_KEY_USERS_COUNT
+        )
 
-    def filter_users(self, users):
-        if users is None:
-            return users
-        if self.search_users:
-            filter_users = [
-                user for user in users
-                if user['username'] in self.search_users
-            ]
-        elif self.search_value:
-            filter_users = [
-                user for user in users
-                if self.search_value.lower() in ','.join(user.values()).lower()
-            ]
-        else:
-            filter_users = users
-        return filter_users
+    def search_usernames(self, search_value):
+        """
+        搜索是任意属性值的子串匹配(与之前在内存中过滤相同)，有序集合的 ZRANGEBYLEX 只能做前缀匹配，
+        所以这里用 SSCAN MATCH 在 redis 中遍历索引: 每次只遍历 1000 个不会长时间阻塞 redis，
+        只返回匹配的用户名，不用传输、反序列化全部用户
+        """
+        value = re.sub(r'([\\*?\[\]])', r'\\\1', search_value.lower())
+        match = '*{}*'.format(value)
+        usernames = []
+        for member in self.client.sscan_iter(self.CACHE_KEY_USERS_SEARCH_INDEX, match=match, count=1000):
+            member = member.decode() if isinstance(member, bytes) else member
+            username, __ = member.split(self.index_sep, 1)
+            usernames.append(username)
+        return usernames
 
     def search(self, search_users=None, search_value=None):
         self.search_users = search_users
         self.search_value = search_value
-        users = self.get_users()
-        users = self.filter_users(users)
+        if self.get_count() is None:
+            return None
+        if self.search_users:
+            users = self.get_users_by_username(self.search_users)
+        elif self.search_value:
+            usernames = self.search_usernames(self.search_value)
+            users = self.get_users_by_username(usernames)
+        else:
+            users = self.get_users()
         return users
 
 
@@ -264,6 +397,7 @@ class LDAPSyncUtil(object):
     CACHE_KEY_LDAP_USERS_SYNC_TASK_ERROR_MSG = 'CACHE_KEY_LDAP_USERS_SYNC_TASK_ERROR_MSG'
 
     CACHE_KEY_LDAP_USERS_SYNC_TASK_STATUS = 'CACHE_KEY_LDAP_USERS_SYNC_TASK_STATUS'
+    CACHE_KEY_LDAP_USERS_SYNC_TASK_PROGRESS = 'CACHE_KEY_LDAP_USERS_SYNC_TASK_PROGRESS'
     TASK_STATUS_IS_RUNNING = 'RUNNING'
     TASK_STATUS_IS_OVER = 'OVER'
 
@@ -275,6 +409,7 @@ class LDAPSyncUtil(object):
     def clear_cache(self):
         logger.info('Clear ldap sync cache')
         self.delete_task_status()
+        self.delete_task_progress()
         self.delete_task_error_msg()
         self.cache_util.delete_users()
 
@@ -306,6 +441,17 @@ class LDAPSyncUtil(object):
         logger.info('Delete task status')
         cache.delete(self.CACHE_KEY_LDAP_USERS_SYNC_TASK_STATUS)
 
+    def set_task_progress(self, count):
+        """ 已经同步的用户数量 """
+        logger.info('Set task progress: {}'.format(count))
+        cache.set(self.CACHE_KEY_LDAP_USERS_SYNC_TASK_PROGRESS, count, None)
+
+    def get_task_progress(self):
+        return cache.get(self.CACHE_KEY_LDAP_USERS_SYNC_TASK_PROGRESS) or 0
+
+    def delete_task_progress(self):
+        cache.delete(self.CACHE_KEY_LDAP_USERS_SYNC_TASK_PROGRESS)
+
     def set_task_error_msg(self, error_msg):
         logger.info('Set task error msg')
         cache.set(self.CACHE_KEY_LDAP_USERS_SYNC_TASK_ERROR_MSG, error_msg, None)
@@ -321,10 +467,11 @@ class LDAPSyncUtil(object):
 
     def pre_sync(self):
         self.set_task_status(self.TASK_STATUS_IS_RUNNING)
+        self.set_task_progress(0)
 
     def sync(self):
-        users = self.server_util.search()
-        self.cache_util.set_users(users)
+        users = self.server_util.iter_users()
+        self.cache_util.set_users(users, callback=self.set_task_progress)
 
     def post_sync(self):
         self.set_task_status(self.TASK_STATUS_IS_OVER)
@@ -345,9 +492,29 @@ class LDAPSyncUtil(object):
 
 
 class LDAPImportUtil(object):
-
-    def __init__(self):
-        pass
+    """
+    分批导入，每批一次查询已有用户，新用户 bulk_create，有变化的用户 bulk_update;
+    一批失败时，这一批逐个导入，记录每个用户的错误
+    """
+    chunk_size = 500
+    CACHE_KEY_LDAP_USERS_IMPORT_TASK_PROGRESS = 'CACHE_KEY_LDAP_USERS_IMPORT_TASK_PROGRESS'
+
+    def __init__(self, callback=None):
+        """
+        :param callback: callback(count) 开始时和每导入一批调用一次，一般是 `set_task_progress`
+        """
+        self.callback = callback
+        self.count = 0
+
+    @classmethod
+    def set_task_progress(cls, count):
+        """ 已经导入的用户数量 """
+        logger.info('Set import task progress: {}'.format(count))
+        cache.set(cls.CACHE_KEY_LDAP_USERS_IMPORT_TASK_PROGRESS, count, None)
+
+    @classmethod
+    def get_task_progress(cls):
+        return cache.get(cls.CACHE_KEY_LDAP_USERS_IMPORT_TASK_PROGRESS) or 0
 
     @staticmethod
     def get_user_email(user):
@@ -356,19 +523,75 @@ class LDAPImportUtil(object):
         email = construct_user_email(username, email)
         return email
 
-    def update_or_create(self, user):
+    def clean_user(self, user):
+        user = dict(user)
         user['email'] = self.get_user_email(user)
         if user['username'] not in ['admin']:
             user['source'] = User.Source.ldap.value
+        return user
+
+    def update_or_create(self, user):
+        user = self.clean_user(user)
         obj, created = User.objects.update_or_create(
             username=user['username'], defaults=user
         )
         return obj, created
 
-    def perform_import(self, users, org=None):
-        logger.info('Start perform import ldap users, count: {}'.format(len(users)))
-        errors = []
+    @staticmethod
+    def bulk_create(users):
+        objs = []
+        for user in users:
+            obj = User(**user)
+            # bulk_create 不会调用 save
+            obj.set_unprovide_attr_if_need()
+            objs.append(obj)
+        User.objects.bulk_create(objs)
+        for obj in objs:
+            post_save.send(User, instance=obj, created=True)
+        return objs
+
+    @staticmethod
+    def bulk_update(username_user_mapper, users):
+        objs = []
+        fields = set()
+        for user in users:
+            obj = username_user_mapper[user['username']]
+            user_fields = {*user.keys(), 'name', 'email'}
+            old_values = {k: getattr(obj, k) for k in user_fields}
+            for k, v in user.items():
+                setattr(obj, k, v)
+            # bulk_update 不会调用 save，名称为空、邮箱不对时与 save 一样填充
+            obj.set_unprovide_attr_if_need()
+            changed = [k for k in user_fields if getattr(obj, k) != old_values[k]]
+            if not changed:
+                continue
+            fields.update(changed)
+            objs.append(obj)
+        if objs:
+            User.objects.bulk_update(objs, fields=list(fields))
+        # 与逐个保存时一样发送信号
+        for obj in objs:
+            post_save.send(User, instance=obj, created=False)
+        return list(username_user_mapper.values())
+
+    @transaction.atomic
+    def import_chunk(self, users):
+        users = {user['username']: self.clean_user(user) for user in users}
         objs = []
+        # admin 保存时有特殊处理，不批量更新
+        admin = users.pop('admin', None)
+        if admin:
+            obj, created = self.update_or_create(admin)
+            objs.append(obj)
+        username_user_mapper = User.objects.in_bulk(list(users.keys()), field_name='username')
+        to_create = [u for name, u in users.items() if name not in username_user_mapper]
+        to_update = [u for name, u in users.items() if name in username_user_mapper]
+        objs.extend(self.bulk_update(username_user_mapper, to_update))
+        objs.extend(self.bulk_create(to_create))
+        return objs
+
+    def import_chunk_one_by_one(self, users):
+        objs, errors = [], []
         for user in users:
             try:
                 obj, created = self.update_or_create(user)
@@ -376,9 +599,31 @@ class LDAPImportUtil(object):
             except Exception as e:
                 errors.append({user['username']: str(e)})
                 logger.error(e)
-        if org and not org.is_root():
-            org.members.add(*objs)
-        logger.info('End perform import ldap users')
+        return objs, errors
+
+    def perform_import(self, users, org=None):
+        """
+        :param users: 可以是生成器
+        """
+        logger.info('Start perform import ldap users')
+        errors = []
+        self.count = count = 0
+        if self.callback:
+            self.callback(count)
+        for chunk in iter_chunks(users, self.chunk_size):
+            try:
+                objs = self.import_chunk(chunk)
+            except Exception as e:
+                logger.error('Import ldap users chunk error, import one by one: {}'.format(e))
+                objs, chunk_errors = self.import_chunk_one_by_one(chunk)
+                errors.extend(chunk_errors)
+            if org and not org.is_root():
+                org.members.add(*objs)
+            self.count = count = count + len(chunk)
+            logger.info('Imported ldap users: {}'.format(count))
+            if self.callback:
+                self.callback(count)
+        logger.info('End perform import ldap users, count: {}'.format(count))
         return errors
 
 
@@ -584,7 +829,10 @@ class LDAPTestUtil(object):
     def _test_login_auth(username, password):
         backend = LDAPAuthorizationBackend()
         ldap_user = LDAPUser(backend, username=username.strip())
-        ldap_user._authenticate_user_dn(password)
+        try:
+            ldap_user._authenticate_user_dn(password)
+        finally:
+            ldap_user.release_connection()
 
     def _test_login(self, username, password):
         self._test_before_login_check(username, password)
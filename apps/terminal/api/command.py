@@ -14,6 +14,7 @@ from terminal.filters import CommandFilter
 from orgs.utils import current_org
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor, IsAppUser
 from common.drf.api import JMSBulkModelViewSet
+from common.drf.pagination import KeysetLimitOffsetPagination
 from common.utils import get_logger
 from terminal.serializers import InsecureCommandAlertSerializer
 from terminal.exceptions import StorageInvalid
@@ -109,6 +110,9 @@ class CommandViewSet(JMSBulkModelViewSet):
     serializer_class = SessionCommandSerializer
     filterset_class = CommandFilter
     ordering_fields = ('timestamp', )
+    # 只对数据库存储生效，ES 等仍然按 offset 分页
+    pagination_class = KeysetLimitOffsetPagination
+    keyset_pagination_field = 'timestamp'
 
     def merge_all_storage_list(self, request, *args, **kwargs):
         merged_commands = []
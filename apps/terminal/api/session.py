@@ -19,6 +19,7 @@ from common.utils import get_logger, get_object_or_none
 from common.mixins.api import AsyncApiMixin
 from common.permissions import IsOrgAdminOrAppUser, IsOrgAuditor, IsAppUser
 from common.drf.filters import DatetimeRangeFilter
+from common.drf.pagination import KeysetLimitOffsetPagination
 from common.drf.renders import PassthroughRenderer
 from orgs.mixins.api import OrgBulkModelViewSet
 from orgs.utils import tmp_to_root_org, tmp_to_org
@@ -50,6 +51,8 @@ class SessionViewSet(OrgBulkModelViewSet):
         ('date_start', ('date_from', 'date_to'))
     ]
     extra_filter_backends = [DatetimeRangeFilter]
+    pagination_class = KeysetLimitOffsetPagination
+    keyset_pagination_field = 'date_start'
 
     @staticmethod
     def prepare_offline_file(session, local_path):
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.13 on 2022-01-10 10:21
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0042_auto_20211229_1619'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionDailyStatistics',
+            fields=[
+                ('org_id', models.CharField(blank=True, db_index=True, default='', max_length=36, verbose_name='Organization')),
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('type', models.CharField(choices=[('user', 'User'), ('asset', 'Asset')], max_length=16, verbose_name='Type')),
+                ('key', models.CharField(max_length=128, verbose_name='Key')),
+                ('name', models.CharField(default='', max_length=128, verbose_name='Name')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('date_last', models.DateTimeField(null=True, verbose_name='Date last')),
+            ],
+            options={
+                'verbose_name': 'Session daily statistics',
+                'db_table': 'terminal_session_daily_statistics',
+                'unique_together': {('org_id', 'date', 'type', 'key')},
+            },
+        ),
+    ]
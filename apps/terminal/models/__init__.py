@@ -5,3 +5,4 @@ from .storage import *
 from .task import *
 from .terminal import *
 from .sharing import *
+from .statistics import *
@@ -0,0 +1,135 @@
+import uuid
+import datetime
+
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from common.db.models import TextChoices
+from common.utils import get_logger
+from orgs.mixins.models import OrgModelMixin
+from orgs.utils import tmp_to_root_org
+from .session import Session
+
+logger = get_logger(__name__)
+
+__all__ = ['SessionDailyStatistics']
+
+
+class SessionDailyStatistics(OrgModelMixin):
+    """
+    每个组织每天 每个用户、每个资产 的会话数量，仪表盘从这里统计，不用扫描会话表
+    - 会话创建、结束时重新统计会话所在那天的这个用户和资产
+    - 定期任务重新统计最近几天，修正遗漏(如 bulk_create 的会话)
+    """
+    class Type(TextChoices):
+        user = 'user', _('User')
+        asset = 'asset', _('Asset')
+
+    # 与之前仪表盘的统计保持一致: 用户按 user_id，资产按 asset 名称
+    TYPE_SESSION_FIELD_MAPPER = {
+        Type.user: ('user_id', 'user'),
+        Type.asset: ('asset', 'asset'),
+    }
+    # 全部补全过的标记，没有会话时统计表一直是空的，不能只根据表中有没有数据判断
+    BACKFILLED_CACHE_KEY = 'SESSION_DAILY_STATISTICS_BACKFILLED'
+
+    id = models.UUIDField(default=uuid.uuid4, primary_key=True)
+    date = models.DateField(verbose_name=_('Date'), db_index=True)
+    type = models.CharField(max_length=16, choices=Type.choices, verbose_name=_('Type'))
+    key = models.CharField(max_length=128, verbose_name=_('Key'))
+    name = models.CharField(max_length=128, default='', verbose_name=_('Name'))
+    count = models.IntegerField(default=0, verbose_name=_('Count'))
+    date_last = models.DateTimeField(null=True, verbose_name=_('Date last'))
+
+    class Meta:
+        db_table = 'terminal_session_daily_statistics'
+        unique_together = [('org_id', 'date', 'type', 'key')]
+        verbose_name = _('Session daily statistics')
+
+    def __str__(self):
+        return '{0.date} {0.type} {0.name}: {0.count}'.format(self)
+
+    @staticmethod
+    def get_date_range(date):
+        """ 本地时区的一天 [ds, de) """
+        ds = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+        de = ds + datetime.timedelta(days=1)
+        return ds, de
+
+    @staticmethod
+    def get_session_date(session):
+        return timezone.localtime(session.date_start).date()
+
+    @classmethod
+    def is_backfilled(cls):
+        if cache.get(cls.BACKFILLED_CACHE_KEY):
+            return True
+        with tmp_to_root_org():
+            return cls.objects.exists()
+
+    @classmethod
+    def mark_backfilled(cls):
+        cache.set(cls.BACKFILLED_CACHE_KEY, 1, None)
+
+    @classmethod
+    def aggregate_sessions(cls, org_id, date, tp, key):
+        key_field, name_field = cls.TYPE_SESSION_FIELD_MAPPER[tp]
+        ds, de = cls.get_date_range(date)
+        return Session.objects.filter(
+            org_id=org_id, date_start__gte=ds, date_start__lt=de, **{key_field: key}
+        ).aggregate(count=Count('id'), name=Max(name_field), date_last=Max('date_start'))
+
+    @classmethod
+    def refresh(cls, org_id, date, tp, key):
+        """ 重新统计一项，结果与执行次数无关 """
+        with tmp_to_root_org():
+            data = cls.aggregate_sessions(org_id, date, tp, key)
+            lookup = dict(org_id=org_id, date=date, type=tp, key=key)
+            if not data['count']:
+                cls.objects.filter(**lookup).delete()
+                return
+            try:
+                cls.objects.update_or_create(defaults=data, **lookup)
+            except IntegrityError:
+                # 并发创建同一项时后创建的失败，这一项已经存在，重新统计后更新
+                data = cls.aggregate_sessions(org_id, date, tp, key)
+                cls.objects.filter(**lookup).update(**data)
+
+    @classmethod
+    def refresh_session(cls, session):
+        date = cls.get_session_date(session)
+        for tp, (key_field, __) in cls.TYPE_SESSION_FIELD_MAPPER.items():
+            key = getattr(session, key_field)
+            cls.refresh(session.org_id, date, tp, key)
+
+    @classmethod
+    def rebuild_date(cls, date):
+        """ 重新统计所有组织某一天的数据，每种类型一次分组查询 """
+        ds, de = cls.get_date_range(date)
+        objs = []
+        with tmp_to_root_org():
+            sessions = Session.objects.filter(date_start__gte=ds, date_start__lt=de)
+            for tp, (key_field, name_field) in cls.TYPE_SESSION_FIELD_MAPPER.items():
+                rows = sessions.values('org_id', key_field).annotate(
+                    count=Count('id'), name=Max(name_field), date_last=Max('date_start')
+                )
+                for row in rows:
+                    objs.append(cls(
+                        org_id=row['org_id'], date=date, type=tp, key=row[key_field],
+                        name=row['name'] or '', count=row['count'], date_last=row['date_last']
+                    ))
+            with transaction.atomic():
+                cls.objects.filter(date=date).delete()
+                cls.objects.bulk_create(objs, batch_size=1000)
+        return len(objs)
+
+    @classmethod
+    def rebuild_recent_days(cls, days):
+        today = timezone.localdate()
+        for i in range(days - 1, -1, -1):
+            date = today - datetime.timedelta(days=i)
+            amount = cls.rebuild_date(date)
+            logger.debug(f'Rebuild session daily statistics: date={date} rows={amount}')
@@ -1,2 +1,28 @@
 # -*- coding: utf-8 -*-
 #
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from common.decorator import on_transaction_commit
+from common.utils import get_logger
+from .models import Session, SessionDailyStatistics
+
+logger = get_logger(__name__)
+
+
+@on_transaction_commit
+def refresh_session_daily_statistics(session):
+    try:
+        SessionDailyStatistics.refresh_session(session)
+    except Exception as e:
+        # 统计失败不影响会话，定期任务会修正
+        logger.error(f'Refresh session daily statistics error: {e}')
+
+
+@receiver(post_save, sender=Session)
+def on_session_saved(sender, instance, created, update_fields=None, **kwargs):
+    # 会话创建、结束时更新，只更新其它字段(如 has_replay)时不影响统计
+    if not created and update_fields and 'is_finished' not in update_fields:
+        return
+    if created or instance.is_finished:
+        refresh_session_daily_statistics(instance)
@@ -11,10 +11,11 @@ from django.utils import timezone
 from django.core.files.storage import default_storage
 
 from common.utils import get_log_keep_day
+from orgs.utils import tmp_to_root_org
 from ops.celery.decorator import (
     register_as_period_task, after_app_ready_start, after_app_shutdown_clean_periodic
 )
-from .models import Status, Session, Command
+from .models import Status, Session, Command, SessionDailyStatistics
 from .backends import server_replay_storage
 from .utils import find_session_replay_local
 
@@ -62,6 +63,9 @@ def clean_expired_session_period():
 
     expired_sessions.delete()
     logger.info("Clean session item done")
+    with tmp_to_root_org():
+        SessionDailyStatistics.objects.filter(date__lt=timezone.localdate(expire_date)).delete()
+    logger.info("Clean session daily statistics done")
     expired_commands.delete()
     logger.info("Clean session command done")
     command = "find %s -mtime +%s -name '*.gz' -exec rm -f {} \\;" % (
@@ -73,6 +77,31 @@ def clean_expired_session_period():
     logger.info("Clean session replay done")
 
 
+@shared_task
+def backfill_session_daily_statistics(days=None):
+    """
+    重新统计最近 days 天(默认是会话保存的天数)的会话每日统计
+    """
+    backfill_all = days is None
+    if backfill_all:
+        days = get_log_keep_day('TERMINAL_SESSION_KEEP_DURATION')
+    logger.info(f'Start backfill session daily statistics: days={days}')
+    SessionDailyStatistics.rebuild_recent_days(days)
+    if backfill_all:
+        SessionDailyStatistics.mark_backfilled()
+    logger.info('Backfill session daily statistics done')
+
+
+@shared_task
+@register_as_period_task(interval=3600*24)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def refresh_session_daily_statistics_period():
+    # 第一次运行时补全全部，之后只修正最近两天
+    days = 2 if SessionDailyStatistics.is_backfilled() else None
+    backfill_session_daily_statistics(days)
+
+
 @shared_task
 def upload_session_replay_to_external_storage(session_id):
     logger.info(f'Start upload session to external storage: {session_id}')
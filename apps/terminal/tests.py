@@ -1,3 +1,40 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.test import TestCase
+from django.utils import timezone
+
+from common.utils import get_log_keep_day
+from orgs.models import Organization
+from orgs.utils import tmp_to_root_org
+from .models import SessionDailyStatistics
+from .tasks import refresh_session_daily_statistics_period
+
+
+class SessionDailyStatisticsTestCase(TestCase):
+    def setUp(self):
+        cache.delete(SessionDailyStatistics.BACKFILLED_CACHE_KEY)
+        self.org_id = str(Organization.default().id)
+        self.date = timezone.localdate()
+
+    def test_backfill_once_when_no_statistics(self):
+        with mock.patch.object(SessionDailyStatistics, 'rebuild_recent_days') as rebuild:
+            refresh_session_daily_statistics_period()
+            refresh_session_daily_statistics_period()
+        days = get_log_keep_day('TERMINAL_SESSION_KEEP_DURATION')
+        self.assertEqual([c.args for c in rebuild.call_args_list], [(days,), (2,)])
 
-# Create your tests here.
+    def test_refresh_retry_as_update_on_integrity_error(self):
+        data = {'count': 3, 'name': 'refresh_test_user', 'date_last': timezone.now()}
+        lookup = dict(org_id=self.org_id, date=self.date, type=SessionDailyStatistics.Type.user, key='u1')
+        with tmp_to_root_org():
+            # 模拟并发: 另一个进程在 update_or_create 查询之后创建了这一项
+            SessionDailyStatistics.objects.create(count=1, **lookup)
+            manager_class = SessionDailyStatistics.objects.__class__
+            with mock.patch.object(SessionDailyStatistics, 'aggregate_sessions', return_value=data), \
+                    mock.patch.object(manager_class, 'update_or_create', side_effect=IntegrityError):
+                SessionDailyStatistics.refresh(self.org_id, self.date, SessionDailyStatistics.Type.user, 'u1')
+            obj = SessionDailyStatistics.objects.get(**lookup)
+        self.assertEqual(obj.count, 3)
+        self.assertEqual(obj.name, 'refresh_test_user')
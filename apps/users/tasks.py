@@ -79,13 +79,13 @@ def check_user_expired_periodic():
 def import_ldap_user():
     logger.info("Start import ldap user task")
     util_server = LDAPServerUtil()
-    util_import = LDAPImportUtil()
-    users = util_server.search()
+    util_import = LDAPImportUtil(callback=LDAPImportUtil.set_task_progress)
+    users = util_server.iter_users()
     errors = util_import.perform_import(users)
     if errors:
         logger.error("Imported LDAP users errors: {}".format(errors))
     else:
-        logger.info('Imported {} users successfully'.format(len(users)))
+        logger.info('Imported {} users successfully'.format(util_import.count))
 
 
 @shared_task
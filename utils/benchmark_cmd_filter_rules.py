@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# 比较命令过滤规则 每次编译后逐个匹配(之前的实现)、预编译后逐个匹配、预编译并按必须出现的字符串筛选后匹配 的耗时，
+# 并校验结果是否一致
+#
+# 使用随机生成的规则和命令，不需要数据库中有数据，之前的实现太慢，只取一部分命令测试后换算:
+#   python benchmark_cmd_filter_rules.py -r 1000 -c 10000 -s 100
+#
+import os
+import sys
+import time
+import uuid
+import random
+import string
+import argparse
+
+import django
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS_DIR = os.path.join(BASE_DIR, 'apps')
+sys.path.insert(0, APPS_DIR)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from assets.models import CommandFilterRule, CommandFilterRuleSet
+
+Action = CommandFilterRule.ActionChoices
+
+
+def random_word(min_length=3, max_length=10):
+    length = random.randint(min_length, max_length)
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def generate_rules(amount):
+    rules = []
+    for i in range(amount):
+        if random.random() < 0.8:
+            tp = CommandFilterRule.TYPE_COMMAND
+            lines = [random_word() for _ in range(random.randint(1, 5))]
+            if random.random() < 0.3:
+                lines.append('{} -{}'.format(random_word(), random.choice('rfv')))
+            content = '\n'.join(lines)
+        else:
+            tp = CommandFilterRule.TYPE_REGEX
+            content = r'{}\s+\d+'.format(random_word())
+        rules.append({
+            'id': str(uuid.uuid4()),
+            'filter_id': str(uuid.uuid4()),
+            'type': tp,
+            'content': content,
+            'priority': random.randint(1, 100),
+            'action': random.choice([Action.deny, Action.allow, Action.confirm]),
+        })
+    return rules
+
+
+def generate_commands(amount, rules):
+    words = [line.split()[0] for r in rules if r['type'] == CommandFilterRule.TYPE_COMMAND
+             for line in r['content'].split('\n')]
+    commands = []
+    for _ in range(amount):
+        parts = [random_word() for _ in range(random.randint(1, 6))]
+        # 一部分命令能匹配到规则
+        if random.random() < 0.3:
+            parts.insert(random.randint(0, len(parts)), random.choice(words))
+        commands.append(' '.join(parts))
+    return commands
+
+
+def match_compile_every_time(rules, command):
+    """ 之前的实现: 每次匹配都编译每个规则的正则 """
+    for rule in rules:
+        pattern = CommandFilterRule.get_pattern(rule['type'], rule['content'])
+        succeed, error, compiled = CommandFilterRule.compile_regex(pattern)
+        if not succeed:
+            continue
+        found = compiled.search(command)
+        if found:
+            return rule['id'], found.group()
+    return None, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark command filter rules matching')
+    parser.add_argument('-r', '--rules', type=int, default=1000, help='rules amount')
+    parser.add_argument('-c', '--commands', type=int, default=10000, help='commands amount')
+    parser.add_argument('-s', '--sample', type=int, default=100, help='commands amount for the old implementation')
+    args = parser.parse_args()
+
+    rules = generate_rules(args.rules)
+    commands = generate_commands(args.commands, rules)
+
+    t_start = time.time()
+    rule_set = CommandFilterRuleSet(rules)
+    compile_cost = time.time() - t_start
+    print(f'Rules: {len(rules)} commands: {len(commands)} '
+          f'always_match: {len(rule_set.always_match_indexes)} compile={compile_cost:.3f}s')
+
+    sample = commands[:args.sample]
+    t_start = time.time()
+    old_results = [match_compile_every_time(rule_set.rules, command) for command in sample]
+    old_cost = (time.time() - t_start) * len(commands) / max(len(sample), 1)
+
+    t_start = time.time()
+    linear_results = []
+    for command in commands:
+        for rule, compiled in rule_set.compiled_rules:
+            found = compiled.search(command)
+            if found:
+                linear_results.append((rule['id'], found.group()))
+                break
+        else:
+            linear_results.append((None, ''))
+    linear_cost = time.time() - t_start
+
+    t_start = time.time()
+    rule_set_results = []
+    for command in commands:
+        rule, matched = rule_set.match(command)
+        rule_set_results.append((rule['id'] if rule else None, matched))
+    rule_set_cost = time.time() - t_start
+
+    matched_amount = sum(1 for rule_id, __ in rule_set_results if rule_id)
+    same = linear_results == rule_set_results and old_results == rule_set_results[:len(sample)]
+    print(f'Matched: {matched_amount} same={same}')
+    print(f'compile_every_time={old_cost:.3f}s(estimated) precompiled={linear_cost:.3f}s '
+          f'rule_set={rule_set_cost:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# 比较 NodeAssetsUtil 计算节点资产数量 与 之前逐层合并资产集合的实现 的耗时，并校验结果是否一致
+#
+# 使用随机生成的节点树，不需要数据库中有数据:
+#   python benchmark_node_assets_amount.py -d 5 -f 8 -a 500000 -l 500000
+#
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+
+import django
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS_DIR = os.path.join(BASE_DIR, 'apps')
+sys.path.insert(0, APPS_DIR)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from common.struct import Stack
+from assets.utils import NodeAssetsUtil
+
+
+class FakeNode:
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+
+class MergeSetsNodeAssetsUtil:
+    """ 之前的实现: 按 key 排序后用栈逐层把子节点的资产集合合并到父节点 """
+
+    def __init__(self, nodes, nodekey_assetsid_mapper):
+        self.nodes = nodes
+        self.nodekey_assetsid_mapper = nodekey_assetsid_mapper
+        self.nodekey_assets_amount_mapper = {}
+
+    def generate(self):
+        infos = []
+        for node in self.nodes:
+            assets = set(self.nodekey_assetsid_mapper.get(node.key, set()))
+            infos.append([node.key, assets])
+        infos = sorted(infos, key=lambda i: [int(k) for k in i[0].split(':')])
+        infos.append(['', set()])
+
+        stack = Stack()
+        for info in infos:
+            while stack.top and not info[0].startswith(f'{stack.top[0]}:'):
+                key, assets = stack.pop()
+                self.nodekey_assets_amount_mapper[key] = len(assets)
+                if not stack.top:
+                    continue
+                stack.top[1].update(assets)
+            stack.push(info)
+
+    def get_assets_amount(self, key):
+        return self.nodekey_assets_amount_mapper[key]
+
+
+def generate_tree(depth, fan_out, nodes_amount):
+    keys = ['1']
+    level = ['1']
+    for _ in range(depth - 1):
+        next_level = []
+        for key in level:
+            for i in range(fan_out):
+                next_level.append(f'{key}:{i}')
+        keys.extend(next_level)
+        level = next_level
+        if len(keys) >= nodes_amount:
+            break
+    return keys[:nodes_amount]
+
+
+def generate_mapping(keys, assets_amount, links_amount):
+    asset_ids = [uuid.uuid4().hex for _ in range(assets_amount)]
+    mapping = {}
+    for _ in range(links_amount):
+        key = random.choice(keys)
+        mapping.setdefault(key, set()).add(random.choice(asset_ids))
+    return mapping
+
+
+def run(util_class, nodes, mapping):
+    util = util_class(nodes, mapping)
+    t_start = time.time()
+    util.generate()
+    return util, time.time() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark node assets amount computing')
+    parser.add_argument('-d', '--depth', type=int, default=5, help='tree depth')
+    parser.add_argument('-f', '--fan-out', type=int, default=8, help='max children of a node')
+    parser.add_argument('-n', '--nodes', type=int, default=50000, help='max nodes amount')
+    parser.add_argument('-a', '--assets', type=int, default=100000, help='assets amount')
+    parser.add_argument('-l', '--links', type=int, default=500000, help='node asset links amount')
+    parser.add_argument('-r', '--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    keys = generate_tree(args.depth, args.fan_out, args.nodes)
+    nodes = [FakeNode(key) for key in keys]
+    mapping = generate_mapping(keys, args.assets, args.links)
+    print(f'Nodes: {len(nodes)} links: {sum(len(i) for i in mapping.values())}')
+
+    for i in range(args.rounds):
+        old_util, old_cost = run(MergeSetsNodeAssetsUtil, nodes, mapping)
+        new_util, new_cost = run(NodeAssetsUtil, nodes, mapping)
+        same = all(
+            old_util.get_assets_amount(key) == new_util.get_assets_amount(key)
+            for key in keys
+        )
+        print(f'Round {i}: merge_sets={old_cost:.3f}s new={new_cost:.3f}s same={same}')
+
+
+if __name__ == '__main__':
+    main()
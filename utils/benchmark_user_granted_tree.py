@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# 比较用户授权树 全量重建 与 增量更新 的耗时，并校验两者的结果是否一致
+#
+# 先生成测试数据(10w 资产):
+#   python generate_fake_data/generate.py node -c 1000
+#   python generate_fake_data/generate.py asset -c 100000 -b 1000
+#   python generate_fake_data/generate.py asset_permission -c 1000
+#
+# 然后运行:
+#   python benchmark_user_granted_tree.py -u 20 -k 5
+#
+import os
+import sys
+import time
+import random
+import argparse
+
+import django
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS_DIR = os.path.join(BASE_DIR, 'apps')
+sys.path.insert(0, APPS_DIR)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.db import transaction
+
+from orgs.models import Organization
+from orgs.utils import tmp_to_org
+from assets.models import Asset, Node
+from perms.models import AssetPermission, UserAssetGrantedTreeNodeRelation
+from perms.utils.asset.user_permission import (
+    UserGrantedTreeBuildUtils, get_user_all_asset_perm_ids
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+def dump_user_tree(user):
+    rels = UserAssetGrantedTreeNodeRelation.objects.filter(user=user).values_list(
+        'node_key', 'node_parent_key', 'node_from', 'node_assets_amount'
+    )
+    return sorted(rels)
+
+
+def benchmark_user(user, changed_keys_amount):
+    utils = UserGrantedTreeBuildUtils(user)
+    t_start = time.time()
+    utils.rebuild_user_granted_tree()
+    rebuild_cost = time.time() - t_start
+
+    # 模拟一次授权变化: 从用户的一条授权中移除几个节点
+    perm_ids = list(get_user_all_asset_perm_ids(user))
+    if not perm_ids:
+        return None
+    perm = AssetPermission.objects.get(id=random.choice(perm_ids))
+    nodes = list(perm.nodes.all()[:changed_keys_amount])
+    if not nodes:
+        nodes = random.sample(list(Node.objects.all()), changed_keys_amount)
+        perm.nodes.add(*nodes)
+    else:
+        perm.nodes.remove(*nodes)
+    changed_keys = {node.key for node in nodes}
+
+    utils = UserGrantedTreeBuildUtils(user)
+    t_start = time.time()
+    utils.update_user_granted_tree(changed_keys)
+    update_cost = time.time() - t_start
+    updated_tree = dump_user_tree(user)
+
+    UserGrantedTreeBuildUtils(user).rebuild_user_granted_tree()
+    rebuilt_tree = dump_user_tree(user)
+    return rebuild_cost, update_cost, updated_tree == rebuilt_tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark user granted tree rebuild/update')
+    parser.add_argument('-o', '--org', type=str, default='')
+    parser.add_argument('-u', '--users', type=int, default=20, help='users amount to benchmark')
+    parser.add_argument('-k', '--keys', type=int, default=5, help='changed node keys amount')
+    args = parser.parse_args()
+
+    org = Organization.get_instance(args.org, default=Organization.default())
+    with tmp_to_org(org):
+        print(f'Org: {org} assets={Asset.objects.count()} nodes={Node.objects.count()}')
+        users = list(org.get_members()[:args.users])
+
+        total_rebuild, total_update, mismatched = 0, 0, 0
+        for user in users:
+            try:
+                with transaction.atomic():
+                    ret = benchmark_user(user, args.keys)
+                    raise Rollback
+            except Rollback:
+                pass
+            if ret is None:
+                continue
+            rebuild_cost, update_cost, same = ret
+            total_rebuild += rebuild_cost
+            total_update += update_cost
+            mismatched += not same
+            print(f'{user}: rebuild={rebuild_cost:.3f}s update={update_cost:.3f}s same={same}')
+
+        print(f'Total: rebuild={total_rebuild:.3f}s update={total_update:.3f}s mismatched={mismatched}')
+
+
+if __name__ == '__main__':
+    main()